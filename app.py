@@ -4,6 +4,7 @@ from config import Config
 from models import db, init_standaard_data, Gebruiker
 from routes import all_blueprints
 from routes.auth import auth_bp
+from commands import registreer_commands
 
 
 def create_app():
@@ -26,6 +27,8 @@ def create_app():
     for bp in all_blueprints:
         app.register_blueprint(bp)
 
+    registreer_commands(app)
+
     with app.app_context():
         db.create_all()
         init_standaard_data()
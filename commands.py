@@ -0,0 +1,146 @@
+"""CLI-commando's voor onderhoud van de administratie.
+
+Gebruik: flask --app app <commando>
+"""
+import click
+from utils.saldi import herbereken_saldi
+from utils.btwtotalen import herbereken_btw
+from utils.periodes import sluit_periode, herbereken_periodes
+from utils.bankimport import importeer_afschrift
+from utils.factuurimport import lees_bestand, importeer_facturen
+from utils.nummering import ontbrekende_nummers, REEKSEN
+from utils.taken import verwerk_wachtende_taken
+from utils.openstaand import controleer_openstaand, markeer_vervallen
+from utils.xaf import xaf_stroom, xaf_bestandsnaam
+from utils.analyse import DATASETS, FORMATEN, exporteer
+from migraties import voer_migraties_uit, huidige_versie
+
+
+def registreer_commands(app):
+    """Registreer alle onderhoudscommando's bij de Flask CLI."""
+
+    @app.cli.command('db-migreer')
+    def db_migreer():
+        """Voer openstaande databasemigraties uit (ook onderdeel van seed.py)."""
+        aantal = voer_migraties_uit()
+        click.echo(f'{aantal} migratie(s) uitgevoerd, schemaversie {huidige_versie()}.')
+
+    @app.cli.command('saldi-herbereken')
+    def saldi_herbereken():
+        """Bouw de tabel rekening_saldo opnieuw op vanuit het journaal."""
+        aantal = herbereken_saldi()
+        click.echo(f'Saldi van {aantal} grootboekrekeningen herberekend.')
+
+    @app.cli.command('btw-herbereken')
+    def btw_herbereken():
+        """Bouw de BTW-totalen per maand en tarief opnieuw op vanuit de facturen."""
+        click.echo(f'{herbereken_btw()} BTW-totalen herberekend.')
+
+    @app.cli.command('periode-afsluiten')
+    @click.argument('jaar', type=int)
+    @click.argument('maand', type=click.IntRange(1, 12))
+    def periode_afsluiten(jaar, maand):
+        """Sluit een maand af en leg de eindstand per rekening vast."""
+        periode = sluit_periode(jaar, maand)
+        click.echo(f'Periode {periode.jaar}-{periode.maand:02d} afgesloten '
+                   f'({len(periode.saldi)} rekeningen vastgelegd).')
+
+    @app.cli.command('periodes-herbereken')
+    def periodes_herbereken():
+        """Leg standen opnieuw vast voor afgesloten periodes met late boekingen."""
+        aantal = herbereken_periodes()
+        click.echo(f'{aantal} periode(s) herberekend.')
+
+    @app.cli.command('facturen-vervallen')
+    def facturen_vervallen():
+        """Zet facturen met een verstreken vervaldatum op 'vervallen' (ook periodiek via worker.py)."""
+        aantallen = markeer_vervallen()
+        click.echo(f"{aantallen['verkoop']} verkoop- en {aantallen['inkoop']} inkoopfactu(u)r(en) vervallen.")
+
+    @app.cli.command('openstaand-controleer')
+    @click.option('--herstel', is_flag=True, help='Herbereken betaalde en openstaande bedragen.')
+    def openstaand_controleer(herstel):
+        """Controleer de opgeslagen betaalde/openstaande bedragen tegen de betalingen."""
+        afwijkingen = controleer_openstaand(herstel=herstel)
+        for factuur_type, nummer, opgeslagen, berekend in afwijkingen:
+            click.echo(f'  {factuur_type} {nummer}: opgeslagen {opgeslagen:.2f}, betalingen {berekend:.2f}')
+        if not afwijkingen:
+            click.echo('Alle facturen kloppen.')
+        elif herstel:
+            click.echo(f'{len(afwijkingen)} factu(u)r(en) hersteld.')
+        else:
+            click.echo(f'{len(afwijkingen)} afwijking(en). Gebruik --herstel om te corrigeren.')
+
+    @app.cli.command('nummers-controleer')
+    @click.option('--jaar', type=int, default=None, help='Jaar (standaard het lopende jaar).')
+    def nummers_controleer(jaar):
+        """Rapporteer uitgegeven maar ongebruikte factuurnummers per reeks."""
+        for prefix in REEKSEN:
+            gaten = ontbrekende_nummers(prefix, jaar)
+            if not gaten:
+                click.echo(f'{prefix}: geen ontbrekende nummers.')
+            for van, tot in gaten:
+                click.echo(f'{prefix}: {van} ontbreekt' if van == tot else f'{prefix}: {van} t/m {tot} ontbreken')
+
+    @app.cli.command('facturen-import')
+    @click.argument('bestand', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--boeken', is_flag=True, help='Facturen direct verzenden en journaalposten maken.')
+    @click.option('--strikt', is_flag=True, help='Niets importeren als er fouten zijn.')
+    def facturen_import(bestand, boeken, strikt):
+        """Importeer verkoopfacturen uit een CSV- of JSON-bestand."""
+        with open(bestand, 'rb') as f:
+            try:
+                facturen = lees_bestand(bestand, f.read())
+            except (ValueError, UnicodeDecodeError) as e:
+                raise click.ClickException(f'Bestand kan niet worden gelezen: {e}')
+        resultaat = importeer_facturen(facturen, boeken=boeken, strikt=strikt)
+        for rij, melding in resultaat['fouten']:
+            click.echo(f'  Rij {rij}: {melding}')
+        click.echo(f"{resultaat['facturen']} facturen en {resultaat['regels']} regels geïmporteerd "
+                   f"in {resultaat['seconden']}s ({resultaat['regels_per_seconde']} regels/s), "
+                   f"{len(resultaat['fouten'])} fout(en).")
+
+    @app.cli.command('bank-import')
+    @click.argument('bestand', type=click.Path(exists=True, dir_okay=False))
+    def bank_import(bestand):
+        """Lees een bankafschrift (CAMT.053 of MT940) in en koppel de transacties aan facturen."""
+        with open(bestand, 'rb') as f:
+            try:
+                resultaat = importeer_afschrift(bestand, f)
+            except (ValueError, SyntaxError) as e:
+                raise click.ClickException(f'Afschrift kan niet worden gelezen: {e}')
+        click.echo(f"{resultaat['transacties']} transacties in {resultaat['seconden']}s: "
+                   f"{resultaat['gekoppeld']} gekoppeld, {resultaat['te_beoordelen']} te beoordelen, "
+                   f"{resultaat['dubbel']} al eerder ingelezen.")
+
+    @app.cli.command('xaf-export')
+    @click.argument('jaar', type=int)
+    @click.option('--uitvoer', type=click.Path(dir_okay=False), default=None,
+                  help='Bestandsnaam (standaard auditfile_JAAR.xaf).')
+    @click.option('--gzip', 'comprimeer', is_flag=True, help='Gzip-gecomprimeerd wegschrijven.')
+    def xaf_export(jaar, uitvoer, comprimeer):
+        """Schrijf de auditfile (XAF 3.2) van een boekjaar weg."""
+        uitvoer = uitvoer or xaf_bestandsnaam(jaar, comprimeer)
+        with open(uitvoer, 'wb') as bestand:
+            for deel in xaf_stroom(jaar, comprimeer):
+                bestand.write(deel)
+        click.echo(f'Auditfile {jaar} geschreven naar {uitvoer}.')
+
+    @app.cli.command('analyse-export')
+    @click.option('--dataset', 'datasets', multiple=True, type=click.Choice(sorted(DATASETS)),
+                  help='Alleen deze dataset(s); standaard alle.')
+    @click.option('--formaat', type=click.Choice(sorted(FORMATEN)), default='parquet', show_default=True)
+    @click.option('--volledig', is_flag=True, help='Alles opnieuw exporteren in plaats van alleen nieuwe regels.')
+    def analyse_export(datasets, formaat, volledig):
+        """Exporteer journaal- en factuurregels naar ANALYSE_MAP voor analyse (vereist pyarrow)."""
+        try:
+            resultaat = exporteer(datasets or None, formaat, volledig)
+        except (RuntimeError, ValueError) as e:
+            raise click.ClickException(str(e))
+        for dataset, r in resultaat.items():
+            click.echo(f"{dataset}: {r['rijen']} nieuwe regel(s) in {r['seconden']}s.")
+
+    @app.cli.command('taken-verwerk')
+    def taken_verwerk():
+        """Voer alle wachtende achtergrondtaken één keer uit (normaal doet worker.py dit)."""
+        click.echo(f'{verwerk_wachtende_taken()} taak/taken uitgevoerd.')
@@ -21,5 +21,12 @@ class Config:
     BEDRIJFSKVK = '12345678'
     BEDRIJFSBTW = 'NL123456789B01'
     BEDRIJFSIBAN = 'NL00BANK0123456789'
+    BEDRIJFSBIC = os.environ.get('BEDRIJFSBIC', '')  # optioneel in pain.001
     UPLOAD_FOLDER = os.path.join(basedir, 'uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB max
+    PDF_CACHE_MAP = os.environ.get('PDF_CACHE_MAP', os.path.join(basedir, 'cache', 'pdf'))
+    PDF_CACHE_MAX_MB = int(os.environ.get('PDF_CACHE_MAX_MB', 200))
+    ANALYSE_MAP = os.environ.get('ANALYSE_MAP', os.path.join(basedir, 'export', 'analyse'))
+    RAPPORT_CACHE_GROOTTE = int(os.environ.get('RAPPORT_CACHE_GROOTTE', 256))
+    # Berekende rapportgegevens ook in de tabel cache_item delen tussen workers
+    RAPPORT_CACHE_GEDEELD = os.environ.get('RAPPORT_CACHE_GEDEELD', 'false').lower() == 'true'
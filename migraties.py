@@ -0,0 +1,126 @@
+"""Versiebeheer van het databaseschema.
+
+Elke migratie heeft een oplopend versienummer en wordt één keer uitgevoerd; de
+toegepaste versies staan in de tabel schema_versie. Alle stappen zijn idempotent,
+zodat een afgebroken migratie veilig opnieuw gestart kan worden. Nieuwe tabellen
+ontstaan via db.create_all(); migraties zijn nodig voor kolommen en indexen op
+bestaande tabellen en voor het vullen van afgeleide gegevens.
+"""
+from sqlalchemy import func, inspect, text
+from models import (db, SchemaVersie, Verkoopfactuur, Inkoopfactuur, Betaling,
+                    Journaalpost, JournaalpostRegel)
+from utils.saldi import herbereken_saldi
+from utils.openstaand import controleer_openstaand
+from utils.btwtotalen import herbereken_btw
+
+
+def kolom(tabel, naam, kolom_type):
+    """Stap: voeg een kolom toe als die nog niet bestaat."""
+    def stap():
+        inspector = inspect(db.session.connection())
+        if tabel not in inspector.get_table_names():
+            return
+        if naam not in [c['name'] for c in inspector.get_columns(tabel)]:
+            db.session.execute(text(f'ALTER TABLE {tabel} ADD COLUMN {naam} {kolom_type}'))
+            db.session.commit()
+            print(f'  Kolom {tabel}.{naam} toegevoegd.')
+    return stap
+
+
+def index(model, naam):
+    """Stap: maak een index aan zoals gedeclareerd in __table_args__ van het model.
+
+    Op PostgreSQL gebeurt dat met CREATE INDEX CONCURRENTLY, zodat de tabel tijdens
+    het opbouwen beschrijfbaar blijft. Een eerder afgebroken, ongeldige index wordt
+    eerst verwijderd.
+    """
+    def stap():
+        idx = next(i for i in model.__table__.indexes if i.name == naam)
+        kolommen = ', '.join(c.name for c in idx.columns)
+        tabel = model.__tablename__
+        db.session.commit()
+
+        if db.engine.dialect.name == 'postgresql':
+            with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                ongeldig = conn.execute(text(
+                    'SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid '
+                    'WHERE c.relname = :naam AND NOT i.indisvalid'
+                ), {'naam': naam}).first()
+                if ongeldig:
+                    conn.execute(text(f'DROP INDEX CONCURRENTLY {naam}'))
+                conn.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {naam} ON {tabel} ({kolommen})'))
+        else:
+            db.session.execute(text(f'CREATE INDEX IF NOT EXISTS {naam} ON {tabel} ({kolommen})'))
+            db.session.commit()
+        print(f'  Index {naam} op {tabel} ({kolommen}) aanwezig.')
+    return stap
+
+
+def openstaand_opbouwen():
+    """Stap: vul betaald/openstaand op facturen vanuit de betalingen."""
+    afwijkingen = controleer_openstaand(herstel=True)
+    print(f'  Betaalde bedragen van {len(afwijkingen)} facturen bijgewerkt.')
+
+
+def saldi_opbouwen():
+    """Stap: vul rekening_saldo vanuit het journaal."""
+    print(f'  Saldi van {herbereken_saldi()} grootboekrekeningen opgebouwd.')
+
+
+def btw_opbouwen():
+    """Stap: vul btw_totaal vanuit de facturen."""
+    print(f'  {herbereken_btw()} BTW-totalen opgebouwd.')
+
+
+# (versie, omschrijving, stappen) - alleen achteraan toevoegen, nooit hernummeren
+MIGRATIES = [
+    (1, 'IBAN bij relaties en PDF bij inkoopfacturen', [
+        kolom('klant', 'iban', 'VARCHAR(34)'),
+        kolom('leverancier', 'iban', 'VARCHAR(34)'),
+        kolom('inkoopfactuur', 'pdf_bestand', 'VARCHAR(500)'),
+    ]),
+    (2, 'Saldotabel per grootboekrekening', [
+        saldi_opbouwen,
+    ]),
+    (3, 'Indexen voor journaal, betalingen en facturen', [
+        index(JournaalpostRegel, 'ix_journaalpost_regel_rekening'),
+        index(JournaalpostRegel, 'ix_journaalpost_regel_journaalpost'),
+        index(Journaalpost, 'ix_journaalpost_datum'),
+        index(Betaling, 'ix_betaling_factuur'),
+        index(Betaling, 'ix_betaling_type_datum'),
+        index(Verkoopfactuur, 'ix_verkoopfactuur_status_vervaldatum'),
+        index(Verkoopfactuur, 'ix_verkoopfactuur_factuurdatum'),
+        index(Inkoopfactuur, 'ix_inkoopfactuur_status_vervaldatum'),
+        index(Inkoopfactuur, 'ix_inkoopfactuur_factuurdatum'),
+    ]),
+    (4, 'Betaalde en openstaande bedragen op facturen', [
+        kolom('verkoopfactuur', 'betaald', 'FLOAT NOT NULL DEFAULT 0'),
+        kolom('verkoopfactuur', 'openstaand', 'FLOAT NOT NULL DEFAULT 0'),
+        kolom('inkoopfactuur', 'betaald', 'FLOAT NOT NULL DEFAULT 0'),
+        kolom('inkoopfactuur', 'openstaand', 'FLOAT NOT NULL DEFAULT 0'),
+        openstaand_opbouwen,
+    ]),
+    (5, 'BTW-totalen per maand en tarief', [
+        btw_opbouwen,
+    ]),
+]
+
+
+def huidige_versie():
+    return db.session.query(func.max(SchemaVersie.versie)).scalar() or 0
+
+
+def voer_migraties_uit():
+    """Voer alle migraties uit die nieuwer zijn dan de huidige schemaversie. Geeft het aantal terug."""
+    versie = huidige_versie()
+    uitgevoerd = 0
+    for nummer, omschrijving, stappen in MIGRATIES:
+        if nummer <= versie:
+            continue
+        print(f'Migratie {nummer}: {omschrijving}')
+        for stap in stappen:
+            stap()
+        db.session.add(SchemaVersie(versie=nummer, omschrijving=omschrijving))
+        db.session.commit()
+        uitgevoerd += 1
+    return uitgevoerd
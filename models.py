@@ -6,6 +6,17 @@ from datetime import datetime, date, timedelta
 db = SQLAlchemy()
 
 
+class SchemaVersie(db.Model):
+    """Toegepaste databasemigraties (zie migraties.py)."""
+    __tablename__ = 'schema_versie'
+    versie = db.Column(db.Integer, primary_key=True)
+    omschrijving = db.Column(db.String(200), nullable=False)
+    toegepast_op = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<SchemaVersie {self.versie}>'
+
+
 class Gebruiker(UserMixin, db.Model):
     __tablename__ = 'gebruiker'
     id = db.Column(db.Integer, primary_key=True)
@@ -89,6 +100,10 @@ class Valuta(db.Model):
 
 class Verkoopfactuur(db.Model):
     __tablename__ = 'verkoopfactuur'
+    __table_args__ = (
+        db.Index('ix_verkoopfactuur_status_vervaldatum', 'status', 'vervaldatum'),
+        db.Index('ix_verkoopfactuur_factuurdatum', 'factuurdatum'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     factuurnummer = db.Column(db.String(20), unique=True, nullable=False)
     klant_id = db.Column(db.Integer, db.ForeignKey('klant.id'), nullable=False)
@@ -98,6 +113,9 @@ class Verkoopfactuur(db.Model):
     subtotaal = db.Column(db.Float, default=0.0)
     btw_bedrag = db.Column(db.Float, default=0.0)
     totaal = db.Column(db.Float, default=0.0)
+    # Bijgewerkt bij elke betaling (utils.openstaand)
+    betaald = db.Column(db.Float, nullable=False, default=0.0)
+    openstaand = db.Column(db.Float, nullable=False, default=0.0)
     valuta = db.Column(db.String(3), default='EUR')
     opmerkingen = db.Column(db.Text)
     aangemaakt_op = db.Column(db.DateTime, default=datetime.utcnow)
@@ -109,11 +127,15 @@ class Verkoopfactuur(db.Model):
 
     @property
     def betaald_bedrag(self):
-        return sum(b.bedrag for b in Betaling.query.filter_by(factuur_type='verkoop', factuur_id=self.id).all())
+        return self.betaald or 0
 
     @property
     def openstaand_bedrag(self):
-        return self.totaal - self.betaald_bedrag
+        return self.openstaand if self.openstaand is not None else (self.totaal or 0) - self.betaald_bedrag
+
+    def werk_openstaand_bij(self):
+        """Herbereken het openstaande bedrag na een wijziging van het factuurtotaal."""
+        self.openstaand = round((self.totaal or 0) - (self.betaald or 0), 2)
 
     @property
     def is_vervallen(self):
@@ -146,6 +168,10 @@ class VerkoopfactuurRegel(db.Model):
 
 class Inkoopfactuur(db.Model):
     __tablename__ = 'inkoopfactuur'
+    __table_args__ = (
+        db.Index('ix_inkoopfactuur_status_vervaldatum', 'status', 'vervaldatum'),
+        db.Index('ix_inkoopfactuur_factuurdatum', 'factuurdatum'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     factuurnummer = db.Column(db.String(20), nullable=False)
     leverancier_id = db.Column(db.Integer, db.ForeignKey('leverancier.id'), nullable=False)
@@ -155,6 +181,9 @@ class Inkoopfactuur(db.Model):
     subtotaal = db.Column(db.Float, default=0.0)
     btw_bedrag = db.Column(db.Float, default=0.0)
     totaal = db.Column(db.Float, default=0.0)
+    # Bijgewerkt bij elke betaling (utils.openstaand)
+    betaald = db.Column(db.Float, nullable=False, default=0.0)
+    openstaand = db.Column(db.Float, nullable=False, default=0.0)
     valuta = db.Column(db.String(3), default='EUR')
     opmerkingen = db.Column(db.Text)
     pdf_bestand = db.Column(db.String(500))
@@ -163,11 +192,15 @@ class Inkoopfactuur(db.Model):
 
     @property
     def betaald_bedrag(self):
-        return sum(b.bedrag for b in Betaling.query.filter_by(factuur_type='inkoop', factuur_id=self.id).all())
+        return self.betaald or 0
 
     @property
     def openstaand_bedrag(self):
-        return self.totaal - self.betaald_bedrag
+        return self.openstaand if self.openstaand is not None else (self.totaal or 0) - self.betaald_bedrag
+
+    def werk_openstaand_bij(self):
+        """Herbereken het openstaande bedrag na een wijziging van het factuurtotaal."""
+        self.openstaand = round((self.totaal or 0) - (self.betaald or 0), 2)
 
     @property
     def is_vervallen(self):
@@ -200,6 +233,10 @@ class InkoopfactuurRegel(db.Model):
 
 class Betaling(db.Model):
     __tablename__ = 'betaling'
+    __table_args__ = (
+        db.Index('ix_betaling_factuur', 'factuur_type', 'factuur_id'),
+        db.Index('ix_betaling_type_datum', 'type', 'datum'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     type = db.Column(db.String(20), nullable=False)  # inkomend, uitgaand
     factuur_type = db.Column(db.String(20), nullable=False)  # verkoop, inkoop
@@ -209,13 +246,60 @@ class Betaling(db.Model):
     betaalmethode = db.Column(db.String(50), default='bank')
     referentie = db.Column(db.String(100))
     aangemaakt_op = db.Column(db.DateTime, default=datetime.utcnow)
+    # Alleen-lezen: factuur_id verwijst afhankelijk van factuur_type naar één van beide tabellen.
+    # Laad met selectinload op beide relaties om een lijst betalingen in twee IN-queries op te lossen.
+    verkoopfactuur = db.relationship('Verkoopfactuur',
+                                     primaryjoin="and_(foreign(Betaling.factuur_id)==Verkoopfactuur.id, Betaling.factuur_type=='verkoop')",
+                                     viewonly=True)
+    inkoopfactuur = db.relationship('Inkoopfactuur',
+                                    primaryjoin="and_(foreign(Betaling.factuur_id)==Inkoopfactuur.id, Betaling.factuur_type=='inkoop')",
+                                    viewonly=True)
+
+    @property
+    def factuur(self):
+        return self.verkoopfactuur if self.factuur_type == 'verkoop' else self.inkoopfactuur
+
+    @property
+    def relatie(self):
+        factuur = self.factuur
+        if factuur is None:
+            return None
+        return factuur.klant if self.factuur_type == 'verkoop' else factuur.leverancier
 
     def __repr__(self):
         return f'<Betaling {self.type} {self.bedrag}>'
 
 
+class Banktransactie(db.Model):
+    """Regel van een geïmporteerd bankafschrift; niet gekoppelde regels wachten op beoordeling."""
+    __tablename__ = 'banktransactie'
+    __table_args__ = (
+        db.Index('ix_banktransactie_status', 'status', 'datum'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    sleutel = db.Column(db.String(64), unique=True, nullable=False)  # hash tegen dubbel importeren
+    datum = db.Column(db.Date, nullable=False)
+    bedrag = db.Column(db.Float, nullable=False)
+    richting = db.Column(db.String(10), nullable=False)  # credit (ontvangen), debet (betaald)
+    iban = db.Column(db.String(34))
+    naam = db.Column(db.String(200))
+    omschrijving = db.Column(db.Text)
+    bankreferentie = db.Column(db.String(100))
+    bestand = db.Column(db.String(200))
+    status = db.Column(db.String(20), nullable=False, default='te_beoordelen')  # te_beoordelen, gekoppeld, genegeerd
+    koppeling = db.Column(db.String(30))  # factuurnummer, iban_bedrag, bedrag, handmatig
+    betaling_id = db.Column(db.Integer, db.ForeignKey('betaling.id'))
+    aangemaakt_op = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Banktransactie {self.datum} {self.richting} {self.bedrag}>'
+
+
 class Journaalpost(db.Model):
     __tablename__ = 'journaalpost'
+    __table_args__ = (
+        db.Index('ix_journaalpost_datum', 'datum', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     datum = db.Column(db.Date, nullable=False, default=date.today)
     omschrijving = db.Column(db.String(500), nullable=False)
@@ -229,6 +313,10 @@ class Journaalpost(db.Model):
 
 class JournaalpostRegel(db.Model):
     __tablename__ = 'journaalpost_regel'
+    __table_args__ = (
+        db.Index('ix_journaalpost_regel_rekening', 'grootboekrekening_id', 'journaalpost_id'),
+        db.Index('ix_journaalpost_regel_journaalpost', 'journaalpost_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     journaalpost_id = db.Column(db.Integer, db.ForeignKey('journaalpost.id'), nullable=False)
     grootboekrekening_id = db.Column(db.Integer, db.ForeignKey('grootboekrekening.id'), nullable=False)
@@ -240,6 +328,143 @@ class JournaalpostRegel(db.Model):
         return f'<JournaalpostRegel {self.grootboekrekening_id} D:{self.debet} C:{self.credit}>'
 
 
+class RekeningSaldo(db.Model):
+    """Totalen per grootboekrekening, bijgewerkt bij elke journaalpost (zie utils.saldi)."""
+    __tablename__ = 'rekening_saldo'
+    grootboekrekening_id = db.Column(db.Integer, db.ForeignKey('grootboekrekening.id'), primary_key=True)
+    totaal_debet = db.Column(db.Float, nullable=False, default=0.0)
+    totaal_credit = db.Column(db.Float, nullable=False, default=0.0)
+    aantal_regels = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<RekeningSaldo {self.grootboekrekening_id} D:{self.totaal_debet} C:{self.totaal_credit}>'
+
+
+class BtwTotaal(db.Model):
+    """BTW-grondslag en -bedrag per maand, soort en tarief (zie utils.btwtotalen)."""
+    __tablename__ = 'btw_totaal'
+    jaar = db.Column(db.Integer, primary_key=True)
+    maand = db.Column(db.Integer, primary_key=True)
+    soort = db.Column(db.String(10), primary_key=True)  # verkoop, inkoop
+    btw_percentage = db.Column(db.Float, primary_key=True)
+    netto = db.Column(db.Float, nullable=False, default=0.0)
+    btw = db.Column(db.Float, nullable=False, default=0.0)
+    aantal_regels = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<BtwTotaal {self.jaar}-{self.maand:02d} {self.soort} {self.btw_percentage}%>'
+
+
+class CacheVersie(db.Model):
+    """Versieteller per bewaakte tabel, opgehoogd bij elke wijziging daarin (zie utils.rapportcache)."""
+    __tablename__ = 'cache_versie'
+    naam = db.Column(db.String(50), primary_key=True)
+    versie = db.Column(db.Integer, nullable=False, default=0)
+
+
+class CacheItem(db.Model):
+    """Gedeelde cache van berekende rapportgegevens (JSON) voor alle workers."""
+    __tablename__ = 'cache_item'
+    sleutel = db.Column(db.String(64), primary_key=True)
+    versie = db.Column(db.Integer, nullable=False)
+    waarde = db.Column(db.Text, nullable=False)
+    bijgewerkt_op = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ExportWatermerk(db.Model):
+    """Hoogste id per bron dat al in de analyse-export staat (zie utils.analyse)."""
+    __tablename__ = 'export_watermerk'
+    bron = db.Column(db.String(50), primary_key=True)
+    laatste_id = db.Column(db.Integer, nullable=False, default=0)
+    aantal_rijen = db.Column(db.Integer, nullable=False, default=0)
+    bijgewerkt_op = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Nummerreeks(db.Model):
+    """Laatst uitgegeven volgnummer per prefix en jaar (zie utils.nummering)."""
+    __tablename__ = 'nummerreeks'
+    prefix = db.Column(db.String(10), primary_key=True)
+    jaar = db.Column(db.Integer, primary_key=True)
+    laatste = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<Nummerreeks {self.prefix}{self.jaar} {self.laatste}>'
+
+
+class Taak(db.Model):
+    """Achtergrondtaak, uitgevoerd door worker.py (zie utils.taken)."""
+    __tablename__ = 'taak'
+    __table_args__ = (
+        db.Index('ix_taak_status', 'status', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    soort = db.Column(db.String(50), nullable=False)
+    omschrijving = db.Column(db.String(200))
+    parameters = db.Column(db.Text, nullable=False, default='{}')  # JSON
+    status = db.Column(db.String(20), nullable=False, default='wachtend')  # wachtend, bezig, klaar, mislukt
+    klaar = db.Column(db.Integer, nullable=False, default=0)
+    totaal = db.Column(db.Integer)
+    foutmelding = db.Column(db.Text)
+    bestandsnaam = db.Column(db.String(200))
+    mimetype = db.Column(db.String(100))
+    gebruiker_id = db.Column(db.Integer, db.ForeignKey('gebruiker.id'))
+    aangemaakt_op = db.Column(db.DateTime, default=datetime.utcnow)
+    gestart_op = db.Column(db.DateTime)
+    voltooid_op = db.Column(db.DateTime)
+
+    @property
+    def percentage(self):
+        if self.status == 'klaar':
+            return 100
+        if not self.totaal:
+            return 0
+        return min(100, int(self.klaar * 100 / self.totaal))
+
+    def __repr__(self):
+        return f'<Taak {self.id} {self.soort} {self.status}>'
+
+
+class TaakResultaat(db.Model):
+    """Deel van het uitvoerbestand van een taak; apart van taak zodat statusopvragingen licht blijven.
+
+    Het bestand staat in opeenvolgende delen (volgnummer 0, 1, ...), zodat de worker en
+    de download nooit het hele bestand in het geheugen hebben.
+    """
+    __tablename__ = 'taak_resultaat'
+    taak_id = db.Column(db.Integer, db.ForeignKey('taak.id', ondelete='CASCADE'), primary_key=True)
+    volgnummer = db.Column(db.Integer, primary_key=True, default=0)
+    inhoud = db.Column(db.LargeBinary, nullable=False)
+
+
+class Periode(db.Model):
+    """Boekingsmaand. Bij afsluiten wordt de eindstand per rekening vastgelegd in periode_saldo."""
+    __tablename__ = 'periode'
+    __table_args__ = (db.UniqueConstraint('jaar', 'maand', name='uq_periode_jaar_maand'),)
+    id = db.Column(db.Integer, primary_key=True)
+    jaar = db.Column(db.Integer, nullable=False)
+    maand = db.Column(db.Integer, nullable=False)
+    einddatum = db.Column(db.Date, nullable=False)
+    afgesloten = db.Column(db.Boolean, default=False)
+    afgesloten_op = db.Column(db.DateTime)
+    snapshot_geldig = db.Column(db.Boolean, default=False)
+    saldi = db.relationship('PeriodeSaldo', backref='periode', lazy=True, cascade='all, delete-orphan')
+
+    def __repr__(self):
+        return f'<Periode {self.jaar}-{self.maand:02d}>'
+
+
+class PeriodeSaldo(db.Model):
+    """Cumulatieve stand van een grootboekrekening aan het einde van een afgesloten periode."""
+    __tablename__ = 'periode_saldo'
+    periode_id = db.Column(db.Integer, db.ForeignKey('periode.id'), primary_key=True)
+    grootboekrekening_id = db.Column(db.Integer, db.ForeignKey('grootboekrekening.id'), primary_key=True)
+    totaal_debet = db.Column(db.Float, nullable=False, default=0.0)
+    totaal_credit = db.Column(db.Float, nullable=False, default=0.0)
+
+    def __repr__(self):
+        return f'<PeriodeSaldo {self.periode_id} {self.grootboekrekening_id}>'
+
+
 def init_standaard_data():
     """Initialiseer standaard grootboekrekeningen en valuta's."""
     if Grootboekrekening.query.first() is None:
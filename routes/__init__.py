@@ -6,6 +6,7 @@ from .inkoopfacturen import inkoopfacturen_bp
 from .betalingen import betalingen_bp
 from .grootboek import grootboek_bp
 from .rapportages import rapportages_bp
+from .taken import taken_bp
 
 all_blueprints = [
     dashboard_bp,
@@ -16,4 +17,5 @@ all_blueprints = [
     betalingen_bp,
     grootboek_bp,
     rapportages_bp,
+    taken_bp,
 ]
@@ -1,11 +1,18 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required
-from models import (db, Betaling, Verkoopfactuur, Inkoopfactuur,
-                     Journaalpost, JournaalpostRegel, Grootboekrekening)
+from models import db, Betaling, Banktransactie, Verkoopfactuur, Inkoopfactuur
+from utils.bankimport import importeer_afschrift, koppel_handmatig
+from utils.boekingen import boek
+from utils.datums import datum_uit_request
+from utils.openstaand import verwerk_betalingen
+from sqlalchemy import or_, and_
+from sqlalchemy.orm import selectinload
 from datetime import date
 
 betalingen_bp = Blueprint('betalingen', __name__, url_prefix='/betalingen')
 
+BETALINGEN_PER_PAGINA = 100
+
 
 @betalingen_bp.before_request
 @login_required
@@ -13,82 +20,38 @@ def vereist_login():
     pass
 
 
-def maak_journaalpost_betaling(betaling):
-    """Maak journaalpost voor een betaling."""
-    jp = Journaalpost(
-        datum=betaling.datum,
-        omschrijving=f'Betaling {betaling.referentie or betaling.id}',
-        referentie=betaling.referentie
-    )
-    db.session.add(jp)
-    db.session.flush()
-
-    bank_rek = Grootboekrekening.query.filter_by(code='1100').first()
-
-    if betaling.type == 'inkomend':
-        # Debet: Bank, Credit: Debiteuren
-        deb_rek = Grootboekrekening.query.filter_by(code='1200').first()
-        if bank_rek:
-            db.session.add(JournaalpostRegel(
-                journaalpost_id=jp.id,
-                grootboekrekening_id=bank_rek.id,
-                debet=betaling.bedrag,
-                credit=0
-            ))
-        if deb_rek:
-            db.session.add(JournaalpostRegel(
-                journaalpost_id=jp.id,
-                grootboekrekening_id=deb_rek.id,
-                debet=0,
-                credit=betaling.bedrag
-            ))
-    else:
-        # Debet: Crediteuren, Credit: Bank
-        cred_rek = Grootboekrekening.query.filter_by(code='2000').first()
-        if cred_rek:
-            db.session.add(JournaalpostRegel(
-                journaalpost_id=jp.id,
-                grootboekrekening_id=cred_rek.id,
-                debet=betaling.bedrag,
-                credit=0
-            ))
-        if bank_rek:
-            db.session.add(JournaalpostRegel(
-                journaalpost_id=jp.id,
-                grootboekrekening_id=bank_rek.id,
-                debet=0,
-                credit=betaling.bedrag
-            ))
-
-
-def update_factuur_status(betaling):
-    """Update factuurstatus na betaling."""
-    if betaling.factuur_type == 'verkoop':
-        factuur = Verkoopfactuur.query.get(betaling.factuur_id)
-        if factuur and factuur.openstaand_bedrag <= 0.01:
-            factuur.status = 'betaald'
-    elif betaling.factuur_type == 'inkoop':
-        factuur = Inkoopfactuur.query.get(betaling.factuur_id)
-        if factuur and factuur.openstaand_bedrag <= 0.01:
-            factuur.status = 'betaald'
-
-
 @betalingen_bp.route('/')
 def lijst():
     type_filter = request.args.get('type', '')
-    query = Betaling.query
+    van_datum = datum_uit_request('van_datum')
+    tot_datum = datum_uit_request('tot_datum')
+    voor_datum = datum_uit_request('voor_datum')
+    voor_id = request.args.get('voor_id', type=int)
+
+    # Facturen en relaties per pagina in enkele IN-queries in plaats van één query per betaling
+    query = Betaling.query.options(
+        selectinload(Betaling.verkoopfactuur).selectinload(Verkoopfactuur.klant),
+        selectinload(Betaling.inkoopfactuur).selectinload(Inkoopfactuur.leverancier),
+    )
     if type_filter:
-        query = query.filter_by(type=type_filter)
-    betalingen = query.order_by(Betaling.datum.desc()).all()
-
-    # Enrich with factuur info
-    for b in betalingen:
-        if b.factuur_type == 'verkoop':
-            b.factuur_obj = Verkoopfactuur.query.get(b.factuur_id)
-        else:
-            b.factuur_obj = Inkoopfactuur.query.get(b.factuur_id)
-
-    return render_template('betalingen/lijst.html', betalingen=betalingen, type_filter=type_filter)
+        query = query.filter(Betaling.type == type_filter)
+    if van_datum:
+        query = query.filter(Betaling.datum >= van_datum)
+    if tot_datum:
+        query = query.filter(Betaling.datum <= tot_datum)
+    if voor_datum and voor_id is not None:
+        query = query.filter(or_(Betaling.datum < voor_datum,
+                                 and_(Betaling.datum == voor_datum, Betaling.id < voor_id)))
+    betalingen = query.order_by(Betaling.datum.desc(), Betaling.id.desc()).limit(BETALINGEN_PER_PAGINA + 1).all()
+
+    filters = {'type': type_filter or None, 'van_datum': van_datum, 'tot_datum': tot_datum}
+    volgende = None
+    if len(betalingen) > BETALINGEN_PER_PAGINA:
+        betalingen = betalingen[:BETALINGEN_PER_PAGINA]
+        volgende = dict(filters, voor_datum=betalingen[-1].datum.isoformat(), voor_id=betalingen[-1].id)
+
+    return render_template('betalingen/lijst.html', betalingen=betalingen, type_filter=type_filter,
+                           filters=filters, is_vervolg=voor_datum is not None, volgende=volgende)
 
 
 @betalingen_bp.route('/nieuw', methods=['GET', 'POST'])
@@ -115,8 +78,13 @@ def nieuw():
         db.session.add(betaling)
         db.session.flush()
 
-        maak_journaalpost_betaling(betaling)
-        update_factuur_status(betaling)
+        try:
+            boek(f'betaling_{betaling.type}', betaling)
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+            return redirect(url_for('betalingen.nieuw'))
+        verwerk_betalingen(betaling.factuur_type, {betaling.factuur_id: betaling.bedrag})
         db.session.commit()
 
         flash(f'Betaling van \u20ac {bedrag:,.2f} is geregistreerd.', 'success')
@@ -140,3 +108,51 @@ def nieuw():
                            vandaag=date.today(),
                            pre_type=pre_type,
                            pre_id=pre_id)
+
+
+@betalingen_bp.route('/bank', methods=['GET', 'POST'])
+def bank():
+    resultaat = None
+    if request.method == 'POST':
+        bestand = request.files.get('bestand')
+        if not bestand or not bestand.filename:
+            flash('Kies een CAMT.053- (.xml) of MT940-bestand.', 'danger')
+            return redirect(url_for('betalingen.bank'))
+        try:
+            resultaat = importeer_afschrift(bestand.filename, bestand.stream)
+        except (ValueError, SyntaxError) as e:
+            db.session.rollback()
+            flash(f'Afschrift kan niet worden gelezen: {e}', 'danger')
+            return redirect(url_for('betalingen.bank'))
+        flash(f"{resultaat['transacties']} transacties ingelezen, {resultaat['gekoppeld']} automatisch gekoppeld.",
+              'success')
+
+    te_beoordelen = Banktransactie.query.filter_by(status='te_beoordelen')
+    aantal = te_beoordelen.count()
+    transacties = te_beoordelen.order_by(Banktransactie.datum, Banktransactie.id).limit(200).all()
+    return render_template('betalingen/bank.html', resultaat=resultaat, transacties=transacties, aantal=aantal)
+
+
+@betalingen_bp.route('/bank/<int:id>/koppel', methods=['POST'])
+def bank_koppel(id):
+    transactie = Banktransactie.query.get_or_404(id)
+    if transactie.status != 'te_beoordelen':
+        flash('Deze transactie is al verwerkt.', 'warning')
+        return redirect(url_for('betalingen.bank'))
+    try:
+        koppel_handmatig(transactie, request.form.get('factuurnummer', ''))
+    except ValueError as e:
+        db.session.rollback()
+        flash(str(e), 'danger')
+        return redirect(url_for('betalingen.bank'))
+    flash(f'Transactie van \u20ac {transactie.bedrag:,.2f} is gekoppeld.', 'success')
+    return redirect(url_for('betalingen.bank'))
+
+
+@betalingen_bp.route('/bank/<int:id>/negeer', methods=['POST'])
+def bank_negeer(id):
+    transactie = Banktransactie.query.get_or_404(id)
+    if transactie.status == 'te_beoordelen':
+        transactie.status = 'genegeerd'
+        db.session.commit()
+    return redirect(url_for('betalingen.bank'))
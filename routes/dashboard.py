@@ -1,33 +1,44 @@
-from flask import Blueprint, render_template, jsonify
+from flask import Blueprint, render_template, request
 from flask_login import login_required
 from models import db, Verkoopfactuur, Inkoopfactuur, Betaling, Klant, Leverancier
 from datetime import date, timedelta
-from sqlalchemy import func, extract
+from sqlalchemy import func, extract, literal, select, union_all
+from utils import rapportcache
+from utils.reeksen import reeks, reeks_parameters, datumbereik
+from utils.prognose import MAX_DAGEN, liquiditeitsprognose
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
 
-@dashboard_bp.route('/')
-@login_required
-def index():
-    vandaag = date.today()
+def _vervallen(model, relatie, statussen, vandaag, aantal=5):
+    """Aantal vervallen facturen en de oudste paar als dicts (met relatienaam uit één join)."""
+    filters = (model.status.in_(statussen), model.vervaldatum < vandaag)
+    totaal = db.session.query(func.count(model.id)).filter(*filters).scalar()
+    rijen = db.session.query(
+        model.id, model.factuurnummer, relatie.naam, model.vervaldatum, model.openstaand
+    ).join(relatie).filter(*filters).order_by(model.vervaldatum, model.id).limit(aantal).all()
+    return totaal, [{'id': r[0], 'factuurnummer': r[1], 'relatie': r[2], 'vervaldatum': r[3], 'openstaand': r[4]}
+                    for r in rijen]
+
+
+def dashboard_cijfers(vandaag):
     begin_jaar = date(vandaag.year, 1, 1)
 
     # Openstaande debiteuren
-    openstaande_verkoop = Verkoopfactuur.query.filter(
+    totaal_debiteuren = db.session.query(func.sum(Verkoopfactuur.openstaand)).filter(
         Verkoopfactuur.status.in_(['verzonden', 'vervallen'])
-    ).all()
-    totaal_debiteuren = sum(f.openstaand_bedrag for f in openstaande_verkoop)
+    ).scalar() or 0
 
     # Openstaande crediteuren
-    openstaande_inkoop = Inkoopfactuur.query.filter(
+    totaal_crediteuren = db.session.query(func.sum(Inkoopfactuur.openstaand)).filter(
         Inkoopfactuur.status.in_(['ontvangen', 'goedgekeurd', 'vervallen'])
-    ).all()
-    totaal_crediteuren = sum(f.openstaand_bedrag for f in openstaande_inkoop)
+    ).scalar() or 0
 
     # Vervallen facturen
-    vervallen_verkoop = [f for f in openstaande_verkoop if f.is_vervallen]
-    vervallen_inkoop = [f for f in openstaande_inkoop if f.is_vervallen]
+    aantal_vervallen_verkoop, vervallen_verkoop = _vervallen(
+        Verkoopfactuur, Klant, ['verzonden', 'vervallen'], vandaag)
+    aantal_vervallen_inkoop, vervallen_inkoop = _vervallen(
+        Inkoopfactuur, Leverancier, ['ontvangen', 'goedgekeurd', 'vervallen'], vandaag)
 
     # Omzet dit jaar
     omzet_jaar = db.session.query(func.sum(Verkoopfactuur.totaal)).filter(
@@ -40,71 +51,93 @@ def index():
         Inkoopfactuur.factuurdatum >= begin_jaar
     ).scalar() or 0
 
-    # Inkomende betalingen dit jaar
-    inkomend_jaar = db.session.query(func.sum(Betaling.bedrag)).filter(
-        Betaling.type == 'inkomend',
+    # Inkomende en uitgaande betalingen dit jaar
+    betalingen = dict(db.session.query(Betaling.type, func.sum(Betaling.bedrag)).filter(
         Betaling.datum >= begin_jaar
-    ).scalar() or 0
+    ).group_by(Betaling.type).all())
+    inkomend_jaar = betalingen.get('inkomend') or 0
+    uitgaand_jaar = betalingen.get('uitgaand') or 0
+
+    return {
+        'totaal_debiteuren': totaal_debiteuren,
+        'totaal_crediteuren': totaal_crediteuren,
+        'vervallen_verkoop': vervallen_verkoop,
+        'aantal_vervallen_verkoop': aantal_vervallen_verkoop,
+        'vervallen_inkoop': vervallen_inkoop,
+        'aantal_vervallen_inkoop': aantal_vervallen_inkoop,
+        'omzet_jaar': omzet_jaar,
+        'kosten_jaar': kosten_jaar,
+        'winst_jaar': omzet_jaar - kosten_jaar,
+        'inkomend_jaar': inkomend_jaar,
+        'uitgaand_jaar': uitgaand_jaar,
+        'cashflow_jaar': inkomend_jaar - uitgaand_jaar,
+        'aantal_klanten': Klant.query.count(),
+        'aantal_leveranciers': Leverancier.query.count(),
+    }
 
-    # Uitgaande betalingen dit jaar
-    uitgaand_jaar = db.session.query(func.sum(Betaling.bedrag)).filter(
-        Betaling.type == 'uitgaand',
-        Betaling.datum >= begin_jaar
-    ).scalar() or 0
 
-    # Aantal klanten en leveranciers
-    aantal_klanten = Klant.query.count()
-    aantal_leveranciers = Leverancier.query.count()
-
-    return render_template('dashboard.html',
-                           totaal_debiteuren=totaal_debiteuren,
-                           totaal_crediteuren=totaal_crediteuren,
-                           vervallen_verkoop=vervallen_verkoop,
-                           vervallen_inkoop=vervallen_inkoop,
-                           omzet_jaar=omzet_jaar,
-                           kosten_jaar=kosten_jaar,
-                           winst_jaar=omzet_jaar - kosten_jaar,
-                           inkomend_jaar=inkomend_jaar,
-                           uitgaand_jaar=uitgaand_jaar,
-                           cashflow_jaar=inkomend_jaar - uitgaand_jaar,
-                           aantal_klanten=aantal_klanten,
-                           aantal_leveranciers=aantal_leveranciers)
+@dashboard_bp.route('/')
+@login_required
+def index():
+    vandaag = date.today()
+    cijfers = rapportcache.haal_op('dashboard', [vandaag], lambda: dashboard_cijfers(vandaag))
+    return render_template('dashboard.html', **cijfers)
 
 
 @dashboard_bp.route('/api/omzet-per-maand')
 @login_required
 def omzet_per_maand():
-    jaar = date.today().year
-    data = []
-    for maand in range(1, 13):
-        omzet = db.session.query(func.sum(Verkoopfactuur.totaal)).filter(
-            extract('year', Verkoopfactuur.factuurdatum) == jaar,
-            extract('month', Verkoopfactuur.factuurdatum) == maand,
-            Verkoopfactuur.status != 'concept'
-        ).scalar() or 0
-        kosten = db.session.query(func.sum(Inkoopfactuur.totaal)).filter(
-            extract('year', Inkoopfactuur.factuurdatum) == jaar,
-            extract('month', Inkoopfactuur.factuurdatum) == maand
-        ).scalar() or 0
-        data.append({'maand': maand, 'omzet': round(omzet, 2), 'kosten': round(kosten, 2)})
-    return jsonify(data)
+    van, tot, granulariteit = reeks_parameters()
+    return rapportcache.json_met_etag('omzet_reeks', [van, tot, granulariteit],
+                                      lambda: omzet_reeks(van, tot, granulariteit))
+
+
+def omzet_reeks(van, tot, granulariteit):
+    begin, eind = datumbereik(van, tot)
+
+    # Verkoop en inkoop in één gegroepeerde query
+    bronnen = union_all(
+        select(Verkoopfactuur.factuurdatum.label('datum'), literal('omzet').label('veld'),
+               Verkoopfactuur.totaal.label('bedrag'))
+        .where(Verkoopfactuur.factuurdatum >= begin, Verkoopfactuur.factuurdatum < eind,
+               Verkoopfactuur.status != 'concept'),
+        select(Inkoopfactuur.factuurdatum, literal('kosten'), Inkoopfactuur.totaal)
+        .where(Inkoopfactuur.factuurdatum >= begin, Inkoopfactuur.factuurdatum < eind),
+    ).subquery()
+    jaar = extract('year', bronnen.c.datum)
+    maand = extract('month', bronnen.c.datum)
+    rijen = db.session.execute(
+        select(jaar, maand, bronnen.c.veld, func.sum(bronnen.c.bedrag)).group_by(jaar, maand, bronnen.c.veld)
+    )
+    return reeks(rijen, van, tot, granulariteit, ('omzet', 'kosten'))
 
 
 @dashboard_bp.route('/api/cashflow-per-maand')
 @login_required
 def cashflow_per_maand():
-    jaar = date.today().year
-    data = []
-    for maand in range(1, 13):
-        inkomend = db.session.query(func.sum(Betaling.bedrag)).filter(
-            Betaling.type == 'inkomend',
-            extract('year', Betaling.datum) == jaar,
-            extract('month', Betaling.datum) == maand
-        ).scalar() or 0
-        uitgaand = db.session.query(func.sum(Betaling.bedrag)).filter(
-            Betaling.type == 'uitgaand',
-            extract('year', Betaling.datum) == jaar,
-            extract('month', Betaling.datum) == maand
-        ).scalar() or 0
-        data.append({'maand': maand, 'inkomend': round(inkomend, 2), 'uitgaand': round(uitgaand, 2)})
-    return jsonify(data)
+    van, tot, granulariteit = reeks_parameters()
+    return rapportcache.json_met_etag('cashflow_reeks', [van, tot, granulariteit],
+                                      lambda: cashflow_reeks(van, tot, granulariteit))
+
+
+def cashflow_reeks(van, tot, granulariteit):
+    begin, eind = datumbereik(van, tot)
+
+    jaar = extract('year', Betaling.datum)
+    maand = extract('month', Betaling.datum)
+    rijen = db.session.execute(
+        select(jaar, maand, Betaling.type, func.sum(Betaling.bedrag))
+        .where(Betaling.datum >= begin, Betaling.datum < eind)
+        .group_by(jaar, maand, Betaling.type)
+    )
+    return reeks(rijen, van, tot, granulariteit, ('inkomend', 'uitgaand'))
+
+
+@dashboard_bp.route('/api/liquiditeitsprognose')
+@login_required
+def prognose():
+    vandaag = date.today()
+    dagen = max(1, min(request.args.get('dagen', 90, type=int), MAX_DAGEN))
+    met_betaalgedrag = request.args.get('betaalgedrag') == '1'
+    return rapportcache.json_met_etag('liquiditeitsprognose', [vandaag, dagen, met_betaalgedrag],
+                                      lambda: liquiditeitsprognose(dagen, met_betaalgedrag, vandaag))
@@ -1,10 +1,19 @@
-from flask import Blueprint, render_template, request
+from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required
-from models import db, Grootboekrekening, Journaalpost, JournaalpostRegel
-from sqlalchemy import func
+from models import db, Grootboekrekening, Journaalpost, JournaalpostRegel, Periode
+from utils.saldi import saldi_per_rekening, saldo_rekening
+from utils.datums import datum_uit_request
+from utils import rapportcache
+from utils.periodes import sluit_periode, herbereken_periodes
+from sqlalchemy import func, or_, and_
+from sqlalchemy.orm import selectinload
+from datetime import date, timedelta
 
 grootboek_bp = Blueprint('grootboek', __name__, url_prefix='/grootboek')
 
+REGELS_PER_PAGINA = 100
+POSTEN_PER_PAGINA = 50
+
 
 @grootboek_bp.before_request
 @login_required
@@ -15,71 +24,151 @@ def vereist_login():
 @grootboek_bp.route('/')
 def rekeningen():
     type_filter = request.args.get('type', '')
-    query = Grootboekrekening.query
-    if type_filter:
-        query = query.filter_by(type=type_filter)
-    rekeningen = query.order_by(Grootboekrekening.code).all()
-
-    # Bereken saldi
-    for rek in rekeningen:
-        debet = db.session.query(func.sum(JournaalpostRegel.debet)).filter_by(
-            grootboekrekening_id=rek.id
-        ).scalar() or 0
-        credit = db.session.query(func.sum(JournaalpostRegel.credit)).filter_by(
-            grootboekrekening_id=rek.id
-        ).scalar() or 0
-        rek.totaal_debet = round(debet, 2)
-        rek.totaal_credit = round(credit, 2)
-        rek.saldo = round(debet - credit, 2)
-
+    rekeningen = rapportcache.haal_op('saldi', [type_filter or None, None, None],
+                                      lambda: saldi_per_rekening(type_filter or None))
     return render_template('grootboek/rekeningen.html', rekeningen=rekeningen, type_filter=type_filter)
 
 
 @grootboek_bp.route('/rekening/<int:id>')
 def rekening_detail(id):
     rekening = Grootboekrekening.query.get_or_404(id)
-    regels = JournaalpostRegel.query.filter_by(
-        grootboekrekening_id=id
-    ).order_by(JournaalpostRegel.id).all()
-
-    # Bereken lopend saldo
-    saldo = 0
-    for regel in regels:
-        saldo += regel.debet - regel.credit
-        regel.lopend_saldo = round(saldo, 2)
-
-    return render_template('grootboek/rekening_detail.html', rekening=rekening, regels=regels)
+    van_datum = datum_uit_request('van_datum')
+    tot_datum = datum_uit_request('tot_datum')
+    na_datum = datum_uit_request('na_datum')
+    na_id = request.args.get('na_id', type=int)
+
+    # Beginsaldo: saldo tot van_datum, bij vervolgpagina's plus de regels tot en met de cursor
+    begin_saldo = saldo_rekening(id, van_datum - timedelta(days=1)) if van_datum else 0
+    if na_datum and na_id is not None:
+        eerder = db.session.query(func.sum(JournaalpostRegel.debet - JournaalpostRegel.credit)).join(
+            Journaalpost, Journaalpost.id == JournaalpostRegel.journaalpost_id
+        ).filter(
+            JournaalpostRegel.grootboekrekening_id == id,
+            or_(Journaalpost.datum < na_datum,
+                and_(Journaalpost.datum == na_datum, JournaalpostRegel.id <= na_id)),
+        )
+        if van_datum:
+            eerder = eerder.filter(Journaalpost.datum >= van_datum)
+        begin_saldo = round(begin_saldo + (eerder.scalar() or 0), 2)
+
+    # Lopend saldo in de database, vanaf het begin van deze pagina
+    lopend = func.sum(JournaalpostRegel.debet - JournaalpostRegel.credit).over(
+        order_by=(Journaalpost.datum, JournaalpostRegel.id)
+    )
+    query = db.session.query(
+        JournaalpostRegel.id, Journaalpost.datum, Journaalpost.omschrijving, Journaalpost.referentie,
+        JournaalpostRegel.debet, JournaalpostRegel.credit, lopend.label('mutatie'),
+    ).join(Journaalpost, Journaalpost.id == JournaalpostRegel.journaalpost_id).filter(
+        JournaalpostRegel.grootboekrekening_id == id
+    )
+    if van_datum:
+        query = query.filter(Journaalpost.datum >= van_datum)
+    if tot_datum:
+        query = query.filter(Journaalpost.datum <= tot_datum)
+    if na_datum and na_id is not None:
+        query = query.filter(or_(Journaalpost.datum > na_datum,
+                                 and_(Journaalpost.datum == na_datum, JournaalpostRegel.id > na_id)))
+    rijen = query.order_by(Journaalpost.datum, JournaalpostRegel.id).limit(REGELS_PER_PAGINA + 1).all()
+
+    heeft_volgende = len(rijen) > REGELS_PER_PAGINA
+    regels = [{
+        'id': r.id, 'datum': r.datum, 'omschrijving': r.omschrijving, 'referentie': r.referentie,
+        'debet': r.debet, 'credit': r.credit, 'lopend_saldo': round(begin_saldo + r.mutatie, 2),
+    } for r in rijen[:REGELS_PER_PAGINA]]
+
+    volgende = None
+    if heeft_volgende:
+        laatste = regels[-1]
+        volgende = {'na_datum': laatste['datum'].isoformat(), 'na_id': laatste['id']}
+
+    return render_template('grootboek/rekening_detail.html', rekening=rekening, regels=regels,
+                           begin_saldo=begin_saldo, huidig_saldo=saldo_rekening(id),
+                           van_datum=van_datum, tot_datum=tot_datum,
+                           is_vervolg=na_datum is not None, volgende=volgende)
 
 
 @grootboek_bp.route('/journaal')
 def journaal():
-    posten = Journaalpost.query.order_by(Journaalpost.datum.desc(), Journaalpost.id.desc()).all()
-    return render_template('grootboek/journaal.html', posten=posten)
+    van_datum = datum_uit_request('van_datum')
+    tot_datum = datum_uit_request('tot_datum')
+    referentie = request.args.get('referentie', '').strip()
+    rekening_id = request.args.get('rekening_id', type=int)
+    voor_datum = datum_uit_request('voor_datum')
+    voor_id = request.args.get('voor_id', type=int)
+
+    query = Journaalpost.query.options(
+        selectinload(Journaalpost.regels).selectinload(JournaalpostRegel.grootboekrekening)
+    )
+    if van_datum:
+        query = query.filter(Journaalpost.datum >= van_datum)
+    if tot_datum:
+        query = query.filter(Journaalpost.datum <= tot_datum)
+    if referentie:
+        patroon = referentie.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.filter(Journaalpost.referentie.ilike(f'%{patroon}%', escape='\\'))
+    if rekening_id:
+        query = query.filter(Journaalpost.regels.any(JournaalpostRegel.grootboekrekening_id == rekening_id))
+    if voor_datum and voor_id is not None:
+        query = query.filter(or_(Journaalpost.datum < voor_datum,
+                                 and_(Journaalpost.datum == voor_datum, Journaalpost.id < voor_id)))
+    posten = query.order_by(Journaalpost.datum.desc(), Journaalpost.id.desc()).limit(POSTEN_PER_PAGINA + 1).all()
+
+    filters = {'van_datum': van_datum, 'tot_datum': tot_datum,
+               'referentie': referentie or None, 'rekening_id': rekening_id}
+    volgende = None
+    if len(posten) > POSTEN_PER_PAGINA:
+        posten = posten[:POSTEN_PER_PAGINA]
+        volgende = dict(filters, voor_datum=posten[-1].datum.isoformat(), voor_id=posten[-1].id)
+
+    rekeningen = Grootboekrekening.query.order_by(Grootboekrekening.code).all()
+    return render_template('grootboek/journaal.html', posten=posten, filters=filters,
+                           rekeningen=rekeningen, is_vervolg=voor_datum is not None, volgende=volgende)
 
 
 @grootboek_bp.route('/proefbalans')
 def proefbalans():
-    rekeningen = Grootboekrekening.query.order_by(Grootboekrekening.code).all()
-    totaal_debet = 0
-    totaal_credit = 0
-
-    for rek in rekeningen:
-        debet = db.session.query(func.sum(JournaalpostRegel.debet)).filter_by(
-            grootboekrekening_id=rek.id
-        ).scalar() or 0
-        credit = db.session.query(func.sum(JournaalpostRegel.credit)).filter_by(
-            grootboekrekening_id=rek.id
-        ).scalar() or 0
-        rek.totaal_debet = round(debet, 2)
-        rek.totaal_credit = round(credit, 2)
-        rek.saldo = round(debet - credit, 2)
-        totaal_debet += debet
-        totaal_credit += credit
+    van_datum = datum_uit_request('van_datum')
+    tot_datum = datum_uit_request('tot_datum')
+    rekeningen = rapportcache.haal_op('saldi', [None, van_datum, tot_datum],
+                                      lambda: saldi_per_rekening(van_datum=van_datum, tot_datum=tot_datum))
+    totaal_debet = sum(r['totaal_debet'] for r in rekeningen)
+    totaal_credit = sum(r['totaal_credit'] for r in rekeningen)
 
     # Filter out zero-balance accounts
-    rekeningen = [r for r in rekeningen if r.totaal_debet != 0 or r.totaal_credit != 0]
+    rekeningen = [r for r in rekeningen if r['totaal_debet'] != 0 or r['totaal_credit'] != 0]
 
     return render_template('grootboek/proefbalans.html',
                            rekeningen=rekeningen,
                            totaal_debet=round(totaal_debet, 2),
-                           totaal_credit=round(totaal_credit, 2))
+                           totaal_credit=round(totaal_credit, 2),
+                           van_datum=van_datum, tot_datum=tot_datum)
+
+
+@grootboek_bp.route('/periodes')
+def periodes():
+    periodes = Periode.query.order_by(Periode.einddatum.desc()).all()
+    vandaag = date.today()
+    return render_template('grootboek/periodes.html', periodes=periodes, vandaag=vandaag,
+                           aantal_ongeldig=sum(1 for p in periodes if p.afgesloten and not p.snapshot_geldig))
+
+
+@grootboek_bp.route('/periodes/afsluiten', methods=['POST'])
+def periode_afsluiten():
+    jaar = request.form.get('jaar', type=int)
+    maand = request.form.get('maand', type=int)
+    if jaar is None or not 1900 <= jaar <= 9998:
+        flash('Ongeldig jaar.', 'danger')
+        return redirect(url_for('grootboek.periodes'))
+    if maand is None or not 1 <= maand <= 12:
+        flash('Ongeldige maand.', 'danger')
+        return redirect(url_for('grootboek.periodes'))
+    sluit_periode(jaar, maand)
+    flash(f'Periode {jaar}-{maand:02d} is afgesloten.', 'success')
+    return redirect(url_for('grootboek.periodes'))
+
+
+@grootboek_bp.route('/periodes/herbereken', methods=['POST'])
+def periodes_herbereken():
+    aantal = herbereken_periodes()
+    flash(f'{aantal} periode(s) herberekend.', 'success')
+    return redirect(url_for('grootboek.periodes'))
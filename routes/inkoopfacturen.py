@@ -1,10 +1,14 @@
 import os
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_from_directory, current_app
+from flask import (Blueprint, render_template, request, redirect, url_for, flash, send_from_directory, current_app,
+                   Response, stream_with_context, abort)
 from flask_login import login_required
 from werkzeug.utils import secure_filename
-from models import (db, Inkoopfactuur, InkoopfactuurRegel, Leverancier, Valuta,
-                     Grootboekrekening, Journaalpost, JournaalpostRegel)
+from models import db, Inkoopfactuur, InkoopfactuurRegel, Leverancier, Valuta, Grootboekrekening
 from utils.btw import bereken_btw
+from utils.boekingen import boek
+from utils.btwtotalen import boek_btw
+from utils.datums import datum_uit_request
+from utils.sepa import betaalrun_voorbeeld, betaalrun_andere_valuta, voer_betaalrun_uit, betaalruns, pain001_stroom
 from datetime import date, timedelta
 
 TOEGESTANE_EXTENSIES = {'pdf', 'png', 'jpg', 'jpeg'}
@@ -22,48 +26,6 @@ def vereist_login():
     pass
 
 
-def maak_journaalpost_inkoop(factuur):
-    """Maak journaalpost voor een inkoopfactuur."""
-    jp = Journaalpost(
-        datum=factuur.factuurdatum,
-        omschrijving=f'Inkoopfactuur {factuur.factuurnummer}',
-        referentie=factuur.factuurnummer
-    )
-    db.session.add(jp)
-    db.session.flush()
-
-    # Debet: Inkoopkosten (4000) voor subtotaal
-    kosten_rek = Grootboekrekening.query.filter_by(code='4000').first()
-    if kosten_rek:
-        db.session.add(JournaalpostRegel(
-            journaalpost_id=jp.id,
-            grootboekrekening_id=kosten_rek.id,
-            debet=factuur.subtotaal,
-            credit=0
-        ))
-
-    # Debet: BTW te vorderen (2200)
-    if factuur.btw_bedrag > 0:
-        btw_rek = Grootboekrekening.query.filter_by(code='2200').first()
-        if btw_rek:
-            db.session.add(JournaalpostRegel(
-                journaalpost_id=jp.id,
-                grootboekrekening_id=btw_rek.id,
-                debet=factuur.btw_bedrag,
-                credit=0
-            ))
-
-    # Credit: Crediteuren (2000)
-    cred_rek = Grootboekrekening.query.filter_by(code='2000').first()
-    if cred_rek:
-        db.session.add(JournaalpostRegel(
-            journaalpost_id=jp.id,
-            grootboekrekening_id=cred_rek.id,
-            debet=0,
-            credit=factuur.totaal
-        ))
-
-
 @inkoopfacturen_bp.route('/')
 def lijst():
     status = request.args.get('status', '')
@@ -72,12 +34,6 @@ def lijst():
         query = query.filter_by(status=status)
     facturen = query.order_by(Inkoopfactuur.factuurdatum.desc()).all()
 
-    # Update vervallen status
-    for f in facturen:
-        if f.status in ('ontvangen', 'goedgekeurd') and f.vervaldatum < date.today():
-            f.status = 'vervallen'
-    db.session.commit()
-
     return render_template('inkoopfacturen/lijst.html', facturen=facturen, status=status)
 
 
@@ -135,6 +91,7 @@ def nieuw():
         factuur.subtotaal = round(subtotaal, 2)
         factuur.btw_bedrag = round(btw_totaal, 2)
         factuur.totaal = round(subtotaal + btw_totaal, 2)
+        factuur.werk_openstaand_bij()
 
         # PDF upload
         bestand = request.files.get('pdf_bestand')
@@ -146,7 +103,13 @@ def nieuw():
             factuur.pdf_bestand = bestandsnaam
 
         db.session.add(factuur)
-        maak_journaalpost_inkoop(factuur)
+        try:
+            boek('inkoop', factuur)
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+            return redirect(url_for('inkoopfacturen.nieuw'))
+        boek_btw('inkoop', factuur)
         db.session.commit()
         flash(f'Inkoopfactuur {factuur.factuurnummer} is aangemaakt.', 'success')
         return redirect(url_for('inkoopfacturen.detail', id=factuur.id))
@@ -170,6 +133,7 @@ def detail(id):
 def bewerk(id):
     factuur = Inkoopfactuur.query.get_or_404(id)
     if request.method == 'POST':
+        boek_btw('inkoop', factuur, -1)
         factuur.leverancier_id = request.form['leverancier_id']
         factuur.factuurnummer = request.form['factuurnummer']
         factuur.factuurdatum = date.fromisoformat(request.form['factuurdatum'])
@@ -204,6 +168,8 @@ def bewerk(id):
         factuur.subtotaal = round(subtotaal, 2)
         factuur.btw_bedrag = round(btw_totaal, 2)
         factuur.totaal = round(subtotaal + btw_totaal, 2)
+        factuur.werk_openstaand_bij()
+        boek_btw('inkoop', factuur)
 
         db.session.commit()
         flash(f'Inkoopfactuur {factuur.factuurnummer} is bijgewerkt.', 'success')
@@ -231,6 +197,7 @@ def goedkeuren(id):
 def verwijder(id):
     factuur = Inkoopfactuur.query.get_or_404(id)
     nr = factuur.factuurnummer
+    boek_btw('inkoop', factuur, -1)
     db.session.delete(factuur)
     db.session.commit()
     flash(f'Inkoopfactuur {nr} is verwijderd.', 'success')
@@ -283,3 +250,38 @@ def openstaand():
     ).order_by(Inkoopfactuur.vervaldatum).all()
     totaal = sum(f.openstaand_bedrag for f in facturen)
     return render_template('inkoopfacturen/openstaand.html', facturen=facturen, totaal=totaal)
+
+
+@inkoopfacturen_bp.route('/betaalrun', methods=['GET', 'POST'])
+def betaalrun():
+    tot_datum = datum_uit_request('tot_datum') or date.today() + timedelta(days=7)
+    uitvoerdatum = datum_uit_request('uitvoerdatum') or date.today()
+    if request.method == 'POST':
+        try:
+            msg_id = voer_betaalrun_uit(tot_datum, uitvoerdatum)
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+            return redirect(url_for('inkoopfacturen.betaalrun', tot_datum=tot_datum, uitvoerdatum=uitvoerdatum))
+        if msg_id is None:
+            flash('Er zijn geen goedgekeurde facturen te betalen.', 'warning')
+            return redirect(url_for('inkoopfacturen.betaalrun'))
+        return betaalrun_bestand(msg_id)
+
+    overschrijvingen = betaalrun_voorbeeld(tot_datum)
+    return render_template('inkoopfacturen/betaalrun.html', tot_datum=tot_datum, uitvoerdatum=uitvoerdatum,
+                           overschrijvingen=overschrijvingen, andere_valuta=betaalrun_andere_valuta(tot_datum),
+                           totaal=sum(o['bedrag'] for o in overschrijvingen), runs=betaalruns())
+
+
+@inkoopfacturen_bp.route('/betaalrun/<msg_id>.xml')
+def betaalrun_bestand(msg_id):
+    try:
+        delen = pain001_stroom(msg_id)
+    except ValueError:
+        abort(404)
+    return Response(
+        stream_with_context(delen),
+        mimetype='application/xml',
+        headers={'Content-Disposition': f'attachment; filename={msg_id}.xml'},
+    )
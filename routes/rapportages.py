@@ -1,16 +1,16 @@
-import csv
-import io
-from flask import Blueprint, render_template, request, Response, send_file
+from flask import Blueprint, render_template, request, send_file, jsonify, Response, stream_with_context
 from flask_login import login_required
-from models import (db, Grootboekrekening, JournaalpostRegel, Verkoopfactuur,
-                     VerkoopfactuurRegel, Inkoopfactuur, InkoopfactuurRegel)
-from sqlalchemy import func, extract
+from models import db
+from utils.saldi import saldi_per_type
+from utils.btwtotalen import btw_per_tarief, aangifte_rubrieken
+from utils.datums import datum_uit_request, datum_uit_tekst
+from utils.taken import taaksoort
+from utils.ouderdom import KLASSEN, SOORTEN, ouderdom_query, ouderdomsanalyse
+from utils.csvexport import csv_rapport, csv_regels, stream_csv
+from utils.pdf import html_naar_pdf
+from utils.xaf import xaf_stroom, xaf_bestandsnaam
+from utils import pdfcache, rapportcache
 from datetime import date
-try:
-    from weasyprint import HTML
-    WEASYPRINT_BESCHIKBAAR = True
-except (ImportError, OSError):
-    WEASYPRINT_BESCHIKBAAR = False
 
 rapportages_bp = Blueprint('rapportages', __name__, url_prefix='/rapportages')
 
@@ -21,73 +21,53 @@ def vereist_login():
     pass
 
 
-def get_rekening_saldo(code):
-    rek = Grootboekrekening.query.filter_by(code=code).first()
-    if not rek:
-        return 0
-    debet = db.session.query(func.sum(JournaalpostRegel.debet)).filter_by(
-        grootboekrekening_id=rek.id
-    ).scalar() or 0
-    credit = db.session.query(func.sum(JournaalpostRegel.credit)).filter_by(
-        grootboekrekening_id=rek.id
-    ).scalar() or 0
-    return round(debet - credit, 2)
-
-
-def get_type_saldi(type_):
-    rekeningen = Grootboekrekening.query.filter_by(type=type_).order_by(Grootboekrekening.code).all()
-    result = []
-    totaal = 0
-    for rek in rekeningen:
-        debet = db.session.query(func.sum(JournaalpostRegel.debet)).filter_by(
-            grootboekrekening_id=rek.id
-        ).scalar() or 0
-        credit = db.session.query(func.sum(JournaalpostRegel.credit)).filter_by(
-            grootboekrekening_id=rek.id
-        ).scalar() or 0
-        saldo = round(debet - credit, 2)
-        if saldo != 0:
-            result.append({'code': rek.code, 'naam': rek.naam, 'saldo': saldo})
-            totaal += saldo
-    return result, round(totaal, 2)
+def balans_gegevens(tot_datum=None):
+    """Activa, passiva en resultaat per datum (zonder datum: alle boekingen)."""
+    per_type = saldi_per_type(tot_datum=tot_datum)
+    activa, totaal_activa = per_type['activa']
+    passiva, totaal_passiva = per_type['passiva']
+    # Opbrengsten zijn credit (negatief saldo), kosten zijn debet (positief saldo)
+    winst = (-per_type['opbrengsten'][1]) - per_type['kosten'][1]
+    return {
+        'activa': activa, 'totaal_activa': totaal_activa,
+        'passiva': passiva, 'totaal_passiva': totaal_passiva,
+        'winst': round(winst, 2), 'tot_datum': tot_datum,
+    }
+
+
+def winstverlies_gegevens(van_datum=None, tot_datum=None):
+    """Opbrengsten, kosten en resultaat over een periode (zonder datums: alle boekingen)."""
+    per_type = saldi_per_type(van_datum=van_datum, tot_datum=tot_datum)
+    opbrengsten, totaal_opbrengsten = per_type['opbrengsten']
+    kosten, totaal_kosten = per_type['kosten']
+    # Opbrengsten hebben negatief saldo (credit), neem absoluut
+    netto_opbrengsten = -totaal_opbrengsten
+    return {
+        'opbrengsten': opbrengsten, 'totaal_opbrengsten': netto_opbrengsten,
+        'kosten': kosten, 'totaal_kosten': totaal_kosten,
+        'resultaat': round(netto_opbrengsten - totaal_kosten, 2),
+        'van_datum': van_datum, 'tot_datum': tot_datum,
+    }
 
 
 @rapportages_bp.route('/')
 def index():
-    return render_template('rapportages/index.html')
+    return render_template('rapportages/index.html', vorig_jaar=date.today().year - 1)
 
 
 @rapportages_bp.route('/balans')
 def balans():
-    activa, totaal_activa = get_type_saldi('activa')
-    passiva, totaal_passiva = get_type_saldi('passiva')
-
-    # Winst toevoegen aan passiva voor balansevenwicht
-    opbrengsten_list, totaal_opbrengsten = get_type_saldi('opbrengsten')
-    kosten_list, totaal_kosten = get_type_saldi('kosten')
-    # Opbrengsten zijn credit (negatief saldo), kosten zijn debet (positief saldo)
-    winst = (-totaal_opbrengsten) - totaal_kosten
-
-    return render_template('rapportages/balans.html',
-                           activa=activa, totaal_activa=totaal_activa,
-                           passiva=passiva, totaal_passiva=totaal_passiva,
-                           winst=winst)
+    tot_datum = datum_uit_request('tot_datum')
+    gegevens = rapportcache.haal_op('balans', [tot_datum], lambda: balans_gegevens(tot_datum))
+    return render_template('rapportages/balans.html', **gegevens)
 
 
 @rapportages_bp.route('/winstverlies')
 def winstverlies():
-    opbrengsten, totaal_opbrengsten = get_type_saldi('opbrengsten')
-    kosten, totaal_kosten = get_type_saldi('kosten')
-    # Opbrengsten hebben negatief saldo (credit), neem absoluut
-    netto_opbrengsten = -totaal_opbrengsten
-    resultaat = netto_opbrengsten - totaal_kosten
-
-    return render_template('rapportages/winstverlies.html',
-                           opbrengsten=opbrengsten,
-                           totaal_opbrengsten=netto_opbrengsten,
-                           kosten=kosten,
-                           totaal_kosten=totaal_kosten,
-                           resultaat=resultaat)
+    van_datum, tot_datum = datum_uit_request('van_datum'), datum_uit_request('tot_datum')
+    gegevens = rapportcache.haal_op('winstverlies', [van_datum, tot_datum],
+                                    lambda: winstverlies_gegevens(van_datum, tot_datum))
+    return render_template('rapportages/winstverlies.html', **gegevens)
 
 
 @rapportages_bp.route('/btw')
@@ -95,31 +75,13 @@ def btw_aangifte():
     jaar = int(request.args.get('jaar', date.today().year))
     kwartaal = int(request.args.get('kwartaal', (date.today().month - 1) // 3 + 1))
 
-    maand_start = (kwartaal - 1) * 3 + 1
-    maand_eind = kwartaal * 3
-
-    # BTW op verkopen
-    verkoop_btw = db.session.query(
-        VerkoopfactuurRegel.btw_percentage,
-        func.sum(VerkoopfactuurRegel.totaal - (VerkoopfactuurRegel.aantal * VerkoopfactuurRegel.prijs_per_stuk)).label('btw'),
-        func.sum(VerkoopfactuurRegel.aantal * VerkoopfactuurRegel.prijs_per_stuk).label('netto')
-    ).join(Verkoopfactuur).filter(
-        extract('year', Verkoopfactuur.factuurdatum) == jaar,
-        extract('month', Verkoopfactuur.factuurdatum) >= maand_start,
-        extract('month', Verkoopfactuur.factuurdatum) <= maand_eind,
-        Verkoopfactuur.status != 'concept'
-    ).group_by(VerkoopfactuurRegel.btw_percentage).all()
-
-    # BTW op inkopen
-    inkoop_btw = db.session.query(
-        InkoopfactuurRegel.btw_percentage,
-        func.sum(InkoopfactuurRegel.totaal - (InkoopfactuurRegel.aantal * InkoopfactuurRegel.prijs_per_stuk)).label('btw'),
-        func.sum(InkoopfactuurRegel.aantal * InkoopfactuurRegel.prijs_per_stuk).label('netto')
-    ).join(Inkoopfactuur).filter(
-        extract('year', Inkoopfactuur.factuurdatum) == jaar,
-        extract('month', Inkoopfactuur.factuurdatum) >= maand_start,
-        extract('month', Inkoopfactuur.factuurdatum) <= maand_eind,
-    ).group_by(InkoopfactuurRegel.btw_percentage).all()
+    # Kwartaal 0 is het hele jaar
+    maand_start = (kwartaal - 1) * 3 + 1 if kwartaal else 1
+    maand_eind = kwartaal * 3 if kwartaal else 12
+
+    per_soort = btw_per_tarief(jaar, maand_start, maand_eind)
+    verkoop_btw = per_soort['verkoop']
+    inkoop_btw = per_soort['inkoop']
 
     totaal_verkoop_btw = sum(r.btw or 0 for r in verkoop_btw)
     totaal_inkoop_btw = sum(r.btw or 0 for r in inkoop_btw)
@@ -129,87 +91,123 @@ def btw_aangifte():
                            jaar=jaar, kwartaal=kwartaal,
                            verkoop_btw=verkoop_btw,
                            inkoop_btw=inkoop_btw,
+                           rubrieken=aangifte_rubrieken(per_soort),
                            totaal_verkoop_btw=round(totaal_verkoop_btw, 2),
                            totaal_inkoop_btw=round(totaal_inkoop_btw, 2),
                            af_te_dragen=round(af_te_dragen, 2))
 
 
+@rapportages_bp.route('/ouderdom')
+def ouderdom():
+    soort = request.args.get('soort', 'debiteuren')
+    if soort not in SOORTEN:
+        soort = 'debiteuren'
+    peildatum = datum_uit_request('peildatum')
+    rijen, totalen = ouderdomsanalyse(soort, peildatum)
+    return render_template('rapportages/ouderdom.html', soort=soort, peildatum=peildatum,
+                           klassen=KLASSEN, rijen=rijen, totalen=totalen)
+
+
+@rapportages_bp.route('/ouderdom/csv')
+def export_ouderdom():
+    soort = request.args.get('soort', 'debiteuren')
+    if soort not in SOORTEN:
+        return 'Onbekend rapport', 404
+    peildatum = datum_uit_request('peildatum') or date.today()
+    query = ouderdom_query(soort, peildatum).execution_options(yield_per=1000)
+
+    def rijen():
+        for rij in db.session.execute(query).mappings():
+            yield [rij['naam']] + [f"{rij[k] or 0:.2f}" for k, _ in KLASSEN] + \
+                  [f"{rij['totaal'] or 0:.2f}", rij['aantal']]
+
+    kop = ['Klant' if soort == 'debiteuren' else 'Leverancier'] + [naam for _, naam in KLASSEN] + \
+          ['Totaal', 'Aantal facturen']
+    return stream_csv(kop, rijen(), f'ouderdom_{soort}_{peildatum}.csv')
+
+
+def _csv_bestandsnaam(rapport, rekening=None):
+    return f"{rapport}{'_' + rekening if rekening else ''}_{date.today()}.csv"
+
+
 @rapportages_bp.route('/export/csv/<rapport>')
 def export_csv(rapport):
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=';')
+    rekening = request.args.get('rekening') or None
+    resultaat = csv_rapport(rapport, datum_uit_request('van_datum'), datum_uit_request('tot_datum'), rekening)
+    if resultaat is None:
+        return 'Onbekend rapport', 404
+    kop, rijen = resultaat
+    return stream_csv(kop, rijen, _csv_bestandsnaam(rapport, rekening))
+
+
+@taaksoort('rapport_csv', 'CSV-export')
+def taak_rapport_csv(parameters, voortgang):
+    rapport = parameters['rapport']
+    rekening = parameters.get('rekening') or None
+    resultaat = csv_rapport(rapport, datum_uit_tekst(parameters.get('van_datum')),
+                            datum_uit_tekst(parameters.get('tot_datum')), rekening)
+    if resultaat is None:
+        raise ValueError(f'Onbekend rapport: {rapport}')
+    # Als stroom teruggeven: de worker schrijft de regels in delen weg in taak_resultaat
+    inhoud = (regel.encode('utf-8') for regel in csv_regels(*resultaat))
+    return inhoud, _csv_bestandsnaam(rapport, rekening), 'text/csv'
+
 
+@rapportages_bp.route('/pdf-cache')
+def pdf_cache():
+    """Statistiek van de PDF-cache; de tellers zijn die van de worker die dit verzoek afhandelt."""
+    return jsonify(pdfcache.statistiek())
+
+
+def rapport_pdf_html(rapport, van_datum=None, tot_datum=None):
+    """HTML voor de PDF-versie van een rapport, of None voor een onbekend rapport."""
     if rapport == 'balans':
-        writer.writerow(['Type', 'Code', 'Naam', 'Saldo'])
-        for type_ in ['activa', 'passiva']:
-            saldi, _ = get_type_saldi(type_)
-            for r in saldi:
-                writer.writerow([type_, r['code'], r['naam'], f"{r['saldo']:.2f}"])
-    elif rapport == 'winstverlies':
-        writer.writerow(['Type', 'Code', 'Naam', 'Saldo'])
-        for type_ in ['opbrengsten', 'kosten']:
-            saldi, _ = get_type_saldi(type_)
-            for r in saldi:
-                saldo = -r['saldo'] if type_ == 'opbrengsten' else r['saldo']
-                writer.writerow([type_, r['code'], r['naam'], f"{saldo:.2f}"])
-    elif rapport == 'debiteuren':
-        writer.writerow(['Factuurnummer', 'Klant', 'Factuurdatum', 'Vervaldatum', 'Totaal', 'Openstaand', 'Status'])
-        facturen = Verkoopfactuur.query.filter(
-            Verkoopfactuur.status.in_(['verzonden', 'vervallen'])
-        ).all()
-        for f in facturen:
-            writer.writerow([f.factuurnummer, f.klant.naam, f.factuurdatum, f.vervaldatum,
-                             f"{f.totaal:.2f}", f"{f.openstaand_bedrag:.2f}", f.status])
-    elif rapport == 'crediteuren':
-        writer.writerow(['Factuurnummer', 'Leverancier', 'Factuurdatum', 'Vervaldatum', 'Totaal', 'Openstaand', 'Status'])
-        facturen = Inkoopfactuur.query.filter(
-            Inkoopfactuur.status.in_(['ontvangen', 'goedgekeurd', 'vervallen'])
-        ).all()
-        for f in facturen:
-            writer.writerow([f.factuurnummer, f.leverancier.naam, f.factuurdatum, f.vervaldatum,
-                             f"{f.totaal:.2f}", f"{f.openstaand_bedrag:.2f}", f.status])
-
-    output.seek(0)
-    return Response(
-        output.getvalue(),
-        mimetype='text/csv',
-        headers={'Content-Disposition': f'attachment; filename={rapport}_{date.today()}.csv'}
-    )
+        return render_template('rapportages/balans_pdf.html', datum=tot_datum or date.today(),
+                               **balans_gegevens(tot_datum))
+    if rapport == 'winstverlies':
+        return render_template('rapportages/winstverlies_pdf.html', datum=date.today(),
+                               **winstverlies_gegevens(van_datum, tot_datum))
+    return None
 
 
 @rapportages_bp.route('/export/pdf/<rapport>')
 def export_pdf(rapport):
-    if rapport == 'balans':
-        activa, totaal_activa = get_type_saldi('activa')
-        passiva, totaal_passiva = get_type_saldi('passiva')
-        opbrengsten_list, totaal_opbrengsten = get_type_saldi('opbrengsten')
-        kosten_list, totaal_kosten = get_type_saldi('kosten')
-        winst = (-totaal_opbrengsten) - totaal_kosten
-        html = render_template('rapportages/balans_pdf.html',
-                               activa=activa, totaal_activa=totaal_activa,
-                               passiva=passiva, totaal_passiva=totaal_passiva,
-                               winst=winst, datum=date.today())
-    elif rapport == 'winstverlies':
-        opbrengsten, totaal_opbrengsten = get_type_saldi('opbrengsten')
-        kosten, totaal_kosten = get_type_saldi('kosten')
-        netto_opbrengsten = -totaal_opbrengsten
-        resultaat = netto_opbrengsten - totaal_kosten
-        html = render_template('rapportages/winstverlies_pdf.html',
-                               opbrengsten=opbrengsten,
-                               totaal_opbrengsten=netto_opbrengsten,
-                               kosten=kosten,
-                               totaal_kosten=totaal_kosten,
-                               resultaat=resultaat, datum=date.today())
-    else:
+    html = rapport_pdf_html(rapport, datum_uit_request('van_datum'), datum_uit_request('tot_datum'))
+    if html is None:
         return 'Onbekend rapport', 404
 
-    if WEASYPRINT_BESCHIKBAAR:
-        pdf_buffer = io.BytesIO()
-        HTML(string=html).write_pdf(pdf_buffer)
-        pdf_buffer.seek(0)
-        return send_file(pdf_buffer, mimetype='application/pdf',
-                         download_name=f'{rapport}_{date.today()}.pdf')
-    else:
-        html_buffer = io.BytesIO(html.encode('utf-8'))
-        return send_file(html_buffer, mimetype='text/html',
-                         download_name=f'{rapport}_{date.today()}.html')
+    buffer, mimetype = html_naar_pdf(html)
+    ext = 'pdf' if mimetype == 'application/pdf' else 'html'
+    return send_file(buffer, mimetype=mimetype, download_name=f'{rapport}_{date.today()}.{ext}')
+
+
+@taaksoort('rapport_pdf', 'PDF-rapport')
+def taak_rapport_pdf(parameters, voortgang):
+    rapport = parameters['rapport']
+    html = rapport_pdf_html(rapport, datum_uit_tekst(parameters.get('van_datum')),
+                            datum_uit_tekst(parameters.get('tot_datum')))
+    if html is None:
+        raise ValueError(f'Onbekend rapport: {rapport}')
+    buffer, mimetype = html_naar_pdf(html)
+    ext = 'pdf' if mimetype == 'application/pdf' else 'html'
+    return buffer.getvalue(), f'{rapport}_{date.today()}.{ext}', mimetype
+
+
+@rapportages_bp.route('/export/xaf')
+def export_xaf():
+    jaar = request.args.get('jaar', date.today().year - 1, type=int)
+    comprimeer = bool(request.args.get('gzip'))
+    return Response(
+        stream_with_context(xaf_stroom(jaar, comprimeer)),
+        mimetype='application/gzip' if comprimeer else 'application/xml',
+        headers={'Content-Disposition': f'attachment; filename={xaf_bestandsnaam(jaar, comprimeer)}'}
+    )
+
+
+@taaksoort('xaf', 'Auditfile (XAF)')
+def taak_xaf(parameters, voortgang):
+    jaar = int(parameters['jaar'])
+    comprimeer = bool(parameters.get('gzip'))
+    mimetype = 'application/gzip' if comprimeer else 'application/xml'
+    # De stroom niet samenvoegen: de worker schrijft elk deel direct weg in taak_resultaat
+    return xaf_stroom(jaar, comprimeer, voortgang), xaf_bestandsnaam(jaar, comprimeer), mimetype
@@ -0,0 +1,77 @@
+from flask import (Blueprint, render_template, request, redirect, url_for, flash, jsonify, abort, Response,
+                   stream_with_context)
+from flask_login import login_required, current_user
+from models import db, Taak, TaakResultaat
+from utils.taken import TAAKSOORTEN, plan_taak, lees_resultaat, resultaat_grootte
+
+taken_bp = Blueprint('taken', __name__, url_prefix='/taken')
+
+
+@taken_bp.before_request
+@login_required
+def vereist_login():
+    pass
+
+
+def taak_status(taak):
+    return {
+        'id': taak.id,
+        'soort': taak.soort,
+        'omschrijving': taak.omschrijving,
+        'status': taak.status,
+        'klaar': taak.klaar,
+        'totaal': taak.totaal,
+        'percentage': taak.percentage,
+        'foutmelding': taak.foutmelding,
+        'resultaat': url_for('taken.resultaat', id=taak.id) if taak.status == 'klaar' else None,
+    }
+
+
+@taken_bp.route('/')
+def lijst():
+    taken = Taak.query.order_by(Taak.id.desc()).limit(50).all()
+    bezig = any(t.status in ('wachtend', 'bezig') for t in taken)
+    return render_template('taken/lijst.html', taken=taken, bezig=bezig)
+
+
+@taken_bp.route('/nieuw/<soort>', methods=['POST'])
+def nieuw(soort):
+    if soort not in TAAKSOORTEN:
+        abort(404)
+    taak = plan_taak(soort, request.form.to_dict(), gebruiker_id=current_user.id)
+    flash(f'Taak "{taak.omschrijving}" staat in de wachtrij.', 'success')
+    return redirect(url_for('taken.lijst'))
+
+
+@taken_bp.route('/<int:id>/status')
+def status(id):
+    return jsonify(taak_status(Taak.query.get_or_404(id)))
+
+
+@taken_bp.route('/<int:id>/resultaat')
+def resultaat(id):
+    taak = Taak.query.get_or_404(id)
+    if taak.status != 'klaar':
+        abort(404)
+    grootte = resultaat_grootte(id)
+    if grootte is None:
+        abort(404)
+    return Response(
+        stream_with_context(lees_resultaat(id)),
+        mimetype=taak.mimetype,
+        headers={'Content-Disposition': f'attachment; filename={taak.bestandsnaam}',
+                 'Content-Length': str(grootte)},
+    )
+
+
+@taken_bp.route('/<int:id>/verwijder', methods=['POST'])
+def verwijder(id):
+    taak = Taak.query.get_or_404(id)
+    if taak.status == 'bezig':
+        flash('Een taak die wordt uitgevoerd kan niet worden verwijderd.', 'warning')
+        return redirect(url_for('taken.lijst'))
+    TaakResultaat.query.filter_by(taak_id=id).delete()
+    db.session.delete(taak)
+    db.session.commit()
+    flash('Taak is verwijderd.', 'success')
+    return redirect(url_for('taken.lijst'))
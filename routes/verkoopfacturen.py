@@ -1,9 +1,15 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file
+from flask import (Blueprint, render_template, request, redirect, url_for, flash, send_file,
+                   Response, current_app, stream_with_context)
 from flask_login import login_required
-from models import (db, Verkoopfactuur, VerkoopfactuurRegel, Klant, Valuta,
-                     Grootboekrekening, Journaalpost, JournaalpostRegel)
+from models import db, Verkoopfactuur, VerkoopfactuurRegel, Klant, Valuta, Grootboekrekening
 from utils.btw import bereken_btw
-from utils.pdf import genereer_factuur_pdf
+from utils.boekingen import boek
+from utils.btwtotalen import boek_btw
+from utils.pdf import genereer_factuur_pdf, factuur_selectie, factuur_zip_stroom
+from utils.datums import datum_uit_request, datum_uit_tekst
+from utils.taken import taaksoort
+from utils.nummering import volgend_nummer
+from utils.factuurimport import lees_bestand, importeer_facturen
 from datetime import date, timedelta
 
 verkoopfacturen_bp = Blueprint('verkoopfacturen', __name__, url_prefix='/verkoop')
@@ -16,57 +22,7 @@ def vereist_login():
 
 
 def genereer_factuurnummer():
-    jaar = date.today().year
-    laatste = Verkoopfactuur.query.filter(
-        Verkoopfactuur.factuurnummer.like(f'VF{jaar}%')
-    ).order_by(Verkoopfactuur.factuurnummer.desc()).first()
-    if laatste:
-        nr = int(laatste.factuurnummer[-4:]) + 1
-    else:
-        nr = 1
-    return f'VF{jaar}{nr:04d}'
-
-
-def maak_journaalpost_verkoop(factuur):
-    """Maak journaalpost voor een verkoopfactuur."""
-    jp = Journaalpost(
-        datum=factuur.factuurdatum,
-        omschrijving=f'Verkoopfactuur {factuur.factuurnummer}',
-        referentie=factuur.factuurnummer
-    )
-    db.session.add(jp)
-    db.session.flush()
-
-    # Debet: Debiteuren (1200)
-    deb_rek = Grootboekrekening.query.filter_by(code='1200').first()
-    if deb_rek:
-        db.session.add(JournaalpostRegel(
-            journaalpost_id=jp.id,
-            grootboekrekening_id=deb_rek.id,
-            debet=factuur.totaal,
-            credit=0
-        ))
-
-    # Credit: Omzet (8000) voor subtotaal
-    omzet_rek = Grootboekrekening.query.filter_by(code='8000').first()
-    if omzet_rek:
-        db.session.add(JournaalpostRegel(
-            journaalpost_id=jp.id,
-            grootboekrekening_id=omzet_rek.id,
-            debet=0,
-            credit=factuur.subtotaal
-        ))
-
-    # Credit: BTW af te dragen (2100)
-    if factuur.btw_bedrag > 0:
-        btw_rek = Grootboekrekening.query.filter_by(code='2100').first()
-        if btw_rek:
-            db.session.add(JournaalpostRegel(
-                journaalpost_id=jp.id,
-                grootboekrekening_id=btw_rek.id,
-                debet=0,
-                credit=factuur.btw_bedrag
-            ))
+    return volgend_nummer('VF')
 
 
 @verkoopfacturen_bp.route('/')
@@ -77,12 +33,6 @@ def lijst():
         query = query.filter_by(status=status)
     facturen = query.order_by(Verkoopfactuur.factuurdatum.desc()).all()
 
-    # Update vervallen status
-    for f in facturen:
-        if f.status == 'verzonden' and f.vervaldatum < date.today():
-            f.status = 'vervallen'
-    db.session.commit()
-
     return render_template('verkoopfacturen/lijst.html', facturen=facturen, status=status)
 
 
@@ -139,6 +89,7 @@ def nieuw():
         factuur.subtotaal = round(subtotaal, 2)
         factuur.btw_bedrag = round(btw_totaal, 2)
         factuur.totaal = round(subtotaal + btw_totaal, 2)
+        factuur.werk_openstaand_bij()
 
         db.session.add(factuur)
         db.session.commit()
@@ -154,6 +105,27 @@ def nieuw():
                            vervaldatum=date.today() + timedelta(days=30))
 
 
+@verkoopfacturen_bp.route('/import', methods=['GET', 'POST'])
+def importeer():
+    resultaat = None
+    if request.method == 'POST':
+        bestand = request.files.get('bestand')
+        if not bestand or not bestand.filename:
+            flash('Kies een CSV- of JSON-bestand.', 'danger')
+            return redirect(url_for('verkoopfacturen.importeer'))
+        try:
+            facturen = lees_bestand(bestand.filename, bestand.read())
+        except (ValueError, UnicodeDecodeError) as e:
+            flash(f'Bestand kan niet worden gelezen: {e}', 'danger')
+            return redirect(url_for('verkoopfacturen.importeer'))
+        resultaat = importeer_facturen(facturen, boeken='boeken' in request.form,
+                                       strikt='strikt' in request.form)
+        if resultaat['facturen']:
+            flash(f"{resultaat['facturen']} verkoopfacturen geïmporteerd "
+                  f"({resultaat['eerste']} t/m {resultaat['laatste']}).", 'success')
+    return render_template('verkoopfacturen/import.html', resultaat=resultaat)
+
+
 @verkoopfacturen_bp.route('/<int:id>')
 def detail(id):
     factuur = Verkoopfactuur.query.get_or_404(id)
@@ -164,6 +136,7 @@ def detail(id):
 def bewerk(id):
     factuur = Verkoopfactuur.query.get_or_404(id)
     if request.method == 'POST':
+        boek_btw('verkoop', factuur, -1)
         factuur.klant_id = request.form['klant_id']
         factuur.factuurdatum = date.fromisoformat(request.form['factuurdatum'])
         factuur.vervaldatum = date.fromisoformat(request.form['vervaldatum'])
@@ -197,6 +170,8 @@ def bewerk(id):
         factuur.subtotaal = round(subtotaal, 2)
         factuur.btw_bedrag = round(btw_totaal, 2)
         factuur.totaal = round(subtotaal + btw_totaal, 2)
+        factuur.werk_openstaand_bij()
+        boek_btw('verkoop', factuur)
 
         db.session.commit()
         flash(f'Verkoopfactuur {factuur.factuurnummer} is bijgewerkt.', 'success')
@@ -215,7 +190,13 @@ def verzend(id):
     factuur = Verkoopfactuur.query.get_or_404(id)
     if factuur.status == 'concept':
         factuur.status = 'verzonden'
-        maak_journaalpost_verkoop(factuur)
+        try:
+            boek('verkoop', factuur)
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+            return redirect(url_for('verkoopfacturen.detail', id=id))
+        boek_btw('verkoop', factuur)
         db.session.commit()
         flash(f'Factuur {factuur.factuurnummer} is verzonden.', 'success')
     return redirect(url_for('verkoopfacturen.detail', id=id))
@@ -231,10 +212,60 @@ def pdf(id):
                      download_name=f'{factuur.factuurnummer}.{ext}')
 
 
+def batch_filters():
+    return {
+        'van_datum': datum_uit_request('van_datum'),
+        'tot_datum': datum_uit_request('tot_datum'),
+        'status': request.args.get('status', ''),
+        'klant_id': request.args.get('klant_id', type=int),
+    }
+
+
+@verkoopfacturen_bp.route('/pdf-batch')
+def pdf_batch():
+    filters = batch_filters()
+    aantal = factuur_selectie(**filters).count() if request.args else None
+    klanten = Klant.query.order_by(Klant.naam).all()
+    return render_template('verkoopfacturen/pdf_batch.html', filters=filters, aantal=aantal, klanten=klanten)
+
+
+@verkoopfacturen_bp.route('/pdf-batch/zip')
+def pdf_batch_zip():
+    filters = batch_filters()
+    aantal = factuur_selectie(**filters).count()
+    facturen = factuur_selectie(**filters).yield_per(100)
+    logger = current_app.logger
+
+    def voortgang(klaar, totaal):
+        if klaar % 50 == 0 or klaar == totaal:
+            logger.info('PDF-batch: %s van %s facturen', klaar, totaal)
+
+    return Response(
+        stream_with_context(factuur_zip_stroom(facturen, aantal, voortgang)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename=facturen_{date.today()}.zip',
+                 'X-Aantal-Facturen': str(aantal)}
+    )
+
+
+@taaksoort('factuur_pdfs', "Factuur-PDF's")
+def taak_factuur_pdfs(parameters, voortgang):
+    filters = {
+        'van_datum': datum_uit_tekst(parameters.get('van_datum')),
+        'tot_datum': datum_uit_tekst(parameters.get('tot_datum')),
+        'status': parameters.get('status'),
+        'klant_id': int(parameters['klant_id']) if parameters.get('klant_id') else None,
+    }
+    aantal = factuur_selectie(**filters).count()
+    inhoud = factuur_zip_stroom(factuur_selectie(**filters).yield_per(100), aantal, voortgang)
+    return inhoud, f'facturen_{date.today()}.zip', 'application/zip'
+
+
 @verkoopfacturen_bp.route('/<int:id>/verwijder', methods=['POST'])
 def verwijder(id):
     factuur = Verkoopfactuur.query.get_or_404(id)
     nr = factuur.factuurnummer
+    boek_btw('verkoop', factuur, -1)
     db.session.delete(factuur)
     db.session.commit()
     flash(f'Factuur {nr} is verwijderd.', 'success')
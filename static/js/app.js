@@ -79,24 +79,39 @@ document.addEventListener('input', function(e) {
 // ============================================================
 // Dashboard grafieken
 // ============================================================
+const grafieken = {};
+
+// Querystring voor de reeks-API's, bv. '?van=2024&tot=2026&granulariteit=kwartaal'
+function grafiekParameters() {
+    const keuze = document.getElementById('grafiekPeriode');
+    if (!keuze || !keuze.value) return '';
+    const [jaren, granulariteit] = keuze.value.split(':');
+    const tot = new Date().getFullYear();
+    return '?van=' + (tot - parseInt(jaren) + 1) + '&tot=' + tot + '&granulariteit=' + granulariteit;
+}
+
+function tekenGrafiek(id, config) {
+    if (grafieken[id]) grafieken[id].destroy();
+    grafieken[id] = new Chart(document.getElementById(id), config);
+}
+
 function laadDashboardGrafieken() {
-    laadOmzetGrafiek();
-    laadCashflowGrafiek();
+    const parameters = grafiekParameters();
+    laadOmzetGrafiek(parameters);
+    laadCashflowGrafiek(parameters);
 }
 
-function laadOmzetGrafiek() {
+function laadOmzetGrafiek(parameters) {
     const ctx = document.getElementById('omzetGrafiek');
     if (!ctx) return;
 
-    fetch('/api/omzet-per-maand')
+    fetch('/api/omzet-per-maand' + parameters)
         .then(r => r.json())
         .then(data => {
-            const maanden = ['Jan', 'Feb', 'Mrt', 'Apr', 'Mei', 'Jun',
-                             'Jul', 'Aug', 'Sep', 'Okt', 'Nov', 'Dec'];
-            new Chart(ctx, {
+            tekenGrafiek('omzetGrafiek', {
                 type: 'bar',
                 data: {
-                    labels: maanden,
+                    labels: data.map(d => d.label),
                     datasets: [
                         {
                             label: 'Omzet',
@@ -133,19 +148,17 @@ function laadOmzetGrafiek() {
         });
 }
 
-function laadCashflowGrafiek() {
+function laadCashflowGrafiek(parameters) {
     const ctx = document.getElementById('cashflowGrafiek');
     if (!ctx) return;
 
-    fetch('/api/cashflow-per-maand')
+    fetch('/api/cashflow-per-maand' + parameters)
         .then(r => r.json())
         .then(data => {
-            const maanden = ['Jan', 'Feb', 'Mrt', 'Apr', 'Mei', 'Jun',
-                             'Jul', 'Aug', 'Sep', 'Okt', 'Nov', 'Dec'];
-            new Chart(ctx, {
+            tekenGrafiek('cashflowGrafiek', {
                 type: 'line',
                 data: {
-                    labels: maanden,
+                    labels: data.map(d => d.label),
                     datasets: [
                         {
                             label: 'Inkomend',
@@ -184,10 +197,76 @@ function laadCashflowGrafiek() {
         });
 }
 
+function laadPrognoseGrafiek() {
+    const ctx = document.getElementById('prognoseGrafiek');
+    if (!ctx) return;
+
+    const dagen = document.getElementById('prognoseDagen')?.value || 90;
+    const betaalgedrag = document.getElementById('prognoseBetaalgedrag')?.checked ? 1 : 0;
+    fetch('/api/liquiditeitsprognose?dagen=' + dagen + '&betaalgedrag=' + betaalgedrag)
+        .then(r => r.json())
+        .then(p => {
+            const samenvatting = document.getElementById('prognoseSamenvatting');
+            if (samenvatting) {
+                samenvatting.textContent = 'Startsaldo kas en bank ' + formatBedrag(p.startsaldo) +
+                    ', laagste verwachte saldo ' + formatBedrag(p.laagste_saldo) + ' op ' +
+                    new Date(p.laagste_datum).toLocaleDateString('nl-NL') +
+                    '. Achterstallig: ' + formatBedrag(p.achterstallig.ontvangsten) + ' te ontvangen, ' +
+                    formatBedrag(p.achterstallig.betalingen) + ' te betalen.';
+            }
+            tekenGrafiek('prognoseGrafiek', {
+                type: 'bar',
+                data: {
+                    labels: p.datums.map(d => new Date(d).toLocaleDateString('nl-NL', { day: 'numeric', month: 'short' })),
+                    datasets: [
+                        {
+                            type: 'line',
+                            label: 'Verwacht saldo',
+                            data: p.saldo,
+                            borderColor: '#2c3e50',
+                            pointRadius: 0,
+                            tension: 0.1
+                        },
+                        {
+                            label: 'Ontvangsten',
+                            data: p.ontvangsten,
+                            backgroundColor: 'rgba(39, 174, 96, 0.6)'
+                        },
+                        {
+                            label: 'Betalingen',
+                            data: p.betalingen.map(b => -b),
+                            backgroundColor: 'rgba(231, 76, 60, 0.6)'
+                        }
+                    ]
+                },
+                options: {
+                    responsive: true,
+                    maintainAspectRatio: false,
+                    plugins: {
+                        legend: { position: 'top' }
+                    },
+                    scales: {
+                        y: {
+                            ticks: {
+                                callback: v => '\u20ac ' + v.toLocaleString('nl-NL')
+                            }
+                        }
+                    }
+                }
+            });
+        });
+}
+
 // Init on page load
 document.addEventListener('DOMContentLoaded', function() {
     if (document.getElementById('omzetGrafiek')) {
         laadDashboardGrafieken();
+        document.getElementById('grafiekPeriode')?.addEventListener('change', laadDashboardGrafieken);
+    }
+    if (document.getElementById('prognoseGrafiek')) {
+        laadPrognoseGrafiek();
+        document.getElementById('prognoseDagen')?.addEventListener('change', laadPrognoseGrafiek);
+        document.getElementById('prognoseBetaalgedrag')?.addEventListener('change', laadPrognoseGrafiek);
     }
     updateTotalen();
 });
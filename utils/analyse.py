@@ -0,0 +1,220 @@
+"""Kolomgeoriënteerde export van journaal- en factuurregels voor analyse (Parquet of Arrow IPC).
+
+Elke dataset is een map onder ANALYSE_MAP met deelbestanden per exportrun. Een bron
+(bijvoorbeeld verkoopfactuurregels) wordt in blokken van BLOK rijen op oplopend id
+gelezen; elk blok wordt één row group (Parquet) of record batch (Arrow). Per bron
+houdt export_watermerk het hoogste geëxporteerde id bij, zodat een volgende run alleen
+nieuwe regels als extra deelbestand toevoegt. Pyarrow en pandas lezen zo'n map in één
+keer als dataset in.
+
+Een id wordt bij het invoegen uitgedeeld, maar pas bij de commit zichtbaar: een lange
+transactie kan dus een lager id vastleggen dan regels die al geëxporteerd zijn. Daarom
+stopt elke run vóór de eerste regel waarvan de journaalpost of factuur korter dan MARGE
+geleden is aangemaakt (regels ontstaan altijd samen met hun post of factuur); die
+regels en alles daarna komen in een volgende run mee. Een transactie die langer dan
+MARGE openstaat, valt daar buiten; een volledige export neemt zulke regels alsnog mee.
+
+Incrementeel worden alleen nieuwe regels meegenomen: wijzigingen in of verwijderingen
+van eerder geëxporteerde regels komen pas mee met een volledige export (volledig=True),
+die de map opnieuw opbouwt.
+
+pyarrow is optioneel; zonder pyarrow geeft exporteer() een RuntimeError.
+"""
+
+import os
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, literal, select
+from models import (db, ExportWatermerk, Grootboekrekening, Journaalpost, JournaalpostRegel, Verkoopfactuur,
+                    VerkoopfactuurRegel, Inkoopfactuur, InkoopfactuurRegel, Klant, Leverancier)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_BESCHIKBAAR = True
+except ImportError:
+    pa = pq = None
+    PYARROW_BESCHIKBAAR = False
+
+BLOK = 50000
+# Regels van posten en facturen die korter geleden zijn aangemaakt, wachten op een volgende run
+MARGE = timedelta(minutes=10)
+FORMATEN = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+def _journaalregels():
+    return select(
+        JournaalpostRegel.id.label('regel_id'), Journaalpost.id.label('journaalpost_id'),
+        Journaalpost.datum, Journaalpost.omschrijving, Journaalpost.referentie,
+        Grootboekrekening.code.label('rekening'), Grootboekrekening.naam.label('rekeningnaam'),
+        Grootboekrekening.type.label('rekeningtype'), JournaalpostRegel.debet, JournaalpostRegel.credit,
+    ).join(Journaalpost, Journaalpost.id == JournaalpostRegel.journaalpost_id).join(
+        Grootboekrekening, Grootboekrekening.id == JournaalpostRegel.grootboekrekening_id
+    ), JournaalpostRegel.id, Journaalpost.aangemaakt_op
+
+
+def _factuurregels(soort, model, regel_model, relatie):
+    def query():
+        return select(
+            regel_model.id.label('regel_id'), literal(soort).label('soort'), model.id.label('factuur_id'),
+            model.factuurnummer, model.factuurdatum, model.vervaldatum, model.status, model.valuta,
+            relatie.id.label('relatie_id'), relatie.naam.label('relatie'), regel_model.omschrijving,
+            regel_model.aantal, regel_model.prijs_per_stuk, regel_model.btw_percentage,
+            (regel_model.aantal * regel_model.prijs_per_stuk).label('netto'), regel_model.totaal,
+            Grootboekrekening.code.label('rekening'),
+        ).join(model, model.id == regel_model.factuur_id).join(relatie).outerjoin(
+            Grootboekrekening, Grootboekrekening.id == regel_model.grootboekrekening_id
+        ), regel_model.id, model.aangemaakt_op
+    return query
+
+
+def _schema_journaal():
+    return pa.schema([
+        ('regel_id', pa.int64()), ('journaalpost_id', pa.int64()), ('datum', pa.date32()),
+        ('omschrijving', pa.string()), ('referentie', pa.string()), ('rekening', pa.string()),
+        ('rekeningnaam', pa.string()), ('rekeningtype', pa.string()),
+        ('debet', pa.float64()), ('credit', pa.float64()),
+    ])
+
+
+def _schema_factuurregels():
+    return pa.schema([
+        ('regel_id', pa.int64()), ('soort', pa.string()), ('factuur_id', pa.int64()),
+        ('factuurnummer', pa.string()), ('factuurdatum', pa.date32()), ('vervaldatum', pa.date32()),
+        ('status', pa.string()), ('valuta', pa.string()), ('relatie_id', pa.int64()), ('relatie', pa.string()),
+        ('omschrijving', pa.string()), ('aantal', pa.float64()), ('prijs_per_stuk', pa.float64()),
+        ('btw_percentage', pa.float64()), ('netto', pa.float64()), ('totaal', pa.float64()),
+        ('rekening', pa.string()),
+    ])
+
+
+# dataset -> (schema-functie, [(bron, query-functie)]); de query-functie geeft
+# (select, id-kolom, aanmaakmoment van de bijbehorende post of factuur)
+DATASETS = {
+    'journaalregels': (_schema_journaal, [('journaalregels', _journaalregels)]),
+    'factuurregels': (_schema_factuurregels, [
+        ('verkoopfactuurregels', _factuurregels('verkoop', Verkoopfactuur, VerkoopfactuurRegel, Klant)),
+        ('inkoopfactuurregels', _factuurregels('inkoop', Inkoopfactuur, InkoopfactuurRegel, Leverancier)),
+    ]),
+}
+
+
+def _grens_id(query, id_kolom, aangemaakt_kolom, vanaf_id, grens):
+    """Laagste id na vanaf_id waarvan de post of factuur op of na grens is aangemaakt, of None."""
+    return db.session.execute(
+        query.with_only_columns(func.min(id_kolom)).where(id_kolom > vanaf_id, aangemaakt_kolom >= grens)
+    ).scalar()
+
+
+def _blokken(query, id_kolom, vanaf_id, tot_id=None):
+    """Lees de query in blokken van BLOK rijen met een keyset op id (geen OFFSET), tot tot_id."""
+    if tot_id is not None:
+        query = query.where(id_kolom < tot_id)
+    laatste = vanaf_id
+    while True:
+        rijen = db.session.execute(query.where(id_kolom > laatste).order_by(id_kolom).limit(BLOK)).all()
+        if not rijen:
+            return
+        yield rijen
+        laatste = rijen[-1][0]
+
+
+def _batch(schema, rijen):
+    kolommen = list(zip(*rijen))
+    return pa.record_batch([pa.array(kolom, type=veld.type) for kolom, veld in zip(kolommen, schema)],
+                           schema=schema)
+
+
+class _Schrijver:
+    """Opent het deelbestand pas bij de eerste batch, zodat een lege run geen bestand achterlaat."""
+
+    def __init__(self, pad, schema, formaat):
+        self.pad, self.schema, self.formaat = pad, schema, formaat
+        self.tijdelijk = pad + '.deel'
+        self.writer = None
+
+    def schrijf(self, batch):
+        if self.writer is None:
+            if self.formaat == 'parquet':
+                self.writer = pq.ParquetWriter(self.tijdelijk, self.schema, compression='zstd')
+            else:
+                self.writer = pa.ipc.new_file(self.tijdelijk, self.schema)
+        self.writer.write_batch(batch)
+
+    def sluit(self):
+        if self.writer is None:
+            return False
+        self.writer.close()
+        os.replace(self.tijdelijk, self.pad)
+        return True
+
+    def breek_af(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.remove(self.tijdelijk)
+
+
+def _exporteer_bron(map_, bron, query_functie, schema, formaat):
+    watermerk = db.session.get(ExportWatermerk, bron)
+    if watermerk is None:
+        watermerk = ExportWatermerk(bron=bron, laatste_id=0, aantal_rijen=0)
+        db.session.add(watermerk)
+
+    query, id_kolom, aangemaakt_kolom = query_functie()
+    vanaf = watermerk.laatste_id
+    tot = _grens_id(query, id_kolom, aangemaakt_kolom, vanaf, datetime.utcnow() - MARGE)
+    pad = os.path.join(map_, f'{bron}-{datetime.now():%Y%m%d%H%M%S}-{vanaf + 1}{FORMATEN[formaat]}')
+    schrijver = _Schrijver(pad, schema, formaat)
+    laatste, aantal = vanaf, 0
+    try:
+        for rijen in _blokken(query, id_kolom, vanaf, tot):
+            schrijver.schrijf(_batch(schema, rijen))
+            laatste = rijen[-1][0]
+            aantal += len(rijen)
+    except Exception:
+        schrijver.breek_af()
+        raise
+    if schrijver.sluit():
+        watermerk.laatste_id = laatste
+        watermerk.aantal_rijen += aantal
+        watermerk.bijgewerkt_op = datetime.utcnow()
+    # Watermerk pas vastleggen als het bestand compleet op zijn plek staat
+    db.session.commit()
+    return aantal
+
+
+def exporteer(datasets=None, formaat='parquet', volledig=False):
+    """Exporteer de datasets (standaard alle) naar ANALYSE_MAP.
+
+    Geeft {dataset: {'rijen': n, 'seconden': s}} terug. Met volledig=True worden de
+    bestaande deelbestanden verwijderd en alle regels opnieuw geëxporteerd.
+    """
+    if not PYARROW_BESCHIKBAAR:
+        raise RuntimeError('pyarrow is niet geïnstalleerd; installeer het voor de analyse-export.')
+    if formaat not in FORMATEN:
+        raise ValueError(f'Onbekend formaat: {formaat}')
+
+    resultaat = {}
+    for dataset in datasets or DATASETS:
+        if dataset not in DATASETS:
+            raise ValueError(f'Onbekende dataset: {dataset}')
+        schema_functie, bronnen = DATASETS[dataset]
+        map_ = os.path.join(current_app.config['ANALYSE_MAP'], dataset)
+        os.makedirs(map_, exist_ok=True)
+        bestanden = [naam for naam in os.listdir(map_) if naam.endswith(tuple(FORMATEN.values()))]
+        if volledig:
+            for naam in bestanden:
+                os.remove(os.path.join(map_, naam))
+            db.session.query(ExportWatermerk).filter(
+                ExportWatermerk.bron.in_([bron for bron, _ in bronnen])
+            ).delete(synchronize_session=False)
+            db.session.commit()
+        elif any(not naam.endswith(FORMATEN[formaat]) for naam in bestanden):
+            raise ValueError(f'{dataset} bevat al bestanden in een ander formaat; exporteer volledig.')
+
+        start = time.perf_counter()
+        aantal = sum(_exporteer_bron(map_, bron, query_functie, schema_functie(), formaat)
+                     for bron, query_functie in bronnen)
+        resultaat[dataset] = {'rijen': aantal, 'seconden': round(time.perf_counter() - start, 2)}
+    return resultaat
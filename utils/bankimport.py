@@ -0,0 +1,406 @@
+"""Import van bankafschriften (CAMT.053 en MT940) met automatisch koppelen aan facturen.
+
+Afschriften worden regel voor regel gelezen (iterparse voor CAMT.053, per tekstregel
+voor MT940) en per blok van IMPORT_BLOK transacties verwerkt, zodat het geheugengebruik
+niet afhangt van de grootte van het bestand. Het hele afschrift wordt in één
+databasetransactie verwerkt: een onleesbaar of onvolledig afschrift (ValueError of
+SyntaxError) wordt teruggedraaid en laat niets in de boeken achter.
+Transacties worden gekoppeld via indexen in het geheugen, die eenmalig uit de open
+facturen worden opgebouwd:
+
+1. een factuurnummer in de omschrijving (bedrag maximaal het openstaande bedrag);
+2. de IBAN van de klant/leverancier plus precies het openstaande bedrag;
+3. een openstaand bedrag dat bij precies één factuur voorkomt.
+
+Gekoppelde transacties worden per blok van IMPORT_BLOK als betalingen met
+journaalposten weggeschreven, alle blokken in één transactie; de overige komen als
+'te_beoordelen' in de tabel banktransactie. Elke transactie krijgt een sleutel (hash), zodat een afschrift
+zonder dubbele boekingen opnieuw kan worden ingelezen.
+"""
+
+import hashlib
+import io
+import re
+import time
+from collections import defaultdict
+from datetime import date
+from functools import lru_cache
+from itertools import islice
+from types import SimpleNamespace
+from xml.etree.ElementTree import iterparse
+from sqlalchemy import insert, select
+from models import db, Banktransactie, Betaling, Klant, Leverancier, Verkoopfactuur, Inkoopfactuur
+from utils.boekingen import boek, boek_reeks
+from utils.openstaand import verwerk_betalingen
+
+IMPORT_BLOK = 1000
+
+# Richting van de transactie -> (factuursoort, betalingstype)
+RICHTINGEN = {
+    'credit': ('verkoop', 'inkomend'),
+    'debet': ('inkoop', 'uitgaand'),
+}
+
+# Factuursoort -> statussen waarin een factuur nog betaald kan worden
+OPEN_STATUSSEN = {
+    'verkoop': ('verzonden', 'vervallen'),
+    'inkoop': ('ontvangen', 'goedgekeurd', 'vervallen'),
+}
+
+_IBAN = re.compile(r'\b[A-Z]{2}\d{2}[A-Z0-9]{11,30}\b')
+_TOKEN = re.compile(r'[A-Z0-9][A-Z0-9\-/._]*[A-Z0-9]')
+
+
+def normaliseer_iban(iban):
+    return re.sub(r'\s', '', iban or '').upper() or None
+
+
+def _transactie(datum, bedrag, richting, iban=None, naam=None, omschrijving=None, bankreferentie=None):
+    return {
+        'datum': datum,
+        'bedrag': round(bedrag, 2),
+        'richting': richting,
+        'iban': normaliseer_iban(iban),
+        'naam': (naam or '')[:200] or None,
+        'omschrijving': (omschrijving or '').strip() or None,
+        'bankreferentie': (bankreferentie or '')[:100] or None,
+    }
+
+
+# CAMT.053
+
+@lru_cache(maxsize=None)
+def _pad(ns, pad):
+    """'BookgDt/Dt' -> '{ns}BookgDt/{ns}Dt'; expliciete namespaces zijn veel sneller dan {*}."""
+    return '/'.join(ns + deel for deel in pad.split('/'))
+
+
+def _tekst(elem, pad, ns=''):
+    gevonden = elem.find(_pad(ns, pad))
+    if gevonden is None or gevonden.text is None:
+        return None
+    return gevonden.text.strip()
+
+
+def _camt_bedrag(tekst, nummer):
+    try:
+        return float(tekst)
+    except (TypeError, ValueError):
+        raise ValueError(f'Post {nummer}: ongeldig of ontbrekend bedrag ({tekst!r}).') from None
+
+
+def _camt_details(tx, richting, ns):
+    """IBAN, naam, omschrijving en referentie uit een TxDtls-element."""
+    partij = 'Dbtr' if richting == 'credit' else 'Cdtr'
+    iban = _tekst(tx, f'RltdPties/{partij}Acct/Id/IBAN', ns)
+    naam = (_tekst(tx, f'RltdPties/{partij}/Nm', ns) or
+            _tekst(tx, f'RltdPties/{partij}/Pty/Nm', ns))
+    delen = [e.text.strip() for e in tx.iterfind(_pad(ns, 'RmtInf/Ustrd')) if e.text]
+    delen += [e.text.strip() for e in tx.iterfind(_pad(ns, 'RmtInf/Strd/CdtrRefInf/Ref')) if e.text]
+    referentie = _tekst(tx, 'Refs/EndToEndId', ns)
+    if referentie == 'NOTPROVIDED':
+        referentie = None
+    return iban, naam, ' '.join(delen), referentie
+
+
+def lees_camt053(bron):
+    """Genereer transacties uit een CAMT.053-bestand (pad of binair bestandsobject).
+
+    Een post zonder geldig bedrag, boekdatum of CdtDbtInd geeft een ValueError.
+    """
+    afschrift, ns, nummer = None, '', 0
+    for gebeurtenis, elem in iterparse(bron, events=('start', 'end')):
+        ns, _, naam = elem.tag.rpartition('}')
+        ns = ns + '}' if ns else ''
+        if gebeurtenis == 'start':
+            if naam == 'Stmt':
+                afschrift = elem
+            continue
+        if naam != 'Ntry':
+            continue
+
+        nummer += 1
+        indicator = _tekst(elem, 'CdtDbtInd', ns)
+        if indicator not in ('CRDT', 'DBIT'):
+            raise ValueError(f'Post {nummer}: ongeldige of ontbrekende CdtDbtInd ({indicator!r}).')
+        richting = 'credit' if indicator == 'CRDT' else 'debet'
+        datum_tekst = (_tekst(elem, 'BookgDt/Dt', ns) or _tekst(elem, 'BookgDt/DtTm', ns) or
+                       _tekst(elem, 'ValDt/Dt', ns))
+        try:
+            datum = date.fromisoformat(datum_tekst[:10])
+        except (TypeError, ValueError):
+            raise ValueError(f'Post {nummer}: ongeldige of ontbrekende boekdatum ({datum_tekst!r}).') from None
+        bedrag = _camt_bedrag(_tekst(elem, 'Amt', ns), nummer)
+        referentie = _tekst(elem, 'AcctSvcrRef', ns) or _tekst(elem, 'NtryRef', ns)
+        extra = _tekst(elem, 'AddtlNtryInf', ns)
+
+        details = elem.findall(_pad(ns, 'NtryDtls/TxDtls'))
+        bedragen = [_tekst(tx, 'Amt', ns) or _tekst(tx, 'AmtDtls/TxAmt/Amt', ns) for tx in details]
+        if len(details) > 1 and all(bedragen):
+            # Verzamelpost: elke deeltransactie afzonderlijk
+            for tx, tx_bedrag in zip(details, bedragen):
+                iban, tegenpartij, omschrijving, tx_ref = _camt_details(tx, richting, ns)
+                yield _transactie(datum, _camt_bedrag(tx_bedrag, nummer), richting, iban, tegenpartij,
+                                  omschrijving or extra, tx_ref or referentie)
+        else:
+            iban, tegenpartij, omschrijving, tx_ref = (_camt_details(details[0], richting, ns) if details
+                                                       else (None, None, '', None))
+            yield _transactie(datum, bedrag, richting, iban, tegenpartij,
+                              ' '.join(d for d in (omschrijving, extra) if d), tx_ref or referentie)
+
+        # Verwerkte posten loslaten, zodat het geheugengebruik constant blijft
+        elem.clear()
+        if afschrift is not None:
+            afschrift.remove(elem)
+
+
+# MT940
+
+_MT940_TAG = re.compile(r'^:(\d{2}[A-Z]?):(.*)$')
+_MT940_61 = re.compile(r'^(\d{2})(\d{2})(\d{2})(\d{4})?(RC|RD|C|D)[A-Z]?(\d+,\d{0,2})(.*)$')
+_MT940_VELD = re.compile(r'/(IBAN|NAME|REMI|EREF)/(.*?)(?=/(?:IBAN|NAME|REMI|EREF|BIC|CSID|MARF|TRTP|ORDP|BENM|ADDR|ISDT)/|$)')
+
+
+def _mt940_transactie(regel61, info):
+    m = _MT940_61.match(regel61)
+    if not m:
+        raise ValueError(f'Ongeldige :61:-regel: {regel61}')
+    jj, mm, dd, _, teken, bedrag, rest = m.groups()
+    richting = 'credit' if teken in ('C', 'RD') else 'debet'
+    referentie = rest.split('//', 1)[1].strip() if '//' in rest else None
+
+    tekst = ''.join(info)
+    velden = dict(_MT940_VELD.findall(tekst))
+    iban = velden.get('IBAN')
+    if not iban:
+        gevonden = _IBAN.search(tekst.upper())
+        iban = gevonden.group(0) if gevonden else None
+    return _transactie(date(2000 + int(jj), int(mm), int(dd)), float(bedrag.replace(',', '.')), richting,
+                       iban, velden.get('NAME'), tekst, velden.get('EREF') or referentie)
+
+
+def lees_mt940(bron):
+    """Genereer transacties uit een MT940-bestand (pad of binair bestandsobject)."""
+    if isinstance(bron, str):
+        bron = open(bron, 'rb')
+    regels = io.TextIOWrapper(bron, encoding='latin-1', newline=None)
+    regel61, info, tag = None, [], None
+    for regel in regels:
+        regel = regel.rstrip('\n')
+        m = _MT940_TAG.match(regel)
+        if m:
+            tag, inhoud = m.groups()
+            if tag == '61':
+                if regel61:
+                    yield _mt940_transactie(regel61, info)
+                regel61, info = inhoud, []
+            elif tag == '86' and regel61:
+                info = [inhoud]
+            elif tag != '86' and regel61:
+                yield _mt940_transactie(regel61, info)
+                regel61, info = None, []
+        elif tag == '86' and regel61 and not regel.startswith('-'):
+            info.append(regel)
+    if regel61:
+        yield _mt940_transactie(regel61, info)
+
+
+def lees_afschrift(bestandsnaam, bron):
+    """Kies de parser op basis van de extensie (.xml is CAMT.053, anders MT940)."""
+    if bestandsnaam.lower().endswith('.xml'):
+        return lees_camt053(bron)
+    return lees_mt940(bron)
+
+
+def _met_sleutels(transacties, bestandsnaam):
+    """Voeg een stabiele sleutel en de bestandsnaam toe; gelijke regels krijgen een volgnummer."""
+    gezien = defaultdict(int)
+    for tx in transacties:
+        basis = '|'.join(str(tx[k] or '') for k in
+                         ('datum', 'bedrag', 'richting', 'iban', 'bankreferentie', 'omschrijving'))
+        gezien[basis] += 1
+        tx['sleutel'] = hashlib.sha256(f'{basis}|{gezien[basis]}'.encode('utf-8')).hexdigest()
+        tx['bestand'] = bestandsnaam[:200]
+        yield tx
+
+
+# Koppelen
+
+def _centen(bedrag):
+    return int(round(bedrag * 100))
+
+
+class Koppelaar:
+    """Indexen op de open facturen voor het koppelen van banktransacties."""
+
+    def __init__(self):
+        self.facturen = {}                      # (soort, id) -> [factuurnummer, openstaand, relatie_id]
+        self.op_nummer = defaultdict(list)      # FACTUURNUMMER -> [(soort, id)]
+        self.op_bedrag = defaultdict(list)      # (soort, centen) -> [id]
+        self.op_relatie = defaultdict(list)     # (soort, relatie_id, centen) -> [id]
+        self.relatie_op_iban = {}               # (soort, iban) -> relatie_id
+
+        bronnen = (
+            ('verkoop', Verkoopfactuur, Verkoopfactuur.klant_id, OPEN_STATUSSEN['verkoop'], Klant),
+            ('inkoop', Inkoopfactuur, Inkoopfactuur.leverancier_id, OPEN_STATUSSEN['inkoop'], Leverancier),
+        )
+        for soort, model, relatie_kolom, statussen, relatie in bronnen:
+            rijen = db.session.execute(
+                select(model.id, model.factuurnummer, model.openstaand, relatie_kolom)
+                .where(model.status.in_(statussen), model.openstaand > 0.005)
+                .order_by(model.vervaldatum, model.id)
+            )
+            for factuur_id, nummer, openstaand, relatie_id in rijen:
+                self.facturen[(soort, factuur_id)] = [nummer, openstaand, relatie_id]
+                self.op_nummer[nummer.upper()].append((soort, factuur_id))
+                self.op_bedrag[(soort, _centen(openstaand))].append(factuur_id)
+                self.op_relatie[(soort, relatie_id, _centen(openstaand))].append(factuur_id)
+            for relatie_id, iban in db.session.execute(select(relatie.id, relatie.iban).where(relatie.iban.isnot(None))):
+                if normaliseer_iban(iban):
+                    self.relatie_op_iban[(soort, normaliseer_iban(iban))] = relatie_id
+
+    def _open(self, soort, factuur_id):
+        factuur = self.facturen.get((soort, factuur_id))
+        return factuur[1] if factuur and factuur[1] > 0.005 else 0
+
+    def zoek(self, tx):
+        """Geef (factuursoort, factuur_id, reden) of None terug."""
+        soort = RICHTINGEN[tx['richting']][0]
+        bedrag, centen = tx['bedrag'], _centen(tx['bedrag'])
+        relatie_id = self.relatie_op_iban.get((soort, tx['iban'])) if tx['iban'] else None
+
+        # 1. Factuurnummer in de omschrijving
+        for token in _TOKEN.findall((tx['omschrijving'] or '').upper()):
+            kandidaten = [f_id for s, f_id in self.op_nummer.get(token, ()) if s == soort and self._open(s, f_id)]
+            if len(kandidaten) > 1 and relatie_id:
+                kandidaten = [f_id for f_id in kandidaten if self.facturen[(soort, f_id)][2] == relatie_id]
+            if len(kandidaten) == 1 and bedrag <= self._open(soort, kandidaten[0]) + 0.01:
+                return soort, kandidaten[0], 'factuurnummer'
+
+        # 2. IBAN van de relatie plus exact openstaand bedrag
+        if relatie_id:
+            for f_id in self.op_relatie.get((soort, relatie_id, centen), ()):
+                if _centen(self._open(soort, f_id)) == centen:
+                    return soort, f_id, 'iban_bedrag'
+
+        # 3. Bedrag dat bij precies één open factuur hoort
+        kandidaten = [f_id for f_id in self.op_bedrag.get((soort, centen), ())
+                      if _centen(self._open(soort, f_id)) == centen]
+        if len(kandidaten) == 1:
+            return soort, kandidaten[0], 'bedrag'
+        return None
+
+    def boek_af(self, soort, factuur_id, bedrag):
+        factuur = self.facturen[(soort, factuur_id)]
+        factuur[1] = round(factuur[1] - bedrag, 2)
+        if factuur[1] > 0.005:
+            # Deelbetaling: het restbedrag is opnieuw te koppelen
+            self.op_bedrag[(soort, _centen(factuur[1]))].append(factuur_id)
+            self.op_relatie[(soort, factuur[2], _centen(factuur[1]))].append(factuur_id)
+
+
+def _verwerk_blok(blok, koppelaar, resultaat):
+    bestaand = set(db.session.execute(
+        select(Banktransactie.sleutel).where(Banktransactie.sleutel.in_([tx['sleutel'] for tx in blok]))
+    ).scalars())
+    nieuw = [tx for tx in blok if tx['sleutel'] not in bestaand]
+    resultaat['dubbel'] += len(blok) - len(nieuw)
+
+    gekoppeld = []
+    for tx in nieuw:
+        tx.update(status='te_beoordelen', koppeling=None, betaling_id=None)
+        gevonden = koppelaar.zoek(tx)
+        if gevonden is None:
+            continue
+        soort, factuur_id, reden = gevonden
+        koppelaar.boek_af(soort, factuur_id, tx['bedrag'])
+        tx.update(status='gekoppeld', koppeling=reden)
+        gekoppeld.append((tx, {
+            'type': RICHTINGEN[tx['richting']][1],
+            'factuur_type': soort,
+            'factuur_id': factuur_id,
+            'bedrag': tx['bedrag'],
+            'datum': tx['datum'],
+            'betaalmethode': 'bank',
+            'referentie': (tx['bankreferentie'] or koppelaar.facturen[(soort, factuur_id)][0])[:100],
+        }))
+
+    if gekoppeld:
+        ids = db.session.execute(
+            insert(Betaling).returning(Betaling.id, sort_by_parameter_order=True), [b for _, b in gekoppeld]
+        ).scalars().all()
+        per_factuur = {'verkoop': defaultdict(float), 'inkoop': defaultdict(float)}
+        for (tx, betaling), betaling_id in zip(gekoppeld, ids):
+            tx['betaling_id'] = betaling['id'] = betaling_id
+            per_factuur[betaling['factuur_type']][betaling['factuur_id']] += betaling['bedrag']
+        for type_ in ('inkomend', 'uitgaand'):
+            boek_reeks(f'betaling_{type_}', [SimpleNamespace(**b) for _, b in gekoppeld if b['type'] == type_])
+        for soort, bedragen in per_factuur.items():
+            verwerk_betalingen(soort, bedragen)
+
+    if nieuw:
+        db.session.execute(insert(Banktransactie), nieuw)
+    resultaat['gekoppeld'] += len(gekoppeld)
+    resultaat['te_beoordelen'] += len(nieuw) - len(gekoppeld)
+
+
+def importeer_afschrift(bestandsnaam, bron):
+    """Lees een afschrift in, koppel de transacties en geef een overzicht met aantallen terug.
+
+    Het bestand wordt per blok gelezen en verwerkt, alle blokken in één transactie. Een
+    fout in het bestand (ValueError of SyntaxError) draait ook de eerdere blokken terug.
+    """
+    begin = time.perf_counter()
+    transacties = _met_sleutels(lees_afschrift(bestandsnaam, bron), bestandsnaam)
+    koppelaar = Koppelaar()
+    resultaat = {'transacties': 0, 'gekoppeld': 0, 'te_beoordelen': 0, 'dubbel': 0}
+    try:
+        while True:
+            blok = list(islice(transacties, IMPORT_BLOK))
+            if not blok:
+                break
+            resultaat['transacties'] += len(blok)
+            _verwerk_blok(blok, koppelaar, resultaat)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    resultaat['seconden'] = round(time.perf_counter() - begin, 2)
+    return resultaat
+
+
+def koppel_handmatig(transactie, factuurnummer):
+    """Koppel een te beoordelen transactie aan een open factuur op nummer. Geeft de betaling terug.
+
+    Dezelfde voorwaarden als bij automatisch koppelen: de factuur staat open en het bedrag
+    is niet hoger dan het openstaande bedrag. Inkoopfactuurnummers zijn alleen per
+    leverancier uniek; die worden beperkt tot de leverancier met de IBAN van de tegenpartij. Geeft een ValueError als er geen of meer dan één factuur overblijft.
+    """
+    soort, type_ = RICHTINGEN[transactie.richting]
+    model = Verkoopfactuur if soort == 'verkoop' else Inkoopfactuur
+    nummer = factuurnummer.strip()
+    facturen = model.query.filter(model.factuurnummer == nummer, model.status.in_(OPEN_STATUSSEN[soort])).all()
+    if soort == 'inkoop' and transactie.iban:
+        facturen = [f for f in facturen if normaliseer_iban(f.leverancier.iban) == transactie.iban]
+    if not facturen:
+        raise ValueError(f'Er is geen openstaande {soort}factuur {nummer}.')
+    if len(facturen) > 1:
+        raise ValueError(f'{soort.capitalize()}factuurnummer {nummer} komt bij meerdere leveranciers voor; '
+                         f'registreer de betaling bij de juiste factuur.')
+    factuur = facturen[0]
+    if transactie.bedrag > factuur.openstaand + 0.01:
+        raise ValueError(f'Het bedrag (€ {transactie.bedrag:,.2f}) is hoger dan het openstaande bedrag '
+                         f'van {factuur.factuurnummer} (€ {factuur.openstaand:,.2f}).')
+
+    betaling = Betaling(type=type_, factuur_type=soort, factuur_id=factuur.id, bedrag=transactie.bedrag,
+                        datum=transactie.datum, betaalmethode='bank',
+                        referentie=(transactie.bankreferentie or factuur.factuurnummer)[:100])
+    db.session.add(betaling)
+    db.session.flush()
+    boek(f'betaling_{type_}', betaling)
+    verwerk_betalingen(soort, {factuur.id: betaling.bedrag})
+    transactie.status = 'gekoppeld'
+    transactie.koppeling = 'handmatig'
+    transactie.betaling_id = betaling.id
+    db.session.commit()
+    return betaling
@@ -0,0 +1,127 @@
+"""Boekingsregels: welke journaalpost bij welke gebeurtenis hoort.
+
+Per soort gebeurtenis staat vast op welke grootboekrekeningen gedebiteerd en
+gecrediteerd wordt. Rekeningcodes worden via een cache per proces naar id's
+vertaald; de cache wordt geleegd zodra het rekeningschema wijzigt.
+
+Elke regel wordt geboekt, ook met bedrag 0, behalve de BTW-regels: die vervallen
+bij een factuur zonder BTW ('weglaten_bij_nul').
+"""
+
+from sqlalchemy import event, insert
+from models import db, Grootboekrekening, Journaalpost, JournaalpostRegel
+from utils.saldi import werk_saldi_bij
+
+
+BOEKINGSREGELS = {
+    'verkoop': {
+        'datum': lambda f: f.factuurdatum,
+        'omschrijving': lambda f: f'Verkoopfactuur {f.factuurnummer}',
+        'referentie': lambda f: f.factuurnummer,
+        'regels': [
+            ('1200', 'debet', lambda f: f.totaal),        # Debiteuren
+            ('8000', 'credit', lambda f: f.subtotaal),    # Omzet
+            ('2100', 'credit', lambda f: f.btw_bedrag),   # BTW af te dragen
+        ],
+        'weglaten_bij_nul': ('2100',),
+    },
+    'inkoop': {
+        'datum': lambda f: f.factuurdatum,
+        'omschrijving': lambda f: f'Inkoopfactuur {f.factuurnummer}',
+        'referentie': lambda f: f.factuurnummer,
+        'regels': [
+            ('4000', 'debet', lambda f: f.subtotaal),     # Inkoopkosten
+            ('2200', 'debet', lambda f: f.btw_bedrag),    # BTW te vorderen
+            ('2000', 'credit', lambda f: f.totaal),       # Crediteuren
+        ],
+        'weglaten_bij_nul': ('2200',),
+    },
+    'betaling_inkomend': {
+        'datum': lambda b: b.datum,
+        'omschrijving': lambda b: f'Betaling {b.referentie or b.id}',
+        'referentie': lambda b: b.referentie,
+        'regels': [
+            ('1100', 'debet', lambda b: b.bedrag),        # Bank
+            ('1200', 'credit', lambda b: b.bedrag),       # Debiteuren
+        ],
+    },
+    'betaling_uitgaand': {
+        'datum': lambda b: b.datum,
+        'omschrijving': lambda b: f'Betaling {b.referentie or b.id}',
+        'referentie': lambda b: b.referentie,
+        'regels': [
+            ('2000', 'debet', lambda b: b.bedrag),        # Crediteuren
+            ('1100', 'credit', lambda b: b.bedrag),       # Bank
+        ],
+    },
+}
+
+
+_rekening_ids = {}
+
+
+def rekening_id(code):
+    """Id van de grootboekrekening met deze code, of None als die niet bestaat."""
+    if code not in _rekening_ids:
+        _rekening_ids.clear()
+        _rekening_ids.update(db.session.query(Grootboekrekening.code, Grootboekrekening.id).all())
+    return _rekening_ids.get(code)
+
+
+def leeg_rekeningcache(*args):
+    _rekening_ids.clear()
+
+
+for _gebeurtenis in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Grootboekrekening, _gebeurtenis, leeg_rekeningcache)
+
+
+def boek_reeks(soort, bronnen):
+    """Maak journaalposten voor een reeks bronobjecten (facturen of betalingen) van één soort.
+
+    Alle posten en regels worden met twee bulk-inserts geschreven. Ontbreekt een van de
+    rekeningen in het rekeningschema, dan volgt een ValueError voordat er iets geboekt is.
+    Geeft de journaalpost-id's terug.
+    """
+    bronnen = list(bronnen)
+    if not bronnen:
+        return []
+    boeking = BOEKINGSREGELS[soort]
+    rek_ids = {code: rekening_id(code) for code, _, _ in boeking['regels']}
+    ontbrekend = sorted(code for code, rek_id in rek_ids.items() if rek_id is None)
+    if ontbrekend:
+        raise ValueError(f"Grootboekrekening {', '.join(ontbrekend)} ontbreekt in het rekeningschema; "
+                         f"boeking '{soort}' is niet mogelijk.")
+    weglaten_bij_nul = boeking.get('weglaten_bij_nul', ())
+
+    posten = [{
+        'datum': boeking['datum'](bron),
+        'omschrijving': boeking['omschrijving'](bron),
+        'referentie': boeking['referentie'](bron),
+    } for bron in bronnen]
+    jp_ids = db.session.execute(
+        insert(Journaalpost).returning(Journaalpost.id, sort_by_parameter_order=True), posten
+    ).scalars().all()
+
+    regels = []
+    for jp_id, bron in zip(jp_ids, bronnen):
+        for code, kant, bedrag in boeking['regels']:
+            waarde = bedrag(bron) or 0
+            if not waarde and code in weglaten_bij_nul:
+                continue
+            regels.append({
+                'journaalpost_id': jp_id,
+                'grootboekrekening_id': rek_ids[code],
+                'debet': waarde if kant == 'debet' else 0,
+                'credit': waarde if kant == 'credit' else 0,
+            })
+    if regels:
+        db.session.execute(insert(JournaalpostRegel), regels)
+        werk_saldi_bij(min(p['datum'] for p in posten),
+                       [(r['grootboekrekening_id'], r['debet'], r['credit']) for r in regels])
+    return jp_ids
+
+
+def boek(soort, bron):
+    """Maak de journaalpost voor één factuur of betaling. Geeft het journaalpost-id terug."""
+    return boek_reeks(soort, [bron])[0]
@@ -1,5 +1,7 @@
 """BTW-tarieven en berekeningen voor Nederlandse boekhouding."""
 
+import numpy as np
+
 BTW_TARIEVEN = {
     21.0: 'Hoog tarief (21%)',
     9.0: 'Laag tarief (9%)',
@@ -34,3 +36,20 @@ def bereken_factuur_totalen(regels):
         'btw_bedrag': round(btw_bedrag, 2),
         'totaal': round(subtotaal + btw_bedrag, 2),
     }
+
+
+def bereken_regelbedragen(aantallen, prijzen, percentages):
+    """Netto, BTW en totaal voor arrays van factuurregels in één keer.
+
+    De BTW wordt per regel op centen afgerond met dezelfde uitkomst als bereken_btw:
+    np.round rekent via bedrag * 100 en kan daardoor bij bedragen op een halve cent
+    anders uitkomen dan round(); die paar regels worden met round() nagerekend.
+    """
+    with np.errstate(invalid='ignore'):  # NaN/oneindig laat de aanroeper afkeuren
+        netto = aantallen * prijzen
+        bedragen = netto * (percentages / 100)
+        btw = np.round(bedragen, 2)
+        centen = bedragen * 100
+        twijfel = np.flatnonzero(np.abs(np.abs(centen - np.floor(centen)) - 0.5) < 1e-6)
+    btw[twijfel] = [round(bedrag, 2) for bedrag in bedragen[twijfel].tolist()]
+    return netto, btw, netto + btw
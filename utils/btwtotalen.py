@@ -0,0 +1,160 @@
+"""BTW-totalen per maand, soort (verkoop/inkoop) en tarief.
+
+De tabel btw_totaal wordt bijgewerkt zodra een factuur voor de aangifte meetelt
+(verkoopfacturen vanaf verzenden, inkoopfacturen vanaf registratie) en wanneer zo'n
+factuur wordt bewerkt of verwijderd. De aangifte telt daardoor per kwartaal of jaar
+alleen een handvol rijen op in plaats van alle factuurregels. herbereken_btw() bouwt
+de tabel opnieuw op vanuit de facturen.
+"""
+
+from sqlalchemy import bindparam, extract, func, update
+from models import (db, BtwTotaal, Verkoopfactuur, VerkoopfactuurRegel, Inkoopfactuur,
+                    InkoopfactuurRegel)
+
+HOOG_TARIEF = 21.0
+LAAG_TARIEVEN = (9.0, 6.0)
+
+# Rubrieken van de aangifte omzetbelasting die uit de facturen volgen
+RUBRIEKEN = {
+    '1a': 'Leveringen/diensten belast met hoog tarief',
+    '1b': 'Leveringen/diensten belast met laag tarief',
+    '1c': 'Leveringen/diensten belast met overige tarieven, behalve 0%',
+    '1e': 'Leveringen/diensten belast met 0% of niet bij u belast',
+    '5a': 'Verschuldigde omzetbelasting (rubrieken 1a t/m 4b)',
+    '5b': 'Voorbelasting',
+    '5c': 'Subtotaal (rubriek 5a min 5b)',
+}
+
+_BRONNEN = {
+    'verkoop': (Verkoopfactuur, VerkoopfactuurRegel),
+    'inkoop': (Inkoopfactuur, InkoopfactuurRegel),
+}
+
+
+def telt_mee(soort, factuur):
+    """Verkoopfacturen tellen mee vanaf verzenden, inkoopfacturen direct."""
+    return soort == 'inkoop' or factuur.status != 'concept'
+
+
+def regel_bedragen(aantal, prijs_per_stuk, totaal):
+    """(netto, btw) van een factuurregel; de btw is zoals per regel afgerond opgeslagen."""
+    netto = aantal * prijs_per_stuk
+    return netto, (totaal or 0) - netto
+
+
+def werk_btw_bij(bijdragen, teken=1):
+    """Verwerk factuurregels in btw_totaal, binnen de lopende transactie.
+
+    bijdragen: iterable van (soort, factuurdatum, btw_percentage, netto, btw)
+    teken: 1 om toe te voegen, -1 om eerder verwerkte regels weer af te trekken
+    """
+    mutaties = {}
+    for soort, datum, percentage, netto, btw in bijdragen:
+        totaal = mutaties.setdefault((datum.year, datum.month, soort, float(percentage)), [0.0, 0.0, 0])
+        totaal[0] += teken * netto
+        totaal[1] += teken * btw
+        totaal[2] += teken
+    if not mutaties:
+        return
+
+    # Eén executemany voor alle cellen; ontbrekende rijen daarna aanvullen
+    tabel = BtwTotaal.__table__
+    resultaat = db.session.execute(
+        update(tabel)
+        .where(tabel.c.jaar == bindparam('k_jaar'), tabel.c.maand == bindparam('k_maand'),
+               tabel.c.soort == bindparam('k_soort'), tabel.c.btw_percentage == bindparam('k_percentage'))
+        .values(netto=tabel.c.netto + bindparam('mutatie_netto'),
+                btw=tabel.c.btw + bindparam('mutatie_btw'),
+                aantal_regels=tabel.c.aantal_regels + bindparam('mutatie_aantal')),
+        [{'k_jaar': jaar, 'k_maand': maand, 'k_soort': soort, 'k_percentage': percentage,
+          'mutatie_netto': netto, 'mutatie_btw': btw, 'mutatie_aantal': aantal}
+         for (jaar, maand, soort, percentage), (netto, btw, aantal) in mutaties.items()]
+    )
+    if resultaat.rowcount != len(mutaties):
+        bestaand = {(r.jaar, r.maand, r.soort, r.btw_percentage) for r in db.session.query(
+            BtwTotaal.jaar, BtwTotaal.maand, BtwTotaal.soort, BtwTotaal.btw_percentage
+        ).filter(BtwTotaal.jaar.in_({sleutel[0] for sleutel in mutaties}))}
+        for (jaar, maand, soort, percentage), (netto, btw, aantal) in mutaties.items():
+            if (jaar, maand, soort, percentage) not in bestaand:
+                db.session.add(BtwTotaal(jaar=jaar, maand=maand, soort=soort, btw_percentage=percentage,
+                                         netto=netto, btw=btw, aantal_regels=aantal))
+
+
+def boek_btw(soort, factuur, teken=1):
+    """Tel de regels van een factuur op (of met teken=-1 af) als de factuur meetelt.
+
+    Bij bewerken: eerst met teken=-1 aanroepen op de oude gegevens, daarna met de nieuwe.
+    """
+    if not telt_mee(soort, factuur):
+        return
+    werk_btw_bij([(soort, factuur.factuurdatum, r.btw_percentage,
+                   *regel_bedragen(r.aantal, r.prijs_per_stuk, r.totaal)) for r in factuur.regels], teken)
+
+
+def herbereken_btw():
+    """Bouw btw_totaal opnieuw op vanuit alle facturen. Geeft het aantal rijen terug."""
+    db.session.query(BtwTotaal).delete()
+    rijen = []
+    for soort, (model, regel_model) in _BRONNEN.items():
+        netto = regel_model.aantal * regel_model.prijs_per_stuk
+        jaar = extract('year', model.factuurdatum)
+        maand = extract('month', model.factuurdatum)
+        query = db.session.query(
+            jaar, maand, regel_model.btw_percentage,
+            func.sum(netto), func.sum(func.coalesce(regel_model.totaal, 0) - netto), func.count(regel_model.id),
+        ).join(model, model.id == regel_model.factuur_id)
+        if soort == 'verkoop':
+            query = query.filter(model.status != 'concept')
+        for j, m, percentage, som_netto, som_btw, aantal in query.group_by(jaar, maand, regel_model.btw_percentage):
+            rijen.append(BtwTotaal(jaar=int(j), maand=int(m), soort=soort, btw_percentage=float(percentage),
+                                   netto=som_netto or 0, btw=som_btw or 0, aantal_regels=aantal))
+    db.session.add_all(rijen)
+    db.session.commit()
+    return len(rijen)
+
+
+def btw_per_tarief(jaar, maand_van=1, maand_tot=12):
+    """Totalen per soort en tarief over de maanden: {'verkoop': [rij], 'inkoop': [rij]}.
+
+    Elke rij heeft btw_percentage, netto en btw.
+    """
+    rijen = db.session.query(
+        BtwTotaal.soort, BtwTotaal.btw_percentage,
+        func.sum(BtwTotaal.netto).label('netto'), func.sum(BtwTotaal.btw).label('btw'),
+    ).filter(
+        BtwTotaal.jaar == jaar, BtwTotaal.maand >= maand_van, BtwTotaal.maand <= maand_tot,
+    ).group_by(BtwTotaal.soort, BtwTotaal.btw_percentage).having(
+        func.sum(BtwTotaal.aantal_regels) > 0
+    ).order_by(BtwTotaal.soort, BtwTotaal.btw_percentage.desc()).all()
+    per_soort = {'verkoop': [], 'inkoop': []}
+    for rij in rijen:
+        per_soort[rij.soort].append(rij)
+    return per_soort
+
+
+def rubriek_van_tarief(percentage):
+    if percentage == HOOG_TARIEF:
+        return '1a'
+    if percentage in LAAG_TARIEVEN:
+        return '1b'
+    return '1e' if percentage == 0 else '1c'
+
+
+def aangifte_rubrieken(per_soort):
+    """Rubrieken van de aangifte: [(code, omschrijving, grondslag, btw)], grondslag None waar niet van toepassing."""
+    bedragen = {code: [0.0, 0.0] for code in ('1a', '1b', '1c', '1e')}
+    for rij in per_soort['verkoop']:
+        bedrag = bedragen[rubriek_van_tarief(rij.btw_percentage)]
+        bedrag[0] += rij.netto or 0
+        bedrag[1] += rij.btw or 0
+    verschuldigd = sum(btw for _, btw in bedragen.values())
+    voorbelasting = sum(rij.btw or 0 for rij in per_soort['inkoop'])
+
+    rubrieken = [(code, RUBRIEKEN[code], round(grondslag, 2), round(btw, 2))
+                 for code, (grondslag, btw) in bedragen.items()]
+    rubrieken += [
+        ('5a', RUBRIEKEN['5a'], None, round(verschuldigd, 2)),
+        ('5b', RUBRIEKEN['5b'], None, round(voorbelasting, 2)),
+        ('5c', RUBRIEKEN['5c'], None, round(verschuldigd - voorbelasting, 2)),
+    ]
+    return rubrieken
@@ -0,0 +1,191 @@
+"""Gestreamde CSV-exports.
+
+Regels worden per stuk naar de client geschreven in plaats van eerst het hele bestand
+in het geheugen op te bouwen, zodat ook grote exports direct beginnen te downloaden.
+De rapporten in CSV_RAPPORTEN lezen hun rijen in blokken van BLOK (yield_per, bij
+Postgres met een server-side cursor); het geheugengebruik hangt daardoor niet af van
+het aantal regels.
+"""
+
+import csv
+from datetime import timedelta
+from itertools import chain
+from flask import Response, stream_with_context
+from sqlalchemy import select
+from models import (db, Grootboekrekening, Journaalpost, JournaalpostRegel, Verkoopfactuur,
+                    VerkoopfactuurRegel, Inkoopfactuur, InkoopfactuurRegel, Klant, Leverancier)
+from utils.saldi import saldi_per_rekening, saldi_per_type
+
+BLOK = 1000
+
+
+class _Regelbuffer:
+    """Minimaal bestandsobject voor csv.writer: onthoudt alleen de laatst geschreven regel."""
+
+    def write(self, waarde):
+        self.regel = waarde
+
+
+def csv_regels(kop, rijen):
+    """Genereer de CSV-tekst (puntkomma-gescheiden, zoals Excel in NL verwacht) regel voor regel."""
+    buffer = _Regelbuffer()
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(kop)
+    yield buffer.regel
+    for rij in rijen:
+        writer.writerow(rij)
+        yield buffer.regel
+
+
+def stream_csv(kop, rijen, bestandsnaam):
+    """Response die de rijen als CSV-bijlage streamt; rijen mag een generator zijn."""
+    return Response(
+        stream_with_context(csv_regels(kop, rijen)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={bestandsnaam}'}
+    )
+
+
+def _stroom(query):
+    return db.session.execute(query.execution_options(yield_per=BLOK))
+
+
+def _bedrag(waarde):
+    return f"{waarde or 0:.2f}"
+
+
+def _balans(van_datum=None, tot_datum=None, rekening=None):
+    per_type = saldi_per_type(tot_datum=tot_datum)
+    rijen = ([type_, r['code'], r['naam'], _bedrag(r['saldo'])]
+             for type_ in ('activa', 'passiva') for r in per_type[type_][0])
+    return ['Type', 'Code', 'Naam', 'Saldo'], rijen
+
+
+def _winstverlies(van_datum=None, tot_datum=None, rekening=None):
+    per_type = saldi_per_type(van_datum=van_datum, tot_datum=tot_datum)
+    rijen = ([type_, r['code'], r['naam'], _bedrag(-r['saldo'] if type_ == 'opbrengsten' else r['saldo'])]
+             for type_ in ('opbrengsten', 'kosten') for r in per_type[type_][0])
+    return ['Type', 'Code', 'Naam', 'Saldo'], rijen
+
+
+def _openstaand(model, relatie, statussen):
+    query = (
+        select(model.factuurnummer, relatie.naam, model.factuurdatum, model.vervaldatum,
+               model.totaal, model.openstaand, model.status)
+        .join(relatie)
+        .where(model.status.in_(statussen))
+        .order_by(model.vervaldatum, model.id)
+    )
+    for nummer, naam, factuurdatum, vervaldatum, totaal, openstaand, status in _stroom(query):
+        yield [nummer, naam, factuurdatum, vervaldatum, _bedrag(totaal), _bedrag(openstaand), status]
+
+
+def _debiteuren(van_datum=None, tot_datum=None, rekening=None):
+    kop = ['Factuurnummer', 'Klant', 'Factuurdatum', 'Vervaldatum', 'Totaal', 'Openstaand', 'Status']
+    return kop, _openstaand(Verkoopfactuur, Klant, ['verzonden', 'vervallen'])
+
+
+def _crediteuren(van_datum=None, tot_datum=None, rekening=None):
+    kop = ['Factuurnummer', 'Leverancier', 'Factuurdatum', 'Vervaldatum', 'Totaal', 'Openstaand', 'Status']
+    return kop, _openstaand(Inkoopfactuur, Leverancier, ['ontvangen', 'goedgekeurd', 'vervallen'])
+
+
+def _journaal(van_datum=None, tot_datum=None, rekening=None):
+    """Alle journaalregels met hun post, op datum en boekingsvolgorde."""
+    query = (
+        select(Journaalpost.id, Journaalpost.datum, Journaalpost.omschrijving, Journaalpost.referentie,
+               Grootboekrekening.code, Grootboekrekening.naam, JournaalpostRegel.debet, JournaalpostRegel.credit)
+        .join(JournaalpostRegel, JournaalpostRegel.journaalpost_id == Journaalpost.id)
+        .join(Grootboekrekening, Grootboekrekening.id == JournaalpostRegel.grootboekrekening_id)
+        .order_by(Journaalpost.datum, Journaalpost.id, JournaalpostRegel.id)
+    )
+    if van_datum:
+        query = query.where(Journaalpost.datum >= van_datum)
+    if tot_datum:
+        query = query.where(Journaalpost.datum <= tot_datum)
+
+    def rijen():
+        for post_id, datum, omschrijving, referentie, code, naam, debet, credit in _stroom(query):
+            yield [post_id, datum, omschrijving, referentie or '', code, naam, _bedrag(debet), _bedrag(credit)]
+
+    return ['Boekstuk', 'Datum', 'Omschrijving', 'Referentie', 'Rekening', 'Rekeningnaam', 'Debet', 'Credit'], rijen()
+
+
+def _mutaties(van_datum=None, tot_datum=None, rekening=None):
+    """Mutaties per grootboekrekening (of één rekening, op code) met lopend saldo.
+
+    Het beginsaldo per rekening komt uit één query op de stand van de dag voor van_datum.
+    """
+    query = (
+        select(Grootboekrekening.id, Grootboekrekening.code, Grootboekrekening.naam, Journaalpost.datum,
+               Journaalpost.id, Journaalpost.omschrijving, JournaalpostRegel.debet, JournaalpostRegel.credit)
+        .join(JournaalpostRegel, JournaalpostRegel.grootboekrekening_id == Grootboekrekening.id)
+        .join(Journaalpost, Journaalpost.id == JournaalpostRegel.journaalpost_id)
+        .order_by(Grootboekrekening.code, Journaalpost.datum, JournaalpostRegel.id)
+    )
+    if rekening:
+        query = query.where(Grootboekrekening.code == rekening)
+    if van_datum:
+        query = query.where(Journaalpost.datum >= van_datum)
+    if tot_datum:
+        query = query.where(Journaalpost.datum <= tot_datum)
+
+    def rijen():
+        begin = {}
+        if van_datum:
+            begin = {r['id']: r['saldo'] for r in saldi_per_rekening(tot_datum=van_datum - timedelta(days=1))}
+        huidige, saldo = None, 0.0
+        for rek_id, code, naam, datum, post_id, omschrijving, debet, credit in _stroom(query):
+            if rek_id != huidige:
+                huidige, saldo = rek_id, begin.get(rek_id, 0.0)
+            saldo += (debet or 0) - (credit or 0)
+            yield [code, naam, datum, post_id, omschrijving, _bedrag(debet), _bedrag(credit), _bedrag(saldo)]
+
+    return ['Rekening', 'Rekeningnaam', 'Datum', 'Boekstuk', 'Omschrijving', 'Debet', 'Credit', 'Saldo'], rijen()
+
+
+def _regels(soort, model, regel_model, relatie, van_datum, tot_datum):
+    query = (
+        select(model.factuurnummer, model.factuurdatum, relatie.naam, model.status, regel_model.omschrijving,
+               regel_model.aantal, regel_model.prijs_per_stuk, regel_model.btw_percentage, regel_model.totaal,
+               Grootboekrekening.code)
+        .join(model, model.id == regel_model.factuur_id)
+        .join(relatie)
+        .outerjoin(Grootboekrekening, Grootboekrekening.id == regel_model.grootboekrekening_id)
+        .order_by(model.factuurdatum, model.id, regel_model.id)
+    )
+    if van_datum:
+        query = query.where(model.factuurdatum >= van_datum)
+    if tot_datum:
+        query = query.where(model.factuurdatum <= tot_datum)
+    for nummer, datum, naam, status, omschrijving, aantal, prijs, percentage, totaal, code in _stroom(query):
+        netto = aantal * prijs
+        yield [soort, nummer, datum, naam, status, omschrijving, aantal, _bedrag(prijs), percentage,
+               _bedrag(netto), _bedrag((totaal or 0) - netto), _bedrag(totaal), code or '']
+
+
+def _factuurregels(van_datum=None, tot_datum=None, rekening=None):
+    kop = ['Soort', 'Factuurnummer', 'Factuurdatum', 'Relatie', 'Status', 'Omschrijving', 'Aantal',
+           'Prijs per stuk', 'BTW %', 'Netto', 'BTW', 'Totaal', 'Grootboekrekening']
+    return kop, chain(
+        _regels('verkoop', Verkoopfactuur, VerkoopfactuurRegel, Klant, van_datum, tot_datum),
+        _regels('inkoop', Inkoopfactuur, InkoopfactuurRegel, Leverancier, van_datum, tot_datum),
+    )
+
+
+# rapport -> functie(van_datum, tot_datum, rekening) die (kop, rijen) teruggeeft
+CSV_RAPPORTEN = {
+    'balans': _balans,
+    'winstverlies': _winstverlies,
+    'debiteuren': _debiteuren,
+    'crediteuren': _crediteuren,
+    'journaal': _journaal,
+    'mutaties': _mutaties,
+    'factuurregels': _factuurregels,
+}
+
+
+def csv_rapport(rapport, van_datum=None, tot_datum=None, rekening=None):
+    """(kop, rijen) van een CSV-rapport; rijen is een generator. None voor een onbekend rapport."""
+    maak = CSV_RAPPORTEN.get(rapport)
+    return maak(van_datum, tot_datum, rekening) if maak else None
@@ -0,0 +1,20 @@
+"""Hulpfuncties voor datumfilters in overzichten en rapportages."""
+
+from datetime import date
+from flask import request
+
+
+def datum_uit_tekst(waarde):
+    """Zet een ISO-datum (JJJJ-MM-DD) om naar een date. Lege of ongeldige waarden geven None."""
+    waarde = (waarde or '').strip()
+    if not waarde:
+        return None
+    try:
+        return date.fromisoformat(waarde)
+    except ValueError:
+        return None
+
+
+def datum_uit_request(naam):
+    """Lees een ISO-datum (JJJJ-MM-DD) uit de querystring. Lege of ongeldige waarden geven None."""
+    return datum_uit_tekst(request.args.get(naam, ''))
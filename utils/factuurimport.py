@@ -0,0 +1,262 @@
+"""Bulkimport van verkoopfacturen uit CSV of JSON.
+
+CSV: één regel per factuurregel, puntkomma- of kommagescheiden, met kolommen
+referentie, klant_id of klant (naam), factuurdatum, vervaldatum, valuta, opmerkingen,
+omschrijving, aantal, prijs_per_stuk, btw_percentage en grootboekrekening (code).
+Regels met dezelfde referentie vormen samen één factuur; de kopvelden komen uit de
+eerste regel.
+
+JSON: een lijst facturen met dezelfde kopvelden en een lijst 'regels'.
+
+Alles wordt eerst gevalideerd; de regel- en factuurtotalen worden daarbij voor alle
+facturen tegelijk met NumPy-arrays uitgerekend. Daarna worden de factuurnummers in één blok uitgegeven
+en worden facturen, regels en (optioneel) journaalposten met bulk-inserts per blok
+van IMPORT_BLOK facturen weggeschreven, elk blok in een eigen transactie.
+"""
+
+import csv
+import io
+import json
+import time
+from datetime import date, timedelta
+import numpy as np
+from types import SimpleNamespace
+from sqlalchemy import insert
+from models import db, Klant, Valuta, Grootboekrekening, Verkoopfactuur, VerkoopfactuurRegel
+from utils.btw import BTW_TARIEVEN, bereken_regelbedragen
+from utils.boekingen import boek_reeks
+from utils.btwtotalen import werk_btw_bij, regel_bedragen
+from utils.nummering import reserveer_blok
+
+IMPORT_BLOK = 500
+
+KOPVELDEN = ('klant_id', 'klant', 'factuurdatum', 'vervaldatum', 'valuta', 'opmerkingen')
+REGELVELDEN = ('omschrijving', 'aantal', 'prijs_per_stuk', 'btw_percentage', 'grootboekrekening')
+
+
+def lees_csv(tekst):
+    """Zet CSV-tekst om naar facturen: [{'rij', 'kop', 'regels': [{'rij', ...}]}]."""
+    eerste_regel = tekst.split('\n', 1)[0]
+    reader = csv.DictReader(io.StringIO(tekst), delimiter=';' if ';' in eerste_regel else ',')
+    facturen = {}
+    for rij_nr, rij in enumerate(reader, start=2):
+        rij = {(k or '').strip().lower(): (v or '').strip() for k, v in rij.items()}
+        sleutel = rij.get('referentie') or f'rij {rij_nr}'
+        if sleutel not in facturen:
+            facturen[sleutel] = {'rij': rij_nr, 'kop': {k: rij.get(k, '') for k in KOPVELDEN}, 'regels': []}
+        facturen[sleutel]['regels'].append(dict({k: rij.get(k, '') for k in REGELVELDEN}, rij=rij_nr))
+    return list(facturen.values())
+
+
+def lees_json(tekst):
+    """Zet een JSON-lijst van facturen om naar hetzelfde formaat als lees_csv.
+
+    Geeft een ValueError (met factuur- en regelnummer) als de structuur niet klopt.
+    """
+    data = json.loads(tekst)
+    if not isinstance(data, list):
+        raise ValueError('verwacht een lijst van facturen')
+    facturen = []
+    for nr, item in enumerate(data, start=1):
+        if not isinstance(item, dict):
+            raise ValueError(f'factuur {nr} is geen object')
+        ruwe_regels = item.get('regels') or []
+        if not isinstance(ruwe_regels, list):
+            raise ValueError(f'factuur {nr}: regels moet een lijst zijn')
+        for i, r in enumerate(ruwe_regels, start=1):
+            if not isinstance(r, dict):
+                raise ValueError(f'regel {nr}.{i} is geen object')
+        regels = [dict({k: r.get(k, '') for k in REGELVELDEN}, rij=f'{nr}.{i}')
+                  for i, r in enumerate(ruwe_regels, start=1)]
+        facturen.append({'rij': nr, 'kop': {k: item.get(k, '') for k in KOPVELDEN}, 'regels': regels})
+    return facturen
+
+
+def lees_bestand(bestandsnaam, inhoud):
+    """Kies de parser op basis van de extensie; inhoud mag bytes of tekst zijn."""
+    if isinstance(inhoud, bytes):
+        inhoud = inhoud.decode('utf-8-sig')
+    if bestandsnaam.lower().endswith('.json'):
+        return lees_json(inhoud)
+    return lees_csv(inhoud)
+
+
+def _getal(waarde, veld, standaard=None):
+    if waarde in ('', None) and standaard is not None:
+        return standaard
+    try:
+        return float(str(waarde).replace(',', '.'))
+    except (TypeError, ValueError):
+        raise ValueError(f'{veld} "{waarde}" is geen getal')
+
+
+def _datum(waarde, veld):
+    try:
+        return date.fromisoformat(str(waarde))
+    except (TypeError, ValueError):
+        raise ValueError(f'{veld} "{waarde}" is geen geldige datum (JJJJ-MM-DD)')
+
+
+def valideer(facturen):
+    """Controleer alle facturen tegen de stamgegevens en reken de totalen uit.
+
+    Geeft (geldig, fouten) terug: geldig is een lijst van dicts met 'kop' (kolommen voor
+    verkoopfactuur) en 'regels' (kolommen voor verkoopfactuur_regel), fouten een lijst
+    van (rij, melding). Een factuur met een fout in één van de regels wordt overgeslagen.
+    """
+    klant_ids = {k_id for (k_id,) in db.session.query(Klant.id)}
+    klanten_op_naam = {naam.lower(): k_id for k_id, naam in db.session.query(Klant.id, Klant.naam)}
+    valutas = {code for (code,) in db.session.query(Valuta.code)}
+    rekeningen = dict(db.session.query(Grootboekrekening.code, Grootboekrekening.id))
+
+    geldig, fouten = [], []
+    for factuur in facturen:
+        kop, meldingen = factuur['kop'], []
+        try:
+            if kop.get('klant_id'):
+                try:
+                    klant_id = int(kop['klant_id'])
+                except (TypeError, ValueError):
+                    raise ValueError(f'klant_id "{kop["klant_id"]}" is geen getal')
+                if klant_id not in klant_ids:
+                    raise ValueError(f'klant {klant_id} bestaat niet')
+            elif kop.get('klant'):
+                klant_id = klanten_op_naam.get(str(kop['klant']).lower())
+                if klant_id is None:
+                    raise ValueError(f'klant "{kop["klant"]}" bestaat niet')
+            else:
+                raise ValueError('klant_id of klant ontbreekt')
+            factuurdatum = _datum(kop.get('factuurdatum'), 'factuurdatum')
+            vervaldatum = (_datum(kop['vervaldatum'], 'vervaldatum') if kop.get('vervaldatum')
+                           else factuurdatum + timedelta(days=30))
+            valuta = kop.get('valuta') or 'EUR'
+            if not isinstance(valuta, str) or valuta not in valutas:
+                raise ValueError(f'valuta {valuta} is onbekend')
+        except ValueError as e:
+            meldingen.append((factuur['rij'], str(e)))
+
+        regels = []
+        for regel in factuur['regels']:
+            try:
+                if not str(regel.get('omschrijving') or '').strip():
+                    raise ValueError('omschrijving ontbreekt')
+                aantal = _getal(regel.get('aantal'), 'aantal', standaard=1.0)
+                prijs = _getal(regel.get('prijs_per_stuk'), 'prijs_per_stuk')
+                btw_pct = _getal(regel.get('btw_percentage'), 'btw_percentage', standaard=21.0)
+                if btw_pct not in BTW_TARIEVEN:
+                    raise ValueError(f'btw_percentage {btw_pct:g} is geen geldig tarief')
+                gb_id = None
+                if regel.get('grootboekrekening'):
+                    gb_id = rekeningen.get(str(regel['grootboekrekening']))
+                    if gb_id is None:
+                        raise ValueError(f'grootboekrekening {regel["grootboekrekening"]} bestaat niet')
+                regels.append({
+                    'omschrijving': str(regel['omschrijving']).strip(),
+                    'aantal': aantal,
+                    'prijs_per_stuk': prijs,
+                    'btw_percentage': btw_pct,
+                    'grootboekrekening_id': gb_id,
+                    'rij': regel['rij'],
+                })
+            except ValueError as e:
+                meldingen.append((regel['rij'], str(e)))
+        if not factuur['regels']:
+            meldingen.append((factuur['rij'], 'factuur heeft geen regels'))
+
+        if meldingen:
+            fouten.extend(meldingen)
+            continue
+        geldig.append({
+            'kop': {
+                'klant_id': klant_id,
+                'factuurdatum': factuurdatum,
+                'vervaldatum': vervaldatum,
+                'valuta': valuta,
+                'opmerkingen': str(kop.get('opmerkingen') or ''),
+                'betaald': 0.0,
+            },
+            'regels': regels,
+        })
+    return _reken_totalen(geldig, fouten)
+
+
+def _reken_totalen(facturen, fouten):
+    """Reken regel- en factuurtotalen voor alle facturen in één NumPy-doorgang uit.
+
+    Facturen met een niet-eindig bedrag (NaN of oneindig) gaan alsnog naar fouten.
+    """
+    regels = [regel for factuur in facturen for regel in factuur['regels']]
+    if not regels:
+        return facturen, fouten
+    factuur_index = np.repeat(np.arange(len(facturen)), [len(f['regels']) for f in facturen])
+    netto, btw, totaal = bereken_regelbedragen(
+        np.array([r['aantal'] for r in regels]), np.array([r['prijs_per_stuk'] for r in regels]),
+        np.array([r['btw_percentage'] for r in regels]))
+
+    ongeldig = ~np.isfinite(totaal)
+    for i in np.flatnonzero(ongeldig):
+        fouten.append((regels[i]['rij'], 'bedrag is geen eindig getal'))
+    fout_facturen = set(factuur_index[ongeldig].tolist())
+
+    subtotalen = np.bincount(factuur_index, weights=np.where(ongeldig, 0, netto), minlength=len(facturen))
+    btw_totalen = np.bincount(factuur_index, weights=np.where(ongeldig, 0, btw), minlength=len(facturen))
+    for regel, regel_totaal in zip(regels, totaal.tolist()):
+        regel['totaal'] = regel_totaal
+        del regel['rij']
+
+    geldig = []
+    for i, factuur in enumerate(facturen):
+        if i in fout_facturen:
+            continue
+        subtotaal, btw_bedrag = float(subtotalen[i]), float(btw_totalen[i])
+        # Afronden zoals bereken_factuur_totalen
+        factuur['kop'].update(subtotaal=round(subtotaal, 2), btw_bedrag=round(btw_bedrag, 2),
+                              totaal=round(subtotaal + btw_bedrag, 2))
+        factuur['kop']['openstaand'] = factuur['kop']['totaal']
+        geldig.append(factuur)
+    return geldig, fouten
+
+
+def importeer_facturen(facturen, boeken=False, strikt=False):
+    """Valideer en importeer facturen. Met boeken=True worden ze direct verzonden en geboekt.
+
+    Met strikt=True wordt niets geïmporteerd zolang er fouten zijn. Geeft een dict met
+    aantallen, fouten, nummers en doorlooptijd terug.
+    """
+    begin = time.perf_counter()
+    geldig, fouten = valideer(facturen)
+    resultaat = {'facturen': 0, 'regels': 0, 'fouten': fouten, 'eerste': None, 'laatste': None}
+    if geldig and not (strikt and fouten):
+        # Nummers uitgeven voordat de sessie schrijft (zie utils.nummering)
+        nummers = reserveer_blok('VF', len(geldig))
+        for factuur, nummer in zip(geldig, nummers):
+            factuur['kop'].update(factuurnummer=nummer, status='verzonden' if boeken else 'concept')
+        resultaat['eerste'], resultaat['laatste'] = nummers[0], nummers[-1]
+
+        for start in range(0, len(geldig), IMPORT_BLOK):
+            blok = geldig[start:start + IMPORT_BLOK]
+            try:
+                koppen = [f['kop'] for f in blok]
+                ids = db.session.execute(
+                    insert(Verkoopfactuur).returning(Verkoopfactuur.id, sort_by_parameter_order=True), koppen
+                ).scalars().all()
+                regels = [dict(regel, factuur_id=factuur_id)
+                          for factuur_id, factuur in zip(ids, blok) for regel in factuur['regels']]
+                db.session.execute(insert(VerkoopfactuurRegel), regels)
+                if boeken:
+                    boek_reeks('verkoop', [SimpleNamespace(**kop) for kop in koppen])
+                    werk_btw_bij(('verkoop', factuur['kop']['factuurdatum'], regel['btw_percentage'],
+                                  *regel_bedragen(regel['aantal'], regel['prijs_per_stuk'], regel['totaal']))
+                                 for factuur in blok for regel in factuur['regels'])
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                fouten.append((f'factuur {start + 1}-{start + len(blok)}',
+                               f'opslaan mislukt, import gestopt: {e}'))
+                break
+            resultaat['facturen'] += len(blok)
+            resultaat['regels'] += len(regels)
+
+    resultaat['seconden'] = round(time.perf_counter() - begin, 2)
+    resultaat['regels_per_seconde'] = int(resultaat['regels'] / resultaat['seconden']) if resultaat['seconden'] else 0
+    return resultaat
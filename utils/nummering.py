@@ -0,0 +1,114 @@
+"""Doorlopende nummerreeksen voor facturen.
+
+Per prefix en jaar houdt de tabel nummerreeks het laatst uitgegeven nummer bij. Nummers
+worden in een eigen, korte transactie opgehoogd: op PostgreSQL houdt de UPDATE een
+rijlock vast, op SQLite wordt de transactie met BEGIN IMMEDIATE gestart. Zo krijgen
+gelijktijdige workers nooit hetzelfde nummer en blijft uitgifte O(1).
+
+Een nummer dat is uitgegeven maar waarvan de factuur niet wordt opgeslagen, blijft
+ongebruikt; ontbrekende_nummers() rapporteert zulke gaten. Op SQLite moet uitgifte
+plaatsvinden voordat de sessie zelf iets schrijft, anders wacht de eigen transactie
+op de schrijflock van de sessie.
+"""
+
+from contextlib import contextmanager
+from datetime import date
+from sqlalchemy import select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, Nummerreeks, Verkoopfactuur
+
+# Prefix -> kolom met de uitgegeven nummers (voor startwaarde en gatenrapport)
+REEKSEN = {
+    'VF': Verkoopfactuur.factuurnummer,
+}
+
+
+def formatteer(prefix, jaar, nummer):
+    return f'{prefix}{jaar}{nummer:04d}'
+
+
+@contextmanager
+def _eigen_transactie():
+    """Verbinding met een eigen transactie die direct de schrijflock neemt."""
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.exec_driver_sql('ROLLBACK')
+                raise
+            conn.exec_driver_sql('COMMIT')
+    else:
+        with db.engine.begin() as conn:
+            yield conn
+
+
+def _gebruikte_nummers(conn, prefix, jaar):
+    """Volgnummers die in de factuurtabel al voorkomen voor deze prefix en dit jaar."""
+    kolom = REEKSEN[prefix]
+    begin = f'{prefix}{jaar}'
+    nummers = set()
+    for (waarde,) in conn.execute(select(kolom).where(kolom.like(f'{begin}%'))):
+        rest = waarde[len(begin):]
+        if rest.isdigit():
+            nummers.add(int(rest))
+    return nummers
+
+
+def reserveer_nummers(prefix, aantal=1, jaar=None):
+    """Geef een aaneengesloten blok van `aantal` nieuwe volgnummers uit als lijst van ints.
+
+    Bestaat de reeks voor dit jaar nog niet, dan begint die na het hoogste nummer dat al
+    in de factuurtabel staat.
+    """
+    jaar = jaar or date.today().year
+    tabel = Nummerreeks.__table__
+    with _eigen_transactie() as conn:
+        laatste = conn.execute(
+            update(tabel)
+            .where(tabel.c.prefix == prefix, tabel.c.jaar == jaar)
+            .values(laatste=tabel.c.laatste + aantal)
+            .returning(tabel.c.laatste)
+        ).scalar()
+        if laatste is None:
+            start = max(_gebruikte_nummers(conn, prefix, jaar), default=0)
+            dialect_insert = postgresql.insert if conn.dialect.name == 'postgresql' else sqlite.insert
+            conn.execute(dialect_insert(tabel).values(prefix=prefix, jaar=jaar, laatste=start)
+                         .on_conflict_do_nothing(index_elements=['prefix', 'jaar']))
+            laatste = conn.execute(
+                update(tabel)
+                .where(tabel.c.prefix == prefix, tabel.c.jaar == jaar)
+                .values(laatste=tabel.c.laatste + aantal)
+                .returning(tabel.c.laatste)
+            ).scalar()
+    return list(range(laatste - aantal + 1, laatste + 1))
+
+
+def volgend_nummer(prefix, jaar=None):
+    """Geef één nieuw, geformatteerd nummer uit, bijvoorbeeld VF20260001."""
+    jaar = jaar or date.today().year
+    return formatteer(prefix, jaar, reserveer_nummers(prefix, 1, jaar)[0])
+
+
+def reserveer_blok(prefix, aantal, jaar=None):
+    """Geef `aantal` geformatteerde nummers uit voor bulkaanmaak."""
+    jaar = jaar or date.today().year
+    return [formatteer(prefix, jaar, nr) for nr in reserveer_nummers(prefix, aantal, jaar)]
+
+
+def ontbrekende_nummers(prefix, jaar=None):
+    """Uitgegeven maar ongebruikte nummers, als lijst van (van, tot) bereiken."""
+    jaar = jaar or date.today().year
+    laatste = db.session.query(Nummerreeks.laatste).filter_by(prefix=prefix, jaar=jaar).scalar() or 0
+    gebruikt = _gebruikte_nummers(db.session, prefix, jaar)
+
+    bereiken = []
+    for nummer in range(1, laatste + 1):
+        if nummer in gebruikt:
+            continue
+        if bereiken and bereiken[-1][1] == nummer - 1:
+            bereiken[-1][1] = nummer
+        else:
+            bereiken.append([nummer, nummer])
+    return [(formatteer(prefix, jaar, van), formatteer(prefix, jaar, tot)) for van, tot in bereiken]
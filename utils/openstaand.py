@@ -0,0 +1,110 @@
+"""Betaalde en openstaande bedragen en de vervalstatus van facturen.
+
+De kolommen betaald en openstaand worden bij elke betaling in dezelfde transactie
+bijgewerkt, zodat overzichten niet per factuur de betalingen hoeven op te tellen.
+De overgang naar 'vervallen' gebeurt periodiek in bulk (worker.py), niet bij het
+bekijken van een overzicht.
+"""
+
+from datetime import date
+from sqlalchemy import bindparam, func, select, update
+from models import db, Betaling, Verkoopfactuur, Inkoopfactuur
+
+FACTUURMODELLEN = {
+    'verkoop': Verkoopfactuur,
+    'inkoop': Inkoopfactuur,
+}
+
+
+def verwerk_betalingen(factuur_type, bedragen):
+    """Boek betaalde bedragen op facturen en zet volledig betaalde facturen op 'betaald'.
+
+    factuur_type: 'verkoop' of 'inkoop'
+    bedragen: dict van factuur_id naar betaald bedrag
+    """
+    if not bedragen:
+        return
+    tabel = FACTUURMODELLEN[factuur_type].__table__
+    db.session.execute(
+        update(tabel)
+        .where(tabel.c.id == bindparam('factuur_id'))
+        .values(betaald=tabel.c.betaald + bindparam('bedrag'),
+                openstaand=tabel.c.totaal - tabel.c.betaald - bindparam('bedrag')),
+        [{'factuur_id': factuur_id, 'bedrag': bedrag} for factuur_id, bedrag in bedragen.items()]
+    )
+    db.session.execute(
+        update(tabel)
+        .where(tabel.c.id.in_(list(bedragen)), tabel.c.openstaand <= 0.01)
+        .values(status='betaald')
+    )
+    # Geladen facturen tonen anders de oude bedragen
+    for obj in list(db.session.identity_map.values()):
+        if isinstance(obj, FACTUURMODELLEN[factuur_type]) and obj.id in bedragen:
+            db.session.expire(obj, ['betaald', 'openstaand', 'status'])
+
+
+def _betaald_subquery(factuur_type):
+    return select(
+        Betaling.factuur_id.label('factuur_id'),
+        func.sum(Betaling.bedrag).label('betaald'),
+    ).where(Betaling.factuur_type == factuur_type).group_by(Betaling.factuur_id).subquery()
+
+
+def controleer_openstaand(herstel=False):
+    """Vergelijk de opgeslagen bedragen met de som van de betalingen.
+
+    Geeft een lijst van (factuur_type, factuurnummer, opgeslagen, berekend) terug voor
+    facturen die afwijken. Met herstel=True worden alle facturen in twee UPDATE's
+    opnieuw berekend.
+    """
+    afwijkingen = []
+    for factuur_type, model in FACTUURMODELLEN.items():
+        betaald = _betaald_subquery(factuur_type)
+        berekend = func.coalesce(betaald.c.betaald, 0)
+        rijen = db.session.query(model.factuurnummer, model.betaald, berekend).outerjoin(
+            betaald, betaald.c.factuur_id == model.id
+        ).filter(
+            (func.abs(model.betaald - berekend) > 0.005) |
+            (func.abs(model.openstaand - (model.totaal - berekend)) > 0.005)
+        ).all()
+        afwijkingen.extend((factuur_type, nr, opgeslagen, round(som, 2)) for nr, opgeslagen, som in rijen)
+
+        if herstel:
+            som = select(func.coalesce(func.sum(Betaling.bedrag), 0)).where(
+                Betaling.factuur_type == factuur_type,
+                Betaling.factuur_id == model.id,
+            ).scalar_subquery()
+            db.session.execute(
+                update(model).values(betaald=som, openstaand=model.totaal - som)
+                .execution_options(synchronize_session=False)
+            )
+    if herstel:
+        db.session.commit()
+    return afwijkingen
+
+
+# Statussen die bij het verstrijken van de vervaldatum naar 'vervallen' gaan. Goedgekeurde
+# inkoopfacturen blijven goedgekeurd, anders vallen ze uit de betaalrun.
+VERVALBARE_STATUSSEN = {
+    'verkoop': ('verzonden',),
+    'inkoop': ('ontvangen',),
+}
+
+
+def markeer_vervallen(peildatum=None):
+    """Zet openstaande facturen met een verstreken vervaldatum op 'vervallen'.
+
+    Eén UPDATE per factuursoort; geeft {factuur_type: aantal gewijzigde facturen} terug.
+    """
+    peildatum = peildatum or date.today()
+    aantallen = {}
+    for factuur_type, model in FACTUURMODELLEN.items():
+        resultaat = db.session.execute(
+            update(model)
+            .where(model.status.in_(VERVALBARE_STATUSSEN[factuur_type]), model.vervaldatum < peildatum)
+            .values(status='vervallen')
+            .execution_options(synchronize_session=False)
+        )
+        aantallen[factuur_type] = resultaat.rowcount
+    db.session.commit()
+    return aantallen
@@ -0,0 +1,98 @@
+"""Ouderdomsanalyse van openstaande posten per klant of leverancier.
+
+Alle bedragen worden in één gegroepeerde query over de facturen berekend. De grenzen
+van de ouderdomsklassen worden vooraf in Python als datums bepaald, zodat de database
+alleen vervaldatums hoeft te vergelijken (index op status, vervaldatum).
+"""
+
+from datetime import date, timedelta
+from sqlalchemy import and_, case, func, select
+from models import db, Betaling, Klant, Leverancier, Verkoopfactuur, Inkoopfactuur
+
+KLASSEN = [
+    ('niet_vervallen', 'Niet vervallen'),
+    ('dagen_0_30', '0-30 dagen'),
+    ('dagen_31_60', '31-60 dagen'),
+    ('dagen_61_90', '61-90 dagen'),
+    ('dagen_90_plus', '> 90 dagen'),
+]
+
+SOORTEN = {
+    'debiteuren': {
+        'factuur': Verkoopfactuur, 'relatie': Klant, 'relatie_id': Verkoopfactuur.klant_id,
+        'factuur_type': 'verkoop', 'open': ('verzonden', 'vervallen'),
+    },
+    'crediteuren': {
+        'factuur': Inkoopfactuur, 'relatie': Leverancier, 'relatie_id': Inkoopfactuur.leverancier_id,
+        'factuur_type': 'inkoop', 'open': ('ontvangen', 'goedgekeurd', 'vervallen'),
+    },
+}
+
+
+def _open_posten(soort, peildatum):
+    """(from-clause, bedrag-expressie, filters) voor de posten die op peildatum openstaan.
+
+    Voor vandaag wordt het opgeslagen openstaande bedrag gebruikt; voor een datum in het
+    verleden worden de betalingen tot en met die datum per factuur opgeteld en afgetrokken.
+    """
+    instelling = SOORTEN[soort]
+    model = instelling['factuur']
+    if peildatum >= date.today():
+        return model, model.openstaand, [model.status.in_(instelling['open'])]
+
+    betaald = select(
+        Betaling.factuur_id.label('factuur_id'),
+        func.sum(Betaling.bedrag).label('betaald'),
+    ).where(
+        Betaling.factuur_type == instelling['factuur_type'],
+        Betaling.datum <= peildatum,
+    ).group_by(Betaling.factuur_id).subquery()
+    bedrag = model.totaal - func.coalesce(betaald.c.betaald, 0)
+    bron = model.__table__.outerjoin(betaald, betaald.c.factuur_id == model.id)
+    filters = [
+        model.status.in_(instelling['open'] + ('betaald',)),
+        model.factuurdatum <= peildatum,
+        bedrag > 0.005,
+    ]
+    return bron, bedrag, filters
+
+
+def ouderdom_query(soort, peildatum=None):
+    """Select met per relatie: id, naam, het bedrag per ouderdomsklasse, totaal en aantal posten."""
+    peildatum = peildatum or date.today()
+    instelling = SOORTEN[soort]
+    model, relatie = instelling['factuur'], instelling['relatie']
+    bron, bedrag, filters = _open_posten(soort, peildatum)
+
+    grens_30, grens_60, grens_90 = (peildatum - timedelta(days=n) for n in (30, 60, 90))
+    vervaldatum = model.vervaldatum
+    voorwaarden = {
+        'niet_vervallen': vervaldatum >= peildatum,
+        'dagen_0_30': and_(vervaldatum < peildatum, vervaldatum >= grens_30),
+        'dagen_31_60': and_(vervaldatum < grens_30, vervaldatum >= grens_60),
+        'dagen_61_90': and_(vervaldatum < grens_60, vervaldatum >= grens_90),
+        'dagen_90_plus': vervaldatum < grens_90,
+    }
+    kolommen = [func.sum(case((voorwaarden[klasse], bedrag), else_=0)).label(klasse)
+                for klasse, _ in KLASSEN]
+
+    return select(
+        relatie.id, relatie.naam, *kolommen,
+        func.sum(bedrag).label('totaal'),
+        func.count().label('aantal'),
+    ).select_from(bron).join(
+        relatie, relatie.id == instelling['relatie_id']
+    ).where(*filters).group_by(relatie.id, relatie.naam).order_by(relatie.naam)
+
+
+def ouderdomsanalyse(soort, peildatum=None):
+    """Geef (rijen, totalen) terug; elke rij is een dict met id, naam, klassen, totaal en aantal."""
+    rijen = []
+    totalen = dict.fromkeys([k for k, _ in KLASSEN] + ['totaal', 'aantal'], 0)
+    for rij in db.session.execute(ouderdom_query(soort, peildatum)).mappings():
+        rij = {sleutel: (round(waarde or 0, 2) if sleutel in totalen and sleutel != 'aantal' else waarde)
+               for sleutel, waarde in rij.items()}
+        for sleutel in totalen:
+            totalen[sleutel] += rij[sleutel]
+        rijen.append(rij)
+    return rijen, {sleutel: round(waarde, 2) for sleutel, waarde in totalen.items()}
@@ -1,13 +1,22 @@
 """PDF generatie voor facturen en rapportages."""
 
 from flask import render_template_string, current_app
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy.orm import selectinload
 import io
+import os
+import zipfile
+from models import Verkoopfactuur
+
+from utils import pdfcache
 
 try:
-    from weasyprint import HTML
+    from weasyprint import HTML, __version__ as WEASYPRINT_VERSIE
     WEASYPRINT_BESCHIKBAAR = True
 except (ImportError, OSError):
     WEASYPRINT_BESCHIKBAAR = False
+    WEASYPRINT_VERSIE = None
 
 
 FACTUUR_PDF_TEMPLATE = """
@@ -139,16 +148,113 @@ def genereer_factuur_html(factuur, klant):
     )
 
 
+def html_naar_pdf(html_content):
+    """Zet HTML om naar een PDF via de cache. Geeft (buffer, mimetype) terug.
+
+    Valt terug op de HTML zelf als WeasyPrint niet beschikbaar is.
+    """
+    if not WEASYPRINT_BESCHIKBAAR:
+        return io.BytesIO(html_content.encode('utf-8')), 'text/html'
+
+    sleutel = pdfcache.cache_sleutel(html_content, WEASYPRINT_VERSIE)
+    data = pdfcache.haal_op(sleutel)
+    if data is None:
+        data = HTML(string=html_content).write_pdf()
+        pdfcache.sla_op(sleutel, data)
+    return io.BytesIO(data), 'application/pdf'
+
+
 def genereer_factuur_pdf(factuur, klant):
     """Genereer een PDF voor een verkoopfactuur. Valt terug op HTML als WeasyPrint niet beschikbaar is."""
-    html_content = genereer_factuur_html(factuur, klant)
+    return html_naar_pdf(genereer_factuur_html(factuur, klant))
+
+
+def factuur_selectie(van_datum=None, tot_datum=None, status=None, klant_id=None):
+    """Query op verkoopfacturen voor een batch, met regels en klant vooraf geladen."""
+    query = Verkoopfactuur.query.options(
+        selectinload(Verkoopfactuur.regels), selectinload(Verkoopfactuur.klant)
+    )
+    if van_datum:
+        query = query.filter(Verkoopfactuur.factuurdatum >= van_datum)
+    if tot_datum:
+        query = query.filter(Verkoopfactuur.factuurdatum <= tot_datum)
+    if status:
+        query = query.filter(Verkoopfactuur.status == status)
+    if klant_id:
+        query = query.filter(Verkoopfactuur.klant_id == klant_id)
+    return query.order_by(Verkoopfactuur.factuurnummer)
+
+
+def _html_naar_pdf(html_content):
+    """Draait in een werkproces: zet HTML om naar PDF-bytes."""
+    return HTML(string=html_content).write_pdf()
+
+
+def _parallel_pdfs(facturen, max_workers=None):
+    """Geef (factuur, pdf-bytes) terug in volgorde, omgezet door een pool van werkprocessen.
 
+    De HTML wordt in dit proces gerenderd (template en database) en eerst in de cache
+    opgezocht; alleen het zware omzetten naar PDF gebeurt parallel. Er staan nooit meer
+    dan twee opdrachten per werkproces klaar, zodat het geheugengebruik begrensd blijft.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    wachtrij = deque()
+
+    def volgende():
+        factuur, sleutel, taak = wachtrij.popleft()
+        if isinstance(taak, bytes):
+            return factuur, taak
+        data = taak.result()
+        pdfcache.sla_op(sleutel, data)
+        return factuur, data
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        for factuur in facturen:
+            html_content = genereer_factuur_html(factuur, factuur.klant)
+            sleutel = pdfcache.cache_sleutel(html_content, WEASYPRINT_VERSIE)
+            taak = pdfcache.haal_op(sleutel) or pool.submit(_html_naar_pdf, html_content)
+            wachtrij.append((factuur, sleutel, taak))
+            if len(wachtrij) >= 2 * max_workers:
+                yield volgende()
+        while wachtrij:
+            yield volgende()
+
+
+class _ZipStroom:
+    """Schrijfbaar object voor zipfile dat de geschreven bytes verzamelt tot ze worden opgehaald."""
+
+    def __init__(self):
+        self.delen = []
+
+    def write(self, data):
+        self.delen.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def haal_op(self):
+        data = b''.join(self.delen)
+        self.delen = []
+        return data
+
+
+def factuur_zip_stroom(facturen, aantal=None, voortgang=None, max_workers=None):
+    """Genereer een ZIP met de factuur-PDF's als stroom van bytes, één bestand per keer.
+
+    Zonder WeasyPrint bevat de ZIP de HTML-versies. voortgang(klaar, aantal) wordt na
+    elke factuur aangeroepen.
+    """
     if WEASYPRINT_BESCHIKBAAR:
-        pdf_buffer = io.BytesIO()
-        HTML(string=html_content).write_pdf(pdf_buffer)
-        pdf_buffer.seek(0)
-        return pdf_buffer, 'application/pdf'
+        bestanden = ((f, pdf, 'pdf') for f, pdf in _parallel_pdfs(facturen, max_workers))
     else:
-        # Fallback: return HTML
-        html_buffer = io.BytesIO(html_content.encode('utf-8'))
-        return html_buffer, 'text/html'
+        bestanden = ((f, genereer_factuur_html(f, f.klant).encode('utf-8'), 'html') for f in facturen)
+
+    stroom = _ZipStroom()
+    with zipfile.ZipFile(stroom, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for klaar, (factuur, inhoud, ext) in enumerate(bestanden, start=1):
+            zf.writestr(f'{factuur.factuurnummer}.{ext}', inhoud)
+            if voortgang:
+                voortgang(klaar, aantal)
+            yield stroom.haal_op()
+    yield stroom.haal_op()
@@ -0,0 +1,142 @@
+"""Cache op schijf voor gerenderde PDF's.
+
+De sleutel is een SHA-256 over de gerenderde HTML (factuurkop, regels, bedrijfsgegevens
+en sjabloon zitten daar allemaal in) plus de sjabloon- en rendererversie. Een
+ongewijzigde factuur of rapportage wordt dus direct van schijf geserveerd; elke
+wijziging levert vanzelf een nieuwe sleutel op.
+
+Bestanden worden via een tijdelijk bestand en os.replace geschreven, zodat meerdere
+gunicorn-workers tegelijk veilig kunnen lezen en schrijven. Een treffer zet de mtime
+op nu; bij overschrijding van PDF_CACHE_MAX_MB worden de oudste bestanden verwijderd
+(LRU).
+
+Elk proces houdt een lopend totaal van de omvang bij en telt de map pas opnieuw als
+dat totaal boven het maximum komt, of na OPRUIM_INTERVAL schrijfacties (andere
+workers schrijven in dezelfde map). De tellers en het lopende totaal gelden per proces;
+/rapportages/pdf-cache toont dus de cijfers van de worker die het verzoek afhandelt.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from flask import current_app
+
+# Ophogen bij een inhoudelijke wijziging van de PDF-opmaak buiten de HTML om
+SJABLOONVERSIE = 1
+
+# Na zoveel schrijfacties de map opnieuw tellen, ook als het lopende totaal onder het maximum blijft
+OPRUIM_INTERVAL = 100
+
+_slot = threading.Lock()
+_tellers = {'hits': 0, 'misses': 0, 'opgeslagen': 0, 'verwijderd': 0}
+_omvang = {'bytes': None, 'schrijfacties': 0}  # lopend totaal sinds de laatste telling (None: nog niet geteld)
+
+
+def _map():
+    return current_app.config['PDF_CACHE_MAP']
+
+
+def _pad(sleutel):
+    return os.path.join(_map(), sleutel[:2], f'{sleutel}.pdf')
+
+
+def cache_sleutel(html_content, renderer=''):
+    h = hashlib.sha256(f'{SJABLOONVERSIE}|{renderer}|'.encode('utf-8'))
+    h.update(html_content.encode('utf-8'))
+    return h.hexdigest()
+
+
+def haal_op(sleutel):
+    """PDF-bytes uit de cache, of None."""
+    pad = _pad(sleutel)
+    try:
+        with open(pad, 'rb') as f:
+            data = f.read()
+        os.utime(pad)
+    except OSError:
+        _tel('misses')
+        return None
+    _tel('hits')
+    return data
+
+
+def _tel(teller, aantal=1):
+    with _slot:
+        _tellers[teller] += aantal
+
+
+def sla_op(sleutel, data):
+    """Schrijf PDF-bytes atomair weg en ruim zo nodig de oudste bestanden op."""
+    pad = _pad(sleutel)
+    os.makedirs(os.path.dirname(pad), exist_ok=True)
+    fd, tijdelijk = tempfile.mkstemp(dir=os.path.dirname(pad), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tijdelijk, pad)
+    except OSError:
+        if os.path.exists(tijdelijk):
+            os.remove(tijdelijk)
+        raise
+    maximum = current_app.config['PDF_CACHE_MAX_MB'] * 1024 * 1024
+    with _slot:
+        _tellers['opgeslagen'] += 1
+        _omvang['schrijfacties'] += 1
+        if _omvang['bytes'] is not None:
+            _omvang['bytes'] += len(data)
+        opruimen = (_omvang['bytes'] is None or _omvang['bytes'] > maximum or
+                    _omvang['schrijfacties'] >= OPRUIM_INTERVAL)
+    if opruimen:
+        _ruim_op()
+
+
+def _bestanden():
+    """(mtime, grootte, pad) van alle PDF's in de cache."""
+    resultaat = []
+    if not os.path.isdir(_map()):
+        return resultaat
+    for submap in os.scandir(_map()):
+        if not submap.is_dir():
+            continue
+        for item in os.scandir(submap.path):
+            if item.name.endswith('.pdf'):
+                try:
+                    info = item.stat()
+                except FileNotFoundError:
+                    continue
+                resultaat.append((info.st_mtime, info.st_size, item.path))
+    return resultaat
+
+
+def _ruim_op():
+    """Tel de map en verwijder zo nodig de oudste bestanden; zet het lopende totaal opnieuw."""
+    maximum = current_app.config['PDF_CACHE_MAX_MB'] * 1024 * 1024
+    bestanden = _bestanden()
+    totaal = sum(grootte for _, grootte, _ in bestanden)
+    if totaal > maximum:
+        # Ruim op tot 90% van het maximum, zodat niet elke volgende schrijfactie opnieuw opruimt
+        verwijderd = 0
+        for _, grootte, pad in sorted(bestanden):
+            if totaal <= maximum * 0.9:
+                break
+            try:
+                os.remove(pad)
+                verwijderd += 1
+            except FileNotFoundError:
+                pass
+            totaal -= grootte
+        _tel('verwijderd', verwijderd)
+    with _slot:
+        _omvang['bytes'] = totaal
+        _omvang['schrijfacties'] = 0
+
+
+def statistiek():
+    """Tellers van dit proces (met proces-id) plus het aantal bestanden en de omvang op schijf."""
+    bestanden = _bestanden()
+    with _slot:
+        tellers = dict(_tellers)
+    return dict(tellers, proces=os.getpid(), bestanden=len(bestanden),
+                megabytes=round(sum(grootte for _, grootte, _ in bestanden) / 1024 / 1024, 2),
+                max_megabytes=current_app.config['PDF_CACHE_MAX_MB'])
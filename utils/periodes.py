@@ -0,0 +1,63 @@
+"""Periodeafsluiting: vastleggen van de eindstand per grootboekrekening per maand."""
+
+import calendar
+from datetime import date, datetime
+from models import db, Periode, PeriodeSaldo
+from utils.saldi import saldi_per_rekening
+
+
+def einde_maand(jaar, maand):
+    return date(jaar, maand, calendar.monthrange(jaar, maand)[1])
+
+
+def haal_periode(jaar, maand):
+    """Geef de periode voor jaar/maand terug en maak die zo nodig aan."""
+    periode = Periode.query.filter_by(jaar=jaar, maand=maand).first()
+    if periode is None:
+        periode = Periode(jaar=jaar, maand=maand, einddatum=einde_maand(jaar, maand),
+                          afgesloten=False, snapshot_geldig=False)
+        db.session.add(periode)
+        db.session.flush()
+    return periode
+
+
+def _leg_standen_vast(periode):
+    """Schrijf de cumulatieve stand per rekening op de einddatum van de periode weg."""
+    PeriodeSaldo.query.filter_by(periode_id=periode.id).delete()
+    # Eigen snapshot niet gebruiken bij het herberekenen
+    periode.snapshot_geldig = False
+    db.session.flush()
+
+    for rek in saldi_per_rekening(tot_datum=periode.einddatum):
+        if rek['totaal_debet'] or rek['totaal_credit']:
+            db.session.add(PeriodeSaldo(periode_id=periode.id, grootboekrekening_id=rek['id'],
+                                        totaal_debet=rek['totaal_debet'],
+                                        totaal_credit=rek['totaal_credit']))
+    periode.snapshot_geldig = True
+
+
+def sluit_periode(jaar, maand):
+    """Sluit een maand af en bevries de eindstanden. Geeft de periode terug."""
+    periode = haal_periode(jaar, maand)
+    _leg_standen_vast(periode)
+    periode.afgesloten = True
+    periode.afgesloten_op = datetime.utcnow()
+    db.session.commit()
+    return periode
+
+
+def herbereken_periodes():
+    """Leg de standen opnieuw vast voor afgesloten periodes die door late boekingen ongeldig zijn.
+
+    Periodes worden oplopend verwerkt, zodat elke periode voortbouwt op de vorige.
+    Geeft het aantal herberekende periodes terug.
+    """
+    ongeldig = Periode.query.filter(
+        Periode.afgesloten.is_(True),
+        Periode.snapshot_geldig.is_(False),
+    ).order_by(Periode.einddatum).all()
+    for periode in ongeldig:
+        _leg_standen_vast(periode)
+        db.session.flush()
+    db.session.commit()
+    return len(ongeldig)
@@ -0,0 +1,136 @@
+"""Liquiditeitsprognose per dag op basis van openstaande posten.
+
+De prognose begint bij het huidige saldo van kas en bank en telt per dag de verwachte
+ontvangsten (openstaande verkoopfacturen) en betalingen (openstaande inkoopfacturen) op,
+op hun vervaldatum. Achterstallige posten worden op vandaag verwacht. Optioneel
+verschuift het gemiddelde betaalgedrag per klant (dagen na vervaldatum bij eerder
+betaalde facturen) de verwachte ontvangstdatum.
+
+De database telt de posten op per vervaldatum (en zo nodig per klant); de rest wordt
+met NumPy-arrays berekend (bincount per dag, cumsum voor het saldo), zodat ook
+tienduizenden openstaande posten interactief blijven.
+"""
+
+from datetime import date, timedelta
+import numpy as np
+from sqlalchemy import func, literal, select
+from models import db, Betaling, Grootboekrekening, Inkoopfactuur, RekeningSaldo, Verkoopfactuur
+
+LIQUIDE_REKENINGEN = ('1000', '1100')  # Kas, Bank
+MAX_DAGEN = 365
+
+# Betaalgedrag: alleen facturen uit deze periode, en pas vanaf zoveel betaalde facturen
+HISTORIE_DAGEN = 730
+MIN_FACTUREN = 2
+VERTRAGING_GRENZEN = (-30, 180)
+
+
+def _startsaldo():
+    saldo = db.session.execute(
+        select(func.sum(RekeningSaldo.totaal_debet - RekeningSaldo.totaal_credit))
+        .join(Grootboekrekening, Grootboekrekening.id == RekeningSaldo.grootboekrekening_id)
+        .where(Grootboekrekening.code.in_(LIQUIDE_REKENINGEN))
+    ).scalar()
+    return round(saldo or 0, 2)
+
+
+def _open_posten(model, relatie_kolom, statussen):
+    """(relatie_ids, vervaldatums, bedragen) van de openstaande facturen als arrays.
+
+    De database telt de posten al op per relatie en vervaldatum; zonder relatie_kolom
+    alleen per vervaldatum (relatie_ids is dan 0).
+    """
+    groep = [relatie_kolom, model.vervaldatum] if relatie_kolom is not None else [model.vervaldatum]
+    rijen = db.session.execute(
+        select(relatie_kolom if relatie_kolom is not None else literal(0), model.vervaldatum,
+               func.sum(model.openstaand))
+        .where(model.status.in_(statussen), model.openstaand > 0.005)
+        .group_by(*groep)
+    ).all()
+    if not rijen:
+        return np.zeros(0, np.int64), np.zeros(0, 'datetime64[D]'), np.zeros(0)
+    relaties, vervaldatums, bedragen = zip(*rijen)
+    return (np.array(relaties, dtype=np.int64), np.array(vervaldatums, dtype='datetime64[D]'),
+            np.array(bedragen, dtype=np.float64))
+
+
+def betaalgedrag(vandaag):
+    """(klant_ids, gemiddelde vertraging in dagen) over recent betaalde verkoopfacturen, gesorteerd op id."""
+    betaald_op = func.max(Betaling.datum)
+    rijen = db.session.execute(
+        select(Verkoopfactuur.klant_id, Verkoopfactuur.vervaldatum, betaald_op)
+        .join(Betaling, (Betaling.factuur_id == Verkoopfactuur.id) & (Betaling.factuur_type == 'verkoop'))
+        .where(Verkoopfactuur.status == 'betaald',
+               Verkoopfactuur.vervaldatum >= vandaag - timedelta(days=HISTORIE_DAGEN))
+        .group_by(Verkoopfactuur.id, Verkoopfactuur.klant_id, Verkoopfactuur.vervaldatum)
+    ).all()
+    if not rijen:
+        return np.zeros(0, np.int64), np.zeros(0)
+    klanten, vervaldatums, betaaldatums = zip(*rijen)
+    vertraging = (np.array(betaaldatums, dtype='datetime64[D]')
+                  - np.array(vervaldatums, dtype='datetime64[D]')).astype(np.int64)
+    ids, index = np.unique(np.array(klanten, dtype=np.int64), return_inverse=True)
+    aantal = np.bincount(index)
+    gemiddeld = np.bincount(index, weights=np.clip(vertraging, *VERTRAGING_GRENZEN)) / aantal
+    genoeg = aantal >= MIN_FACTUREN
+    return ids[genoeg], np.rint(gemiddeld[genoeg])
+
+
+def _per_dag(dagnummers, bedragen, dagen):
+    """Tel bedragen op per dag 0..dagen; achterstallige posten vallen op dag 0."""
+    dagnummers = np.maximum(dagnummers, 0)
+    binnen = dagnummers <= dagen
+    per_dag = np.bincount(dagnummers[binnen], weights=bedragen[binnen], minlength=dagen + 1)
+    return per_dag, float(bedragen[~binnen].sum())
+
+
+def liquiditeitsprognose(dagen=90, met_betaalgedrag=False, vandaag=None):
+    """Prognose over dagen (max. MAX_DAGEN) vanaf vandaag, als dict met kolommen per dag.
+
+    datums, ontvangsten, betalingen en saldo zijn lijsten van gelijke lengte (dag 0 is
+    vandaag); saldo is het verwachte eindsaldo van kas en bank op die dag.
+    """
+    vandaag = vandaag or date.today()
+    dagen = max(1, min(int(dagen), MAX_DAGEN))
+    start = np.datetime64(vandaag, 'D')
+
+    klanten, verval_verkoop, ontvangsten = _open_posten(
+        Verkoopfactuur, Verkoopfactuur.klant_id if met_betaalgedrag else None, ['verzonden', 'vervallen'])
+    _, verval_inkoop, betalingen = _open_posten(
+        Inkoopfactuur, None, ['ontvangen', 'goedgekeurd', 'vervallen'])
+
+    dag_verkoop = (verval_verkoop - start).astype(np.int64)
+    dag_inkoop = (verval_inkoop - start).astype(np.int64)
+    achterstallig_ontvangen = float(ontvangsten[dag_verkoop < 0].sum())
+    achterstallig_betalen = float(betalingen[dag_inkoop < 0].sum())
+
+    if met_betaalgedrag and len(klanten):
+        ids, vertraging = betaalgedrag(vandaag)
+        if len(ids):
+            positie = np.minimum(np.searchsorted(ids, klanten), len(ids) - 1)
+            bekend = ids[positie] == klanten
+            dag_verkoop = dag_verkoop + np.where(bekend, vertraging[positie], 0).astype(np.int64)
+
+    per_dag_in, later_in = _per_dag(dag_verkoop, ontvangsten, dagen)
+    per_dag_uit, later_uit = _per_dag(dag_inkoop, betalingen, dagen)
+
+    startsaldo = _startsaldo()
+    saldo = startsaldo + np.cumsum(per_dag_in - per_dag_uit)
+    laagste = int(np.argmin(saldo))
+    datums = start + np.arange(dagen + 1)
+
+    return {
+        'startdatum': vandaag.isoformat(),
+        'startsaldo': startsaldo,
+        'dagen': dagen,
+        'betaalgedrag': bool(met_betaalgedrag),
+        'datums': [str(d) for d in datums],
+        'ontvangsten': np.round(per_dag_in, 2).tolist(),
+        'betalingen': np.round(per_dag_uit, 2).tolist(),
+        'saldo': np.round(saldo, 2).tolist(),
+        'laagste_saldo': round(float(saldo[laagste]), 2),
+        'laagste_datum': str(datums[laagste]),
+        'achterstallig': {'ontvangsten': round(achterstallig_ontvangen, 2),
+                          'betalingen': round(achterstallig_betalen, 2)},
+        'na_horizon': {'ontvangsten': round(later_in, 2), 'betalingen': round(later_uit, 2)},
+    }
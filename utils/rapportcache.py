@@ -0,0 +1,216 @@
+"""Cache voor berekende rapport- en dashboardgegevens, geldig per grootboekversie.
+
+Elke transactie die facturen, betalingen, journaalposten of stamgegevens van de
+boekhouding wijzigt, hoogt in dezelfde commit in cache_versie de teller op van elke
+gewijzigde tabel (één rij per bewaakte tabel), zodat gelijktijdige schrijvers op
+verschillende tabellen niet op dezelfde rij wachten. De grootboekversie is de som
+van alle tellers; gecachte gegevens horen bij één versie en worden na een boeking
+vanzelf opnieuw berekend. Omdat de tellers in de database staan, zien alle
+gunicorn-workers de wijziging direct.
+
+Resultaten worden als JSON bewaard in een LRU per proces (RAPPORT_CACHE_GROOTTE) en,
+met RAPPORT_CACHE_GEDEELD, ook in de tabel cache_item zodat workers elkaars
+berekeningen hergebruiken. Alleen gegevens worden gecachet, geen HTML.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import chain
+from flask import current_app, g, has_app_context, jsonify, request
+from sqlalchemy import delete, event, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from models import db, CacheVersie, CacheItem
+
+# Tabellen waarvan een wijziging de gecachte gegevens ongeldig maakt
+BEWAAKTE_TABELLEN = frozenset({
+    'verkoopfactuur', 'verkoopfactuur_regel', 'inkoopfactuur', 'inkoopfactuur_regel', 'betaling',
+    'journaalpost', 'journaalpost_regel', 'rekening_saldo', 'grootboekrekening', 'klant', 'leverancier',
+    'periode', 'periode_saldo', 'btw_totaal',
+})
+
+_GEWIJZIGD = 'grootboek_gewijzigd'
+_OPGEHOOGD = 'grootboek_opgehoogd'
+
+_lru = OrderedDict()
+_slot = threading.Lock()
+_tellers = {'hits': 0, 'gedeeld': 0, 'misses': 0}
+
+
+# Versie bijhouden
+
+def _bewaakte_tabellen(objecten):
+    return {o.__tablename__ for o in objecten if getattr(o, '__tablename__', None) in BEWAAKTE_TABELLEN}
+
+
+def _markeer(session, tabellen):
+    if tabellen:
+        session.info.setdefault(_GEWIJZIGD, set()).update(tabellen)
+
+
+@event.listens_for(Session, 'after_flush')
+def _na_flush(session, flush_context):
+    _markeer(session, _bewaakte_tabellen(chain(session.new, session.dirty, session.deleted)))
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _bij_execute(state):
+    # Bulk-inserts en set-based updates lopen buiten de flush om
+    if state.is_insert or state.is_update or state.is_delete:
+        tabel = getattr(state.statement, 'table', None)
+        if tabel is not None and tabel.name in BEWAAKTE_TABELLEN:
+            _markeer(state.session, {tabel.name})
+
+
+@event.listens_for(Session, 'before_commit')
+def _voor_commit(session):
+    _markeer(session, _bewaakte_tabellen(chain(session.new, session.dirty, session.deleted)))
+    tabellen = session.info.pop(_GEWIJZIGD, None)
+    if not tabellen:
+        return
+    # Eén upsert voor alle gewijzigde tabellen, in vaste volgorde tegen deadlocks
+    tabel = CacheVersie.__table__
+    dialect_insert = postgresql.insert if session.get_bind().dialect.name == 'postgresql' else sqlite.insert
+    session.execute(
+        dialect_insert(tabel).values([{'naam': naam, 'versie': 1} for naam in sorted(tabellen)])
+        .on_conflict_do_update(index_elements=['naam'], set_={'versie': tabel.c.versie + 1})
+    )
+    session.info[_OPGEHOOGD] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _na_commit(session):
+    # Markering van de flush binnen commit() zelf hoort bij de al opgehoogde tellers
+    session.info.pop(_GEWIJZIGD, None)
+    if session.info.pop(_OPGEHOOGD, None) and has_app_context():
+        g.pop('grootboek_versie', None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _na_rollback(session):
+    session.info.pop(_GEWIJZIGD, None)
+    session.info.pop(_OPGEHOOGD, None)
+
+
+def grootboek_versie():
+    """Huidige versie van de boekhouding (som van de tellers); binnen een request of taak één keer gelezen."""
+    if has_app_context() and 'grootboek_versie' in g:
+        return g.grootboek_versie
+    versie = db.session.execute(select(func.sum(CacheVersie.versie))).scalar() or 0
+    if has_app_context():
+        g.grootboek_versie = versie
+    return versie
+
+
+# Opslag
+
+def _naar_json(waarde):
+    if isinstance(waarde, datetime):
+        return {'__tijd__': waarde.isoformat()}
+    if isinstance(waarde, date):
+        return {'__datum__': waarde.isoformat()}
+    if isinstance(waarde, Decimal):
+        return float(waarde)
+    raise TypeError(f'{type(waarde).__name__} kan niet in de rapportcache')
+
+
+def _uit_json(obj):
+    if len(obj) == 1:
+        if '__datum__' in obj:
+            return date.fromisoformat(obj['__datum__'])
+        if '__tijd__' in obj:
+            return datetime.fromisoformat(obj['__tijd__'])
+    return obj
+
+
+def _sleutel(naam, argumenten):
+    tekst = json.dumps([naam, argumenten], default=_naar_json, sort_keys=True)
+    return hashlib.sha256(tekst.encode('utf-8')).hexdigest()
+
+
+def _lees_gedeeld(sleutel, versie):
+    return db.session.execute(
+        select(CacheItem.waarde).where(CacheItem.sleutel == sleutel, CacheItem.versie == versie)
+    ).scalar()
+
+
+def _schrijf_gedeeld(sleutel, versie, tekst):
+    # Eigen verbinding: de cache mag de transactie van het request niet raken
+    tabel = CacheItem.__table__
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(delete(tabel).where(tabel.c.sleutel == sleutel))
+            conn.execute(insert(tabel).values(sleutel=sleutel, versie=versie, waarde=tekst,
+                                              bijgewerkt_op=datetime.utcnow()))
+    except SQLAlchemyError:
+        pass  # een andere worker schreef dezelfde sleutel; niet erg
+
+
+def _tel(teller):
+    with _slot:
+        _tellers[teller] += 1
+
+
+def haal_op(naam, argumenten, bereken):
+    """Resultaat van bereken() voor deze naam en argumenten bij de huidige grootboekversie.
+
+    argumenten moeten naar JSON kunnen (datums mogen); het resultaat ook. Elke aanroep
+    krijgt een eigen kopie, zodat aanpassen door de aanroeper de cache niet raakt.
+    """
+    versie = grootboek_versie()
+    sleutel = _sleutel(naam, argumenten)
+    gedeeld = current_app.config.get('RAPPORT_CACHE_GEDEELD')
+
+    with _slot:
+        tekst = _lru.get((sleutel, versie))
+        if tekst is not None:
+            _lru.move_to_end((sleutel, versie))
+            _tellers['hits'] += 1
+    if tekst is None and gedeeld:
+        tekst = _lees_gedeeld(sleutel, versie)
+        if tekst is not None:
+            _tel('gedeeld')
+    if tekst is None:
+        _tel('misses')
+        tekst = json.dumps(bereken(), default=_naar_json)
+        if gedeeld:
+            _schrijf_gedeeld(sleutel, versie, tekst)
+
+    with _slot:
+        _lru[(sleutel, versie)] = tekst
+        while len(_lru) > current_app.config.get('RAPPORT_CACHE_GROOTTE', 256):
+            _lru.popitem(last=False)
+    return json.loads(tekst, object_hook=_uit_json)
+
+
+def json_met_etag(naam, argumenten, bereken):
+    """JSON-response met een ETag op grootboekversie en argumenten.
+
+    Heeft de browser die versie al, dan volgt een 304 zonder iets te berekenen.
+    """
+    etag = f'{_sleutel(naam, argumenten)[:16]}-{grootboek_versie()}'
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(haal_op(naam, argumenten, bereken))
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def ruim_cache_op():
+    """Verwijder gedeelde cache-items van oudere versies. Geeft het aantal terug."""
+    resultaat = db.session.execute(delete(CacheItem).where(CacheItem.versie < grootboek_versie()))
+    db.session.commit()
+    return resultaat.rowcount
+
+
+def statistiek():
+    with _slot:
+        return dict(_tellers, items=len(_lru), versie=grootboek_versie())
@@ -0,0 +1,71 @@
+"""Tijdreeksen per maand of kwartaal voor grafieken.
+
+Een reeks wordt met één gegroepeerde query over een datumbereik opgehaald
+(jaar, maand, veld, bedrag); perioden zonder boekingen worden hier met nullen
+aangevuld en maanden zo nodig tot kwartalen samengevoegd.
+"""
+
+from datetime import date
+from flask import request
+
+GRANULARITEITEN = ('maand', 'kwartaal')
+MAANDNAMEN = ['Jan', 'Feb', 'Mrt', 'Apr', 'Mei', 'Jun', 'Jul', 'Aug', 'Sep', 'Okt', 'Nov', 'Dec']
+MAX_JAREN = 20
+EERSTE_JAAR = 1900
+JAREN_VOORUIT = 10
+
+
+def reeks_parameters():
+    """Lees van/tot (jaren) en granulariteit uit de querystring; standaard het lopende jaar per maand.
+
+    Jaren worden begrensd tot EERSTE_JAAR t/m het lopende jaar + JAREN_VOORUIT, een omgekeerd
+    bereik wordt omgedraaid en het bereik beslaat hoogstens MAX_JAREN jaar.
+    """
+    huidig = date.today().year
+    van = request.args.get('van', huidig, type=int)
+    tot = request.args.get('tot', van if 'van' in request.args else huidig, type=int)
+    van, tot = (min(max(jaar, EERSTE_JAAR), huidig + JAREN_VOORUIT) for jaar in (van, tot))
+    if tot < van:
+        van, tot = tot, van
+    van = max(van, tot - MAX_JAREN + 1)
+    granulariteit = request.args.get('granulariteit', 'maand')
+    if granulariteit not in GRANULARITEITEN:
+        granulariteit = 'maand'
+    return van, tot, granulariteit
+
+
+def datumbereik(van_jaar, tot_jaar):
+    """Halfopen bereik [1 januari van_jaar, 1 januari tot_jaar + 1) voor indexvriendelijke filters."""
+    return date(van_jaar, 1, 1), date(tot_jaar + 1, 1, 1)
+
+
+def _periode(jaar, maand, granulariteit):
+    return (jaar, (maand - 1) // 3 + 1) if granulariteit == 'kwartaal' else (jaar, maand)
+
+
+def reeks(rijen, van_jaar, tot_jaar, granulariteit, velden):
+    """Zet (jaar, maand, veld, bedrag)-rijen om naar een aaneengesloten lijst perioden.
+
+    Elk element heeft jaar, maand (eerste maand van de periode), label en per veld het
+    afgeronde bedrag; bij kwartalen ook kwartaal.
+    """
+    totalen = {}
+    for jaar, maand, veld, bedrag in rijen:
+        sleutel = _periode(int(jaar), int(maand), granulariteit)
+        per_veld = totalen.setdefault(sleutel, dict.fromkeys(velden, 0.0))
+        per_veld[veld] += bedrag or 0
+
+    meerdere_jaren = van_jaar != tot_jaar
+    data = []
+    for jaar in range(van_jaar, tot_jaar + 1):
+        for nummer in range(1, 5 if granulariteit == 'kwartaal' else 13):
+            per_veld = totalen.get((jaar, nummer), dict.fromkeys(velden, 0.0))
+            if granulariteit == 'kwartaal':
+                element = {'jaar': jaar, 'kwartaal': nummer, 'maand': (nummer - 1) * 3 + 1,
+                           'label': f'Q{nummer} {jaar}' if meerdere_jaren else f'Q{nummer}'}
+            else:
+                element = {'jaar': jaar, 'maand': nummer,
+                           'label': f'{MAANDNAMEN[nummer - 1]} {jaar}' if meerdere_jaren else MAANDNAMEN[nummer - 1]}
+            element.update({veld: round(bedrag, 2) for veld, bedrag in per_veld.items()})
+            data.append(element)
+    return data
@@ -0,0 +1,191 @@
+"""Saldi per grootboekrekening.
+
+De totalen worden bijgehouden in de tabel rekening_saldo, zodat balansoverzichten
+niet per rekening over alle journaalregels hoeven te sommeren. Standen per datum
+starten vanaf de laatste geldige periodeafsluiting (periode_saldo) en tellen alleen
+de journaalregels daarna op.
+"""
+
+from sqlalchemy import bindparam, func, select, union_all, update
+from models import (db, Grootboekrekening, Journaalpost, JournaalpostRegel, RekeningSaldo,
+                    Periode, PeriodeSaldo)
+
+
+def werk_saldi_bij(datum, regels):
+    """Verwerk nieuwe journaalregels in rekening_saldo, binnen de lopende transactie.
+
+    datum: boekdatum van de journaalpost; een boeking in een afgesloten periode maakt
+    de vastgelegde standen van die en latere periodes ongeldig.
+    regels: lijst van (grootboekrekening_id, debet, credit)
+    """
+    mutaties = {}
+    for rek_id, debet, credit in regels:
+        totaal = mutaties.setdefault(rek_id, [0.0, 0.0, 0])
+        totaal[0] += debet or 0
+        totaal[1] += credit or 0
+        totaal[2] += 1
+    if not mutaties:
+        return
+
+    # Eén executemany voor alle rekeningen; ontbrekende rijen daarna aanvullen
+    tabel = RekeningSaldo.__table__
+    resultaat = db.session.execute(
+        update(tabel)
+        .where(tabel.c.grootboekrekening_id == bindparam('rek_id'))
+        .values(totaal_debet=tabel.c.totaal_debet + bindparam('mutatie_debet'),
+                totaal_credit=tabel.c.totaal_credit + bindparam('mutatie_credit'),
+                aantal_regels=tabel.c.aantal_regels + bindparam('mutatie_aantal')),
+        [{'rek_id': rek_id, 'mutatie_debet': debet, 'mutatie_credit': credit, 'mutatie_aantal': aantal}
+         for rek_id, (debet, credit, aantal) in mutaties.items()]
+    )
+    if resultaat.rowcount != len(mutaties):
+        bestaand = {rek_id for (rek_id,) in db.session.query(RekeningSaldo.grootboekrekening_id).filter(
+            RekeningSaldo.grootboekrekening_id.in_(list(mutaties))
+        )}
+        for rek_id, (debet, credit, aantal) in mutaties.items():
+            if rek_id not in bestaand:
+                db.session.add(RekeningSaldo(grootboekrekening_id=rek_id, totaal_debet=debet,
+                                             totaal_credit=credit, aantal_regels=aantal))
+
+    db.session.execute(
+        update(Periode)
+        .where(Periode.snapshot_geldig.is_(True), Periode.einddatum >= datum)
+        .values(snapshot_geldig=False)
+    )
+
+
+def herbereken_saldi():
+    """Bouw rekening_saldo opnieuw op vanuit alle journaalregels. Geeft het aantal rekeningen terug."""
+    totalen = db.session.query(
+        Grootboekrekening.id,
+        func.coalesce(func.sum(JournaalpostRegel.debet), 0),
+        func.coalesce(func.sum(JournaalpostRegel.credit), 0),
+        func.count(JournaalpostRegel.id),
+    ).outerjoin(
+        JournaalpostRegel, JournaalpostRegel.grootboekrekening_id == Grootboekrekening.id
+    ).group_by(Grootboekrekening.id).all()
+
+    db.session.query(RekeningSaldo).delete()
+    for rek_id, debet, credit, aantal in totalen:
+        db.session.add(RekeningSaldo(grootboekrekening_id=rek_id, totaal_debet=debet,
+                                     totaal_credit=credit, aantal_regels=aantal))
+    db.session.commit()
+    return len(totalen)
+
+
+def _journaal_totalen(van_datum=None, tot_datum=None):
+    """Subquery met debet/credit per rekening over journaalposten binnen de periode."""
+    query = db.session.query(
+        JournaalpostRegel.grootboekrekening_id.label('grootboekrekening_id'),
+        func.sum(JournaalpostRegel.debet).label('totaal_debet'),
+        func.sum(JournaalpostRegel.credit).label('totaal_credit'),
+    ).join(Journaalpost, Journaalpost.id == JournaalpostRegel.journaalpost_id)
+    if van_datum:
+        query = query.filter(Journaalpost.datum >= van_datum)
+    if tot_datum:
+        query = query.filter(Journaalpost.datum <= tot_datum)
+    return query.group_by(JournaalpostRegel.grootboekrekening_id).subquery()
+
+
+def laatste_snapshot(tot_datum):
+    """Meest recente afgesloten periode met geldige standen die eindigt op of voor tot_datum."""
+    return Periode.query.filter(
+        Periode.afgesloten.is_(True),
+        Periode.snapshot_geldig.is_(True),
+        Periode.einddatum <= tot_datum,
+    ).order_by(Periode.einddatum.desc()).first()
+
+
+def _cumulatieve_totalen(tot_datum):
+    """Subquery met de stand per rekening op tot_datum: laatste snapshot plus latere journaalregels."""
+    periode = laatste_snapshot(tot_datum)
+    if periode is None:
+        return _journaal_totalen(tot_datum=tot_datum)
+
+    snapshot = select(
+        PeriodeSaldo.grootboekrekening_id.label('grootboekrekening_id'),
+        PeriodeSaldo.totaal_debet.label('debet'),
+        PeriodeSaldo.totaal_credit.label('credit'),
+    ).where(PeriodeSaldo.periode_id == periode.id)
+    mutaties = select(
+        JournaalpostRegel.grootboekrekening_id,
+        JournaalpostRegel.debet,
+        JournaalpostRegel.credit,
+    ).join(Journaalpost, Journaalpost.id == JournaalpostRegel.journaalpost_id).where(
+        Journaalpost.datum > periode.einddatum,
+        Journaalpost.datum <= tot_datum,
+    )
+    regels = union_all(snapshot, mutaties).subquery()
+    return select(
+        regels.c.grootboekrekening_id.label('grootboekrekening_id'),
+        func.sum(regels.c.debet).label('totaal_debet'),
+        func.sum(regels.c.credit).label('totaal_credit'),
+    ).group_by(regels.c.grootboekrekening_id).subquery()
+
+
+def saldo_rekening(rekening_id, tot_datum=None):
+    """Saldo (debet - credit) van één rekening, in totaal of op tot_datum."""
+    if tot_datum is None:
+        saldo = db.session.query(RekeningSaldo.totaal_debet - RekeningSaldo.totaal_credit).filter(
+            RekeningSaldo.grootboekrekening_id == rekening_id
+        ).scalar()
+    else:
+        totalen = _cumulatieve_totalen(tot_datum)
+        saldo = db.session.query(totalen.c.totaal_debet - totalen.c.totaal_credit).filter(
+            totalen.c.grootboekrekening_id == rekening_id
+        ).scalar()
+    return round(saldo or 0, 2)
+
+
+def saldi_per_rekening(type_=None, van_datum=None, tot_datum=None):
+    """Debet, credit en saldo van alle rekeningen (of één type) in één query, gesorteerd op code.
+
+    Zonder datums komen de totalen uit rekening_saldo. Met alleen tot_datum is het resultaat
+    de stand op die datum, opgebouwd vanaf de laatste periodeafsluiting; met van_datum en
+    tot_datum de mutaties binnen die periode.
+    """
+    if van_datum or tot_datum:
+        if van_datum:
+            totalen = _journaal_totalen(van_datum, tot_datum)
+        else:
+            totalen = _cumulatieve_totalen(tot_datum)
+        debet_kolom, credit_kolom = totalen.c.totaal_debet, totalen.c.totaal_credit
+        koppeling = totalen.c.grootboekrekening_id == Grootboekrekening.id
+    else:
+        totalen = RekeningSaldo
+        debet_kolom, credit_kolom = RekeningSaldo.totaal_debet, RekeningSaldo.totaal_credit
+        koppeling = RekeningSaldo.grootboekrekening_id == Grootboekrekening.id
+
+    query = db.session.query(
+        Grootboekrekening.id, Grootboekrekening.code, Grootboekrekening.naam, Grootboekrekening.type,
+        debet_kolom, credit_kolom,
+    ).outerjoin(totalen, koppeling)
+    if type_:
+        query = query.filter(Grootboekrekening.type == type_)
+
+    result = []
+    for rek_id, code, naam, type_rek, debet, credit in query.order_by(Grootboekrekening.code):
+        debet = debet or 0
+        credit = credit or 0
+        result.append({
+            'id': rek_id,
+            'code': code,
+            'naam': naam,
+            'type': type_rek,
+            'totaal_debet': round(debet, 2),
+            'totaal_credit': round(credit, 2),
+            'saldo': round(debet - credit, 2),
+        })
+    return result
+
+
+def saldi_per_type(van_datum=None, tot_datum=None):
+    """Rekeningen met een saldo, gegroepeerd per type: {type: (lijst, totaal)}, in één query."""
+    per_type = {type_: ([], 0) for type_ in ('activa', 'passiva', 'kosten', 'opbrengsten')}
+    for rek in saldi_per_rekening(van_datum=van_datum, tot_datum=tot_datum):
+        if rek['saldo'] == 0:
+            continue
+        lijst, totaal = per_type.setdefault(rek['type'], ([], 0))
+        lijst.append({'code': rek['code'], 'naam': rek['naam'], 'saldo': rek['saldo']})
+        per_type[rek['type']] = (lijst, totaal + rek['saldo'])
+    return {type_: (lijst, round(totaal, 2)) for type_, (lijst, totaal) in per_type.items()}
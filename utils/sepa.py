@@ -0,0 +1,226 @@
+"""Betaalrun: goedgekeurde inkoopfacturen betalen via een SEPA-overschrijvingsbestand (pain.001).
+
+Een run selecteert alle goedgekeurde inkoopfacturen in euro met een openstaand bedrag die
+uiterlijk op de gekozen datum vervallen, en registreert in één transactie per factuur een
+betaling, de journaalposten en de statuswijziging. Alle betalingen van een run krijgen het
+berichtkenmerk (MsgId) als referentie, zodat het bestand later opnieuw kan worden gemaakt.
+
+Het pain.001-bestand bevat één overschrijving per IBAN van de leverancier, met de
+factuurnummers in de omschrijving. Het wordt uit de geregistreerde betalingen
+opgebouwd en in delen gegenereerd.
+"""
+
+import re
+import unicodedata
+from collections import defaultdict
+from datetime import datetime
+from types import SimpleNamespace
+from xml.sax.saxutils import escape
+from flask import current_app
+from sqlalchemy import insert, select, update, func
+from models import db, Betaling, Inkoopfactuur, Leverancier
+from utils.boekingen import boek_reeks
+from utils.openstaand import verwerk_betalingen
+
+PAIN_VERSIE = 'pain.001.001.03'
+REFERENTIE_PREFIX = 'SEPA-'
+
+# Tekens die in SEPA-velden zijn toegestaan; de rest wordt een spatie
+_NIET_TOEGESTAAN = re.compile(r"[^A-Za-z0-9/\-?:().,'+ ]")
+
+
+def sepa_tekst(tekst, lengte):
+    """Zet tekst om naar de SEPA-tekenset (accenten eraf) en kort af."""
+    tekst = unicodedata.normalize('NFKD', tekst or '').encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'\s+', ' ', _NIET_TOEGESTAAN.sub(' ', tekst)).strip()[:lengte]
+
+
+def _iban(iban):
+    return re.sub(r'\s', '', iban or '').upper()
+
+
+def geldige_iban(iban):
+    """Controleer opbouw en controlegetal (mod 97) van een IBAN."""
+    iban = _iban(iban)
+    if not re.fullmatch(r'[A-Z]{2}[0-9]{2}[A-Z0-9]{11,30}', iban):
+        return False
+    # Landcode en controlegetal achteraan, letters als getallen (A=10 ... Z=35)
+    return int(''.join(str(int(teken, 36)) for teken in iban[4:] + iban[:4])) % 97 == 1
+
+
+def _te_betalen(tot_datum):
+    return (Inkoopfactuur.status == 'goedgekeurd',
+            Inkoopfactuur.vervaldatum <= tot_datum,
+            Inkoopfactuur.openstaand > 0.005,
+            Leverancier.iban.isnot(None), Leverancier.iban != '')
+
+
+def betaalrun_selectie(tot_datum):
+    """Select op de te betalen facturen: (id, factuurnummer, openstaand, leverancier_id, naam, iban).
+
+    Alleen facturen in euro; een SEPA-overschrijving kent geen andere valuta.
+    """
+    return (
+        select(Inkoopfactuur.id, Inkoopfactuur.factuurnummer, Inkoopfactuur.openstaand,
+               Leverancier.id, Leverancier.naam, Leverancier.iban)
+        .join(Leverancier, Leverancier.id == Inkoopfactuur.leverancier_id)
+        .where(*_te_betalen(tot_datum), Inkoopfactuur.valuta == 'EUR')
+        .order_by(Inkoopfactuur.vervaldatum, Inkoopfactuur.id)
+    )
+
+
+def betaalrun_andere_valuta(tot_datum):
+    """Facturen die alleen door hun valuta buiten de run vallen: [(factuurnummer, naam, valuta, openstaand)]."""
+    return db.session.execute(
+        select(Inkoopfactuur.factuurnummer, Leverancier.naam, Inkoopfactuur.valuta, Inkoopfactuur.openstaand)
+        .join(Leverancier, Leverancier.id == Inkoopfactuur.leverancier_id)
+        .where(*_te_betalen(tot_datum), Inkoopfactuur.valuta != 'EUR')
+        .order_by(Inkoopfactuur.vervaldatum, Inkoopfactuur.id)
+    ).all()
+
+
+def betaalrun_voorbeeld(tot_datum):
+    """Overzicht per leverancier-IBAN: [{'naam', 'iban', 'geldig', 'aantal', 'bedrag'}]."""
+    per_iban = defaultdict(lambda: {'naam': None, 'aantal': 0, 'bedrag': 0.0})
+    for _, _, openstaand, _, naam, iban in db.session.execute(betaalrun_selectie(tot_datum)):
+        groep = per_iban[_iban(iban)]
+        groep['naam'] = groep['naam'] or naam
+        groep['aantal'] += 1
+        groep['bedrag'] = round(groep['bedrag'] + openstaand, 2)
+    return [dict(groep, iban=iban, geldig=geldige_iban(iban)) for iban, groep in per_iban.items()]
+
+
+def voer_betaalrun_uit(tot_datum, uitvoerdatum):
+    """Registreer betalingen, journaalposten en statussen voor alle geselecteerde facturen.
+
+    De facturen worden eerst geclaimd met één UPDATE ... RETURNING die alleen facturen
+    raakt die nog 'goedgekeurd' zijn; een gelijktijdige tweede run vindt ze dan niet meer.
+    Alles gebeurt in één transactie met bulk-inserts en set-based updates. Geeft het
+    berichtkenmerk van de run terug, of None als er niets te betalen is. Een ongeldige
+    IBAN bij een van de leveranciers geeft een ValueError; er wordt dan niets betaald.
+    """
+    te_betalen = betaalrun_selectie(tot_datum).order_by(None)
+    ongeldig = sorted({naam for *_, naam, iban in db.session.execute(te_betalen) if not geldige_iban(iban)})
+    if ongeldig:
+        raise ValueError(f"Ongeldige IBAN bij {', '.join(ongeldig)}; pas de leverancier(s) aan en probeer opnieuw.")
+
+    tabel = Inkoopfactuur.__table__
+    te_betalen = te_betalen.with_only_columns(Inkoopfactuur.id)
+    facturen = db.session.execute(
+        update(tabel)
+        .where(tabel.c.id.in_(te_betalen.scalar_subquery()), tabel.c.status == 'goedgekeurd')
+        .values(status='betaald')
+        .returning(tabel.c.id, tabel.c.openstaand)
+    ).all()
+    if not facturen:
+        return None
+
+    msg_id = f'{REFERENTIE_PREFIX}{datetime.now():%Y%m%d%H%M%S%f}'[:-3]
+    betalingen = [{
+        'type': 'uitgaand',
+        'factuur_type': 'inkoop',
+        'factuur_id': factuur_id,
+        'bedrag': round(openstaand, 2),
+        'datum': uitvoerdatum,
+        'betaalmethode': 'bank',
+        'referentie': msg_id,
+    } for factuur_id, openstaand in sorted(facturen)]
+    ids = db.session.execute(
+        insert(Betaling).returning(Betaling.id, sort_by_parameter_order=True), betalingen
+    ).scalars().all()
+    for betaling, betaling_id in zip(betalingen, ids):
+        betaling['id'] = betaling_id
+
+    boek_reeks('betaling_uitgaand', [SimpleNamespace(**b) for b in betalingen])
+    verwerk_betalingen('inkoop', {b['factuur_id']: b['bedrag'] for b in betalingen})
+    db.session.commit()
+    return msg_id
+
+
+def betaalruns(limiet=20):
+    """Eerdere runs: [(msg_id, uitvoerdatum, aantal, bedrag)], nieuwste eerst."""
+    return db.session.execute(
+        select(Betaling.referentie, func.min(Betaling.datum), func.count(), func.sum(Betaling.bedrag))
+        .where(Betaling.type == 'uitgaand', Betaling.referentie.like(f'{REFERENTIE_PREFIX}%'))
+        .group_by(Betaling.referentie)
+        .order_by(Betaling.referentie.desc())
+        .limit(limiet)
+    ).all()
+
+
+def _overschrijvingen(msg_id):
+    """Betalingen van een run, gegroepeerd per IBAN: (iban, naam, bedrag_in_centen, factuurnummers).
+
+    Gegroepeerd op de genormaliseerde IBAN (zoals in betaalrun_voorbeeld); sorteren op de
+    opgeslagen waarde zou 'NL91 ABNA ...' en 'NL91ABNA...' over twee overschrijvingen verdelen.
+    """
+    rijen = db.session.execute(
+        select(Leverancier.iban, Leverancier.naam, Betaling.bedrag, Inkoopfactuur.factuurnummer)
+        .join(Inkoopfactuur, Inkoopfactuur.id == Betaling.factuur_id)
+        .join(Leverancier, Leverancier.id == Inkoopfactuur.leverancier_id)
+        .where(Betaling.referentie == msg_id, Betaling.factuur_type == 'inkoop')
+        .order_by(Betaling.id)
+        .execution_options(yield_per=500)
+    )
+    per_iban = {}
+    for r in rijen:
+        groep = per_iban.setdefault(_iban(r.iban), {'naam': r.naam, 'centen': 0, 'nummers': []})
+        groep['centen'] += int(round(r.bedrag * 100))
+        groep['nummers'].append(r.factuurnummer)
+    for iban, groep in per_iban.items():
+        yield iban, groep['naam'], groep['centen'], groep['nummers']
+
+
+def pain001_stroom(msg_id):
+    """Geef een generator die het pain.001-bestand van een run in delen (bytes) oplevert.
+
+    Het aantal overschrijvingen en het controletotaal voor de kop worden vooraf in een
+    aparte doorloop bepaald; een onbekende run geeft direct een ValueError.
+    """
+    aantal, totaal = 0, 0
+    for _, _, centen, _ in _overschrijvingen(msg_id):
+        aantal += 1
+        totaal += centen
+    if not aantal:
+        raise ValueError(f'Betaalrun {msg_id} bestaat niet.')
+    uitvoerdatum = db.session.execute(
+        select(func.min(Betaling.datum)).where(Betaling.referentie == msg_id)
+    ).scalar()
+    return _pain001_delen(msg_id, aantal, totaal, uitvoerdatum)
+
+
+def _pain001_delen(msg_id, aantal, totaal, uitvoerdatum):
+    config = current_app.config
+    naam = sepa_tekst(config.get('BEDRIJFSNAAM', ''), 70)
+    bic = config.get('BEDRIJFSBIC')
+    debiteur_agent = (f'<DbtrAgt><FinInstnId><BIC>{bic}</BIC></FinInstnId></DbtrAgt>' if bic else
+                      '<DbtrAgt><FinInstnId><Othr><Id>NOTPROVIDED</Id></Othr></FinInstnId></DbtrAgt>')
+
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Document xmlns="urn:iso:std:iso:20022:tech:xsd:{PAIN_VERSIE}">'
+        '<CstmrCdtTrfInitn>'
+        f'<GrpHdr><MsgId>{msg_id}</MsgId><CreDtTm>{datetime.now():%Y-%m-%dT%H:%M:%S}</CreDtTm>'
+        f'<NbOfTxs>{aantal}</NbOfTxs><CtrlSum>{totaal / 100:.2f}</CtrlSum>'
+        f'<InitgPty><Nm>{naam}</Nm></InitgPty></GrpHdr>'
+        f'<PmtInf><PmtInfId>{msg_id}</PmtInfId><PmtMtd>TRF</PmtMtd><BtchBookg>true</BtchBookg>'
+        f'<NbOfTxs>{aantal}</NbOfTxs><CtrlSum>{totaal / 100:.2f}</CtrlSum>'
+        '<PmtTpInf><SvcLvl><Cd>SEPA</Cd></SvcLvl></PmtTpInf>'
+        f'<ReqdExctnDt>{uitvoerdatum.isoformat()}</ReqdExctnDt>'
+        f'<Dbtr><Nm>{naam}</Nm></Dbtr>'
+        f'<DbtrAcct><Id><IBAN>{escape(_iban(config.get("BEDRIJFSIBAN")))}</IBAN></Id></DbtrAcct>'
+        f'{debiteur_agent}<ChrgBr>SLEV</ChrgBr>'
+    ).encode('utf-8')
+
+    for volgnummer, (iban, crediteur, centen, nummers) in enumerate(_overschrijvingen(msg_id), start=1):
+        yield (
+            '<CdtTrfTxInf>'
+            f'<PmtId><EndToEndId>{msg_id}-{volgnummer}</EndToEndId></PmtId>'
+            f'<Amt><InstdAmt Ccy="EUR">{centen / 100:.2f}</InstdAmt></Amt>'
+            f'<Cdtr><Nm>{sepa_tekst(crediteur, 70)}</Nm></Cdtr>'
+            f'<CdtrAcct><Id><IBAN>{escape(iban)}</IBAN></Id></CdtrAcct>'
+            f'<RmtInf><Ustrd>{sepa_tekst("Factuur " + " ".join(nummers), 140)}</Ustrd></RmtInf>'
+            '</CdtTrfTxInf>'
+        ).encode('utf-8')
+
+    yield b'</PmtInf></CstmrCdtTrfInitn></Document>\n'
@@ -0,0 +1,201 @@
+"""Achtergrondtaken via de database, zonder externe broker.
+
+Een taak is een rij in de tabel taak; worker.py pakt wachtende taken op in volgorde van
+aanmaak. Het claimen gebeurt met een voorwaardelijke UPDATE (status nog 'wachtend'),
+zodat meerdere workers naast elkaar kunnen draaien. Het resultaat komt in
+taak_resultaat, zodat webproces en worker geen bestandssysteem hoeven te delen. Het
+wordt daar in delen van RESULTAAT_DEEL bytes opgeslagen en weer uitgelezen.
+
+Taaksoorten worden geregistreerd met de decorator @taaksoort bij de blueprint die de
+bijbehorende synchrone export heeft. Een handler krijgt de parameters (dict) en een
+voortgang(klaar, totaal)-callback en geeft (inhoud, bestandsnaam, mimetype) terug;
+inhoud mag bytes zijn of een iterator van bytes. Een iterator wordt tijdens het
+uitlezen al weggeschreven, dus grote exports blijven binnen een vaste hoeveelheid geheugen.
+"""
+
+import json
+import time
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, delete, func, insert, select, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+from models import db, Taak, TaakResultaat
+
+# naam -> (handler, titel)
+TAAKSOORTEN = {}
+
+# Een taak die langer dan dit op 'bezig' staat, is van een afgebroken worker
+TAAK_TIMEOUT = timedelta(hours=2)
+
+# Grootte van één rij in taak_resultaat
+RESULTAAT_DEEL = 1024 * 1024
+
+
+def taaksoort(naam, titel):
+    """Decorator: registreer een handler voor een taaksoort."""
+    def registreer(handler):
+        TAAKSOORTEN[naam] = (handler, titel)
+        return handler
+    return registreer
+
+
+def plan_taak(soort, parameters=None, gebruiker_id=None):
+    """Zet een taak in de wachtrij en geef die terug."""
+    parameters = {k: v for k, v in (parameters or {}).items() if v not in (None, '')}
+    details = ', '.join(f'{k}: {v}' for k, v in parameters.items())
+    titel = TAAKSOORTEN[soort][1]
+    taak = Taak(soort=soort, parameters=json.dumps(parameters), gebruiker_id=gebruiker_id,
+                omschrijving=f'{titel} ({details})' if details else titel)
+    db.session.add(taak)
+    db.session.commit()
+    return taak
+
+
+def claim_volgende():
+    """Neem de oudste wachtende taak in behandeling. Geeft de taak of None terug."""
+    while True:
+        taak_id = db.session.execute(
+            select(Taak.id).where(Taak.status == 'wachtend').order_by(Taak.id).limit(1)
+        ).scalar()
+        if taak_id is None:
+            db.session.commit()
+            return None
+        resultaat = db.session.execute(
+            update(Taak).where(Taak.id == taak_id, Taak.status == 'wachtend')
+            .values(status='bezig', gestart_op=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        if resultaat.rowcount == 1:
+            return db.session.get(Taak, taak_id)
+        # Een andere worker was eerder; volgende proberen
+
+
+_voortgang_engine = None
+
+
+def _schrijf_voortgang(taak_id, klaar, totaal):
+    """Werk de voortgang bij in een eigen transactie, los van de lopende leesquery's.
+
+    Op SQLite kan een open leescursor van de taak het schrijven blokkeren; dan wordt deze
+    tussenstand na een korte wachttijd overgeslagen.
+    """
+    global _voortgang_engine
+    if db.engine.dialect.name == 'sqlite':
+        if _voortgang_engine is None:
+            _voortgang_engine = create_engine(db.engine.url, poolclass=NullPool,
+                                              connect_args={'timeout': 0.1})
+        engine = _voortgang_engine
+    else:
+        engine = db.engine
+    try:
+        with engine.begin() as conn:
+            conn.execute(update(Taak.__table__).where(Taak.__table__.c.id == taak_id)
+                         .values(klaar=klaar, totaal=totaal))
+    except OperationalError:
+        pass
+
+
+def _sla_resultaat_op(taak_id, inhoud):
+    """Schrijf de uitvoer (bytes of iterator van bytes) in delen weg in de lopende transactie."""
+    if isinstance(inhoud, bytes):
+        inhoud = [inhoud]
+    buffer = bytearray()
+    volgnummer = 0
+
+    def schrijf(deel):
+        nonlocal volgnummer
+        db.session.execute(insert(TaakResultaat), {'taak_id': taak_id, 'volgnummer': volgnummer,
+                                                   'inhoud': bytes(deel)})
+        volgnummer += 1
+
+    for stuk in inhoud:
+        buffer += stuk
+        while len(buffer) >= RESULTAAT_DEEL:
+            schrijf(buffer[:RESULTAAT_DEEL])
+            del buffer[:RESULTAAT_DEEL]
+    if buffer or volgnummer == 0:
+        schrijf(buffer)
+
+
+def lees_resultaat(taak_id):
+    """Genereer de delen van het resultaat van een taak, één rij tegelijk."""
+    volgnummer = 0
+    while True:
+        deel = db.session.execute(
+            select(TaakResultaat.inhoud)
+            .where(TaakResultaat.taak_id == taak_id, TaakResultaat.volgnummer == volgnummer)
+        ).scalar()
+        if deel is None:
+            return
+        yield deel
+        volgnummer += 1
+
+
+def resultaat_grootte(taak_id):
+    """Totale grootte van het resultaat in bytes, of None als er geen resultaat is."""
+    return db.session.execute(
+        select(func.sum(func.length(TaakResultaat.inhoud))).where(TaakResultaat.taak_id == taak_id)
+    ).scalar()
+
+
+def voer_taak_uit(taak):
+    """Voer een geclaimde taak uit en sla het resultaat of de foutmelding op."""
+    taak_id = taak.id
+    laatste_update = [0.0]
+
+    def voortgang(klaar, totaal=None):
+        nu = time.monotonic()
+        if nu - laatste_update[0] >= 1 or (totaal and klaar >= totaal):
+            _schrijf_voortgang(taak_id, klaar, totaal)
+            laatste_update[0] = nu
+
+    try:
+        handler, _ = TAAKSOORTEN[taak.soort]
+        inhoud, bestandsnaam, mimetype = handler(json.loads(taak.parameters), voortgang)
+        _sla_resultaat_op(taak_id, inhoud)
+        taak = db.session.get(Taak, taak_id)
+        taak.status = 'klaar'
+        taak.bestandsnaam = bestandsnaam
+        taak.mimetype = mimetype
+        taak.voltooid_op = datetime.utcnow()
+        db.session.commit()
+    except Exception as e:
+        traceback.print_exc()
+        db.session.rollback()
+        taak = db.session.get(Taak, taak_id)
+        taak.status = 'mislukt'
+        taak.foutmelding = str(e) or e.__class__.__name__
+        taak.voltooid_op = datetime.utcnow()
+        db.session.commit()
+    return taak
+
+
+def verwerk_wachtende_taken():
+    """Voer wachtende taken uit tot de wachtrij leeg is. Geeft het aantal terug."""
+    aantal = 0
+    while True:
+        taak = claim_volgende()
+        if taak is None:
+            return aantal
+        voer_taak_uit(taak)
+        aantal += 1
+
+
+def ruim_taken_op(bewaardagen=7):
+    """Verwijder oude taken met resultaat en markeer vastgelopen taken als mislukt."""
+    nu = datetime.utcnow()
+    db.session.execute(
+        update(Taak).where(Taak.status == 'bezig', Taak.gestart_op < nu - TAAK_TIMEOUT)
+        .values(status='mislukt', foutmelding='Afgebroken (worker gestopt)', voltooid_op=nu)
+        .execution_options(synchronize_session=False)
+    )
+    oud = select(Taak.id).where(Taak.voltooid_op < nu - timedelta(days=bewaardagen))
+    db.session.execute(delete(TaakResultaat).where(TaakResultaat.taak_id.in_(oud)))
+    verwijderd = db.session.execute(
+        delete(Taak).where(Taak.voltooid_op < nu - timedelta(days=bewaardagen))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return verwijderd
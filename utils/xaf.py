@@ -0,0 +1,254 @@
+"""XML Auditfile Financieel (XAF 3.2) voor een boekjaar.
+
+De auditfile bevat het rekeningschema, de klanten en leveranciers, de beginbalans en
+alle journaalregels van het jaar. Het bestand wordt in delen opgebouwd: de journaalregels
+komen per blok van BLOK uit de database (yield_per) en worden direct als XML
+weggeschreven, eventueel gzip-gecomprimeerd. Het geheugengebruik hangt daardoor niet
+af van het aantal regels, ook niet als achtergrondtaak: de worker slaat de stroom in
+delen op in taak_resultaat en de download leest die delen een voor een terug.
+
+De kop van de transacties vraagt aantallen en totalen; die komen vooraf uit één
+aggregatiequery. Alle posten staan in één memoriaal (jrnTp G): de journaalposten
+leggen niet vast uit welk dagboek ze komen.
+"""
+
+import re
+import zlib
+from datetime import date, datetime, timedelta
+from itertools import groupby
+from xml.sax.saxutils import escape
+from flask import current_app
+from sqlalchemy import case, func, select
+from models import db, Grootboekrekening, Journaalpost, JournaalpostRegel, Klant, Leverancier
+from utils.saldi import saldi_per_rekening
+
+XAF_VERSIE = '3.2'
+XAF_NAMESPACE = 'http://www.auditfiles.nl/XAF/3.2'
+SOFTWARE = ('Boekhouding', '1.0')
+BLOK = 5000
+
+# Resultaat van eerdere jaren; zonder jaarafsluiting komt het hier in de beginbalans
+RESULTAATREKENING = '3300'
+JOURNAAL = ('MEM', 'Memoriaal', 'G')
+
+_LANDCODES = {'nederland': 'NL', 'belgie': 'BE', 'belgië': 'BE', 'duitsland': 'DE', 'frankrijk': 'FR'}
+_ONGELDIG = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_BUFFER = 64 * 1024
+
+
+def _tekst(waarde, lengte=255):
+    return escape(_ONGELDIG.sub('', str(waarde))[:lengte])
+
+
+def _el(tag, waarde, lengte=255):
+    """Element met tekst; leeg bij None of een lege tekst (optionele velden)."""
+    if waarde is None or waarde == '':
+        return ''
+    if isinstance(waarde, date):
+        waarde = waarde.isoformat()
+    return f'<{tag}>{_tekst(waarde, lengte)}</{tag}>'
+
+
+def _bedrag(centen):
+    return f'{abs(centen) / 100:.2f}'
+
+
+def _centen(waarde):
+    return int(round((waarde or 0) * 100))
+
+
+def landcode(land):
+    """ISO-landcode bij een landnaam zoals die bij klanten staat, of None."""
+    land = (land or '').strip()
+    if len(land) == 2:
+        return land.upper()
+    return _LANDCODES.get(land.lower())
+
+
+class _Uitvoer:
+    """Verzamelt XML-tekst en geeft die in blokken bytes terug, desgewenst als gzip."""
+
+    def __init__(self, comprimeer):
+        self.delen = []
+        self.lengte = 0
+        self.gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if comprimeer else None
+
+    def schrijf(self, tekst):
+        self.delen.append(tekst)
+        self.lengte += len(tekst)
+
+    def vol(self):
+        return self.lengte >= _BUFFER
+
+    def haal_op(self, laatste=False):
+        data = ''.join(self.delen).encode('utf-8')
+        self.delen, self.lengte = [], 0
+        if self.gzip:
+            data = self.gzip.compress(data) + (self.gzip.flush() if laatste else b'')
+        return data
+
+
+def _relaties():
+    for model, prefix, soort in ((Klant, 'K', 'C'), (Leverancier, 'L', 'S')):
+        query = select(model.id, model.naam, model.telefoon, model.email, model.kvk_nummer, model.btw_nummer,
+                       model.adres, model.postcode, model.plaats, model.land, model.iban).order_by(model.id)
+        for r in db.session.execute(query.execution_options(yield_per=BLOK)):
+            adres = ''
+            if r.adres or r.plaats:
+                adres = (f'<streetAddress>{_el("streetname", r.adres)}{_el("city", r.plaats, 50)}'
+                         f'{_el("postalCode", r.postcode, 10)}{_el("country", landcode(r.land))}</streetAddress>')
+            bank = f'<bankAccount>{_el("bankAccNr", r.iban, 35)}</bankAccount>' if r.iban else ''
+            yield (f'<customerSupplier>{_el("custSupID", f"{prefix}{r.id}", 35)}{_el("custSupName", r.naam, 50)}'
+                   f'{_el("telephone", r.telefoon, 30)}{_el("eMail", r.email)}{_el("commerceNr", r.kvk_nummer, 100)}'
+                   f'{_el("taxRegIdent", r.btw_nummer, 30)}<custSupTp>{soort}</custSupTp>{adres}{bank}'
+                   '</customerSupplier>')
+
+
+def _beginbalans(jaar):
+    """[(code, centen)] van de balansrekeningen op 31 december van het vorige jaar.
+
+    Het saldo van de resultaatrekeningen tot dan toe komt op RESULTAATREKENING.
+    """
+    regels, resultaat = {}, 0
+    for rek in saldi_per_rekening(tot_datum=date(jaar - 1, 12, 31)):
+        centen = _centen(rek['saldo'])
+        if rek['type'] in ('activa', 'passiva'):
+            regels[rek['code']] = regels.get(rek['code'], 0) + centen
+        else:
+            resultaat += centen
+    if resultaat:
+        regels[RESULTAATREKENING] = regels.get(RESULTAATREKENING, 0) + resultaat
+    return [(code, centen) for code, centen in sorted(regels.items()) if centen]
+
+
+def _transactietotalen(begin, eind):
+    """(aantal regels, totaal debet, totaal credit) in centen, in één query."""
+    netto = JournaalpostRegel.debet - JournaalpostRegel.credit
+    aantal, debet, credit = db.session.execute(
+        select(func.count(JournaalpostRegel.id),
+               func.sum(case((netto > 0, netto), else_=0)),
+               func.sum(case((netto < 0, -netto), else_=0)))
+        .join(Journaalpost, Journaalpost.id == JournaalpostRegel.journaalpost_id)
+        .where(Journaalpost.datum >= begin, Journaalpost.datum < eind)
+    ).one()
+    return aantal, _centen(debet), _centen(credit)
+
+
+def _journaalregels(begin, eind):
+    return db.session.execute(
+        select(Journaalpost.id, Journaalpost.datum, Journaalpost.omschrijving, Journaalpost.referentie,
+               Grootboekrekening.code, JournaalpostRegel.id.label('regel_id'),
+               JournaalpostRegel.debet, JournaalpostRegel.credit)
+        .join(JournaalpostRegel, JournaalpostRegel.journaalpost_id == Journaalpost.id)
+        .join(Grootboekrekening, Grootboekrekening.id == JournaalpostRegel.grootboekrekening_id)
+        .where(Journaalpost.datum >= begin, Journaalpost.datum < eind)
+        .order_by(Journaalpost.datum, Journaalpost.id, JournaalpostRegel.id)
+        .execution_options(yield_per=BLOK)
+    )
+
+
+def _transactie(post_id, regels):
+    eerste = regels[0]
+    bedragen = [_centen(r.debet) - _centen(r.credit) for r in regels]
+    totaal = sum(c for c in bedragen if c > 0)
+    documentref = eerste.referentie or str(post_id)
+    delen = [
+        f'<transaction>{_el("nrTrs", post_id)}{_el("desc", eerste.omschrijving)}'
+        f'<periodNumber>{eerste.datum.month}</periodNumber>{_el("trDt", eerste.datum)}'
+        f'<amnt>{_bedrag(totaal)}</amnt><amntTp>D</amntTp>'
+    ]
+    for regel, centen in zip(regels, bedragen):
+        delen.append(
+            f'<trLine>{_el("nrLine", regel.regel_id)}{_el("accID", regel.code)}{_el("docRef", documentref)}'
+            f'{_el("effDate", regel.datum)}{_el("desc", regel.omschrijving)}'
+            f'<amnt>{_bedrag(centen)}</amnt><amntTp>{"D" if centen >= 0 else "C"}</amntTp></trLine>'
+        )
+    delen.append('</transaction>')
+    return ''.join(delen)
+
+
+def xaf_bestandsnaam(jaar, comprimeer=False):
+    return f'auditfile_{jaar}.xaf' + ('.gz' if comprimeer else '')
+
+
+def xaf_stroom(jaar, comprimeer=False, voortgang=None):
+    """Genereer de auditfile van een boekjaar als stroom van bytes (gzip met comprimeer=True).
+
+    voortgang(klaar, totaal) wordt na elk blok journaalregels aangeroepen.
+    """
+    config = current_app.config
+    begin, eind = date(jaar, 1, 1), date(jaar + 1, 1, 1)
+    aantal, totaal_debet, totaal_credit = _transactietotalen(begin, eind)
+    uit = _Uitvoer(comprimeer)
+
+    uit.schrijf(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<auditfile xmlns="{XAF_NAMESPACE}">'
+        f'<header><fiscalYear>{jaar}</fiscalYear><startDate>{begin}</startDate>'
+        f'<endDate>{eind - timedelta(days=1)}</endDate><curCode>EUR</curCode>'
+        f'<dateCreated>{datetime.now():%Y-%m-%d}</dateCreated>'
+        f'{_el("softwareDesc", SOFTWARE[0], 50)}{_el("softwareVersion", SOFTWARE[1], 20)}</header>'
+        f'<company>{_el("companyIdent", config.get("BEDRIJFSKVK"), 35)}'
+        f'{_el("companyName", config.get("BEDRIJFSNAAM"))}'
+        f'<taxRegistrationCountry>{landcode(config.get("BEDRIJFSLAND")) or "NL"}</taxRegistrationCountry>'
+        f'{_el("taxRegIdent", config.get("BEDRIJFSBTW"), 30)}'
+        f'<streetAddress>{_el("streetname", config.get("BEDRIJFSADRES"))}{_el("city", config.get("BEDRIJFSPLAATS"), 50)}'
+        f'{_el("postalCode", config.get("BEDRIJFSPOSTCODE"), 10)}'
+        f'{_el("country", landcode(config.get("BEDRIJFSLAND")))}</streetAddress>'
+    )
+
+    uit.schrijf('<customersSuppliers>')
+    for relatie in _relaties():
+        uit.schrijf(relatie)
+        if uit.vol():
+            yield uit.haal_op()
+    uit.schrijf('</customersSuppliers>')
+
+    uit.schrijf('<generalLedger>')
+    for code, naam, type_ in db.session.execute(
+        select(Grootboekrekening.code, Grootboekrekening.naam, Grootboekrekening.type).order_by(Grootboekrekening.code)
+    ):
+        uit.schrijf(f'<ledgerAccount>{_el("accID", code)}{_el("accDesc", naam)}'
+                    f'<accTp>{"B" if type_ in ("activa", "passiva") else "P"}</accTp></ledgerAccount>')
+    uit.schrijf('</generalLedger>')
+
+    uit.schrijf('<periods>')
+    for maand in range(1, 13):
+        einde = date(jaar + maand // 12, maand % 12 + 1, 1) - timedelta(days=1)
+        uit.schrijf(f'<period><periodNumber>{maand}</periodNumber><periodDesc>{jaar}-{maand:02d}</periodDesc>'
+                    f'<startDatePeriod>{date(jaar, maand, 1)}</startDatePeriod>'
+                    f'<endDatePeriod>{einde}</endDatePeriod></period>')
+    uit.schrijf('</periods>')
+
+    beginbalans = _beginbalans(jaar)
+    uit.schrijf(
+        f'<openingBalance><opBalDate>{begin}</opBalDate><opBalDesc>Beginbalans {jaar}</opBalDesc>'
+        f'<linesCount>{len(beginbalans)}</linesCount>'
+        f'<totalDebit>{_bedrag(sum(c for _, c in beginbalans if c > 0))}</totalDebit>'
+        f'<totalCredit>{_bedrag(sum(c for _, c in beginbalans if c < 0))}</totalCredit>'
+    )
+    for nummer, (code, centen) in enumerate(beginbalans, start=1):
+        uit.schrijf(f'<obLine><nr>{nummer}</nr>{_el("accID", code)}<amnt>{_bedrag(centen)}</amnt>'
+                    f'<amntTp>{"D" if centen > 0 else "C"}</amntTp></obLine>')
+    uit.schrijf('</openingBalance>')
+    yield uit.haal_op()
+
+    jrn_id, jrn_omschrijving, jrn_type = JOURNAAL
+    uit.schrijf(
+        f'<transactions><linesCount>{aantal}</linesCount><totalDebit>{_bedrag(totaal_debet)}</totalDebit>'
+        f'<totalCredit>{_bedrag(totaal_credit)}</totalCredit>'
+        f'<journal><jrnID>{jrn_id}</jrnID><desc>{jrn_omschrijving}</desc><jrnTp>{jrn_type}</jrnTp>'
+    )
+    klaar = 0
+    for post_id, regels in groupby(_journaalregels(begin, eind), key=lambda r: r.id):
+        regels = list(regels)
+        uit.schrijf(_transactie(post_id, regels))
+        klaar += len(regels)
+        if uit.vol():
+            if voortgang:
+                voortgang(klaar, aantal)
+            yield uit.haal_op()
+    uit.schrijf('</journal></transactions></company></auditfile>\n')
+    if voortgang:
+        voortgang(klaar, aantal)
+    yield uit.haal_op(laatste=True)
@@ -0,0 +1,56 @@
+"""Achtergrondproces (Procfile: worker).
+
+Voert wachtende taken uit de tabel taak uit (zie utils.taken) en doet periodiek
+onderhoud: facturen met een verstreken vervaldatum op 'vervallen' zetten en oude taken
+en verouderde rapportcache-items opruimen. WORKER_POLL bepaalt hoe vaak (in seconden)
+naar nieuwe taken wordt gekeken, WORKER_INTERVAL hoe vaak het onderhoud draait (standaard een uur).
+"""
+import os
+import time
+from app import app
+from models import db
+from utils.openstaand import markeer_vervallen
+from utils.rapportcache import ruim_cache_op
+from utils.taken import verwerk_wachtende_taken, ruim_taken_op
+
+INTERVAL = int(os.environ.get('WORKER_INTERVAL', 3600))
+POLL = float(os.environ.get('WORKER_POLL', 2))
+
+
+def voer_onderhoud_uit():
+    with app.app_context():
+        try:
+            aantallen = markeer_vervallen()
+            if any(aantallen.values()):
+                print(f"Vervallen: {aantallen['verkoop']} verkoop, {aantallen['inkoop']} inkoop", flush=True)
+            verwijderd = ruim_taken_op()
+            if verwijderd:
+                print(f'{verwijderd} oude taak/taken opgeruimd', flush=True)
+            verouderd = ruim_cache_op()
+            if verouderd:
+                print(f'{verouderd} verouderde cache-item(s) opgeruimd', flush=True)
+        except Exception as e:
+            db.session.rollback()
+            print(f'Onderhoud mislukt: {e}', flush=True)
+
+
+def verwerk_taken():
+    with app.app_context():
+        try:
+            aantal = verwerk_wachtende_taken()
+            if aantal:
+                print(f'{aantal} taak/taken uitgevoerd', flush=True)
+        except Exception as e:
+            db.session.rollback()
+            print(f'Taken verwerken mislukt: {e}', flush=True)
+
+
+if __name__ == '__main__':
+    print(f'Worker gestart, taken elke {POLL:g}s, onderhoud elke {INTERVAL}s', flush=True)
+    volgend_onderhoud = 0
+    while True:
+        if time.monotonic() >= volgend_onderhoud:
+            voer_onderhoud_uit()
+            volgend_onderhoud = time.monotonic() + INTERVAL
+        verwerk_taken()
+        time.sleep(POLL)